@@ -3,29 +3,58 @@
 import os
 import time
 import uuid
+import hashlib
 import threading
-import subprocess
-from flask import Flask, request, jsonify, send_from_directory, render_template
-from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_from_directory, render_template, Response, stream_with_context
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
 import json
-import shutil
 import redis
+from collections import deque
 
 # 确保 downloader 在 app 之前导入，以避免循环依赖
-from downloader import process_task_file_with_progress, DownloadController
+from downloader import (
+    process_task_file_with_progress, DownloadController, RedisDownloadController, TaskSuspended, PACK_MODES,
+    open_task_file
+)
+from async_downloader import process_task_file_async
+from distributed import process_task_file_distributed
+from job_queue import JobQueue, SlotScheduler, clamp_priority, DEFAULT_PRIORITY
+from postprocess import normalize_postprocess_options, check_postprocess_support
+from metrics import gauge, render_metrics, redis_timer, TaskProfiler, profile_summary
+from uploader import UploadManager, MAX_CONCURRENT_UPLOADS, run_rclone, format_upload_stats
+from housekeeping import Housekeeper, book_artifact_names, HOUSEKEEPING_INTERVAL
+from task_cache import store_upload
+from zip_export import ZipExport, list_chapters
 
 app = Flask(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 OUTPUT_FOLDER = os.path.join(BASE_DIR, "output")
+# 开启性能分析的任务结束后，cProfile 结果保存在这里
+PROFILE_FOLDER = os.path.join(BASE_DIR, "profiles")
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(PROFILE_FOLDER, exist_ok=True)
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+# /download 和整本 CBZ 的导出经 send_from_directory 返回，gunicorn 等提供 wsgi.file_wrapper 的服务器用 sendfile 零拷贝发送；
+# 前面有 nginx/Apache 并配置了 X-Sendfile（X-Accel-Redirect 需另行映射）时可打开，文件由前端服务器直接发送
+USE_X_SENDFILE = False
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+CBZ_MIMETYPE = 'application/vnd.comicbook+zip'
+
+# --- 输出目录清理配置 ---
+# 输出目录（书籍目录和 CBZ）的总大小上限，超过时按最近最少使用的顺序删除；None 为不限制
+OUTPUT_QUOTA_BYTES = None
+# 超过该天数没有访问的书籍目录和 CBZ 会被删除
+OUTPUT_MAX_AGE_DAYS = 7
 
 # --- Redis 配置 ---
 REDIS_HOST = 'localhost'
@@ -43,8 +72,32 @@ except Exception as e:
     print(f"警告: Redis 连接失败: {e}。URL去重功能将不可用。")
     redis_client = None
 
-executor = ThreadPoolExecutor(max_workers=4)
+# rclone 上传（手动或打包后自动）共用一个执行器，同时运行的上传数有上限
+upload_manager = UploadManager(MAX_CONCURRENT_UPLOADS)
+# 同时运行的下载任务数，其余按优先级排队
+MAX_RUNNING_TASKS = 4
+# 所有下载任务合计的在途图片请求上限，按优先级加权公平分配给各任务
+GLOBAL_DOWNLOAD_SLOTS = 64
+job_queue = JobQueue(MAX_RUNNING_TASKS)
+slot_scheduler = SlotScheduler(GLOBAL_DOWNLOAD_SLOTS)
+
+def _job_queue_depth():
+    snapshot = job_queue.snapshot()
+    return {('queued',): len(snapshot['queued']), ('running',): len(snapshot['running'])}
+
+gauge("job_queue_tasks", "下载任务队列中排队和运行的任务数", ("state",), callback=_job_queue_depth)
+gauge("download_slots_in_use", "全局下载槽位的占用数", callback=lambda: slot_scheduler.in_use)
+gauge("uploads", "rclone 上传任务数", ("state",),
+      callback=lambda: {(k,): v for k, v in upload_manager.stats().items() if k != 'max_concurrent'})
+# 下载引擎：thread 为每个任务一个线程池，async 为所有任务共享一个事件循环（需要 aiohttp），
+# distributed 把图片分发给 worker.py 下载进程（需要 Redis）
+DOWNLOAD_ENGINES = {
+    'thread': process_task_file_with_progress, 'async': process_task_file_async,
+    'distributed': process_task_file_distributed,
+}
 download_controllers = {}
+# 已暂停并退出的任务，Redis 不可用时恢复任务靠这里的规格和状态
+suspended_tasks = {}
 
 def get_task_key(task_id):
     return f"{REDIS_KEY_PREFIX}task:{task_id}"
@@ -52,47 +105,634 @@ def get_task_key(task_id):
 def get_all_tasks_key():
     return f"{REDIS_KEY_PREFIX}tasks"
 
+# 按创建时间排序的任务索引 (ZSET) 和精简摘要 (HASH)，用于分页列出任务
+def get_task_index_key():
+    return f"{REDIS_KEY_PREFIX}tasks:index"
+
+def get_task_summary_key():
+    return f"{REDIS_KEY_PREFIX}tasks:summary"
+
+def compact_task_result(result):
+    # 下载结果里的失败URL列表可能很长，摘要中只保留数量
+    if isinstance(result, list):
+        return [{k: (len(v) if k == 'failed' else v) for k, v in r.items() if k != 'connections'}
+                if isinstance(r, dict) else r for r in result]
+    return result
+
+def build_task_summary(task_id, status_data):
+    return {
+        'task_id': task_id, 'task_type': status_data.get('task_type'),
+        'status': status_data.get('status', '未知'),
+        'filename': status_data.get('config', {}).get('filename', ''),
+        'progress_percent': status_data.get('progress_percent', 0),
+        'created_at': status_data.get('created_at'), 'updated_at': status_data.get('updated_at'),
+        'result': compact_task_result(status_data.get('result')),
+    }
+
+def stage_task_write(pipe, task_id, status_data):
+    """把任务文档、摘要和时间索引的写入放进同一个 pipeline。"""
+    status_data['updated_at'] = time.time()
+    status_data.setdefault('created_at', status_data['updated_at'])
+    pipe.set(get_task_key(task_id), json.dumps(status_data, ensure_ascii=False))
+    pipe.sadd(get_all_tasks_key(), task_id)
+    pipe.hset(get_task_summary_key(), task_id, json.dumps(build_task_summary(task_id, status_data), ensure_ascii=False))
+    pipe.zadd(get_task_index_key(), {task_id: status_data['created_at']}, nx=True)
+
+TASK_LOG_LIMIT = 200
+PROGRESS_FLUSH_INTERVAL = 0.5
+PROGRESS_FLUSH_EVENTS = 50
+SSE_POLL_INTERVAL = 1.0
+SSE_MIN_INTERVAL = 0.25
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_INITIAL_LOGS = 50
+FINAL_TASK_STATUSES = ('完成', '失败', '中断')
+RESUMABLE_TASK_STATUSES = ('中断', '失败', '暂停中')
+TASK_RETENTION_DAYS = 30
+TASK_PRUNE_INTERVAL = 3600
+TASK_LIST_DEFAULT_LIMIT = 50
+TASK_LIST_MAX_LIMIT = 200
+TASK_LEASE_TTL = 24*3600
+
+# 日志单独存放在定长 Redis 列表中，任务文档本身不再包含日志
+def get_task_logs_key(task_id):
+    return f"{REDIS_KEY_PREFIX}task:{task_id}:logs"
+
+# 完整任务规格（含上传文件路径和所有选项），用于恢复中断的任务
+def get_task_spec_key(task_id):
+    return f"{REDIS_KEY_PREFIX}task:{task_id}:spec"
+
+# 每张图片的完成位图
+def get_task_manifest_key(task_id):
+    return f"{REDIS_KEY_PREFIX}task:{task_id}:done"
+
+# 任务租约：任务排队或运行期间存在，保证多个 Web 进程不会同时运行同一个任务
+def get_task_lease_key(task_id):
+    return f"{REDIS_KEY_PREFIX}lease:{task_id}"
+
+def claim_task_lease(task_id):
+    if not redis_client: return True
+    return bool(redis_client.set(get_task_lease_key(task_id), os.getpid(), nx=True, ex=TASK_LEASE_TTL))
+
+def release_task_lease(task_id):
+    if not redis_client: return
+    try:
+        redis_client.delete(get_task_lease_key(task_id))
+    except Exception as e:
+        print(f"释放任务租约时出错 {task_id}: {e}")
+
+def task_lease_held(task_id):
+    return bool(redis_client and redis_client.exists(get_task_lease_key(task_id)))
+
+# 输出目录顶层条目 → 写入它的任务，供所有 Web 进程判断条目是否正在使用
+OUTPUT_OWNERS_KEY = f"{REDIS_KEY_PREFIX}output_owners"
+# 多个 Web 进程（gunicorn 多 worker）中只有持有该锁的进程执行清理
+HOUSEKEEPING_LOCK_KEY = f"{REDIS_KEY_PREFIX}housekeeping_lock"
+HOUSEKEEPING_LOCK_TOKEN = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+def make_download_controller(task_id):
+    """有 Redis 时暂停/继续状态存放在 Redis 中，任意 Web 进程和下载进程都能控制同一个任务。"""
+    if redis_client:
+        return RedisDownloadController(redis_client, task_id)
+    return DownloadController()
+
+def find_download_controller(task_id):
+    ctrl = download_controllers.get(task_id)
+    if ctrl is None and task_lease_held(task_id):
+        # 任务在其他 Web 进程中排队或运行
+        ctrl = make_download_controller(task_id)
+    return ctrl
+
+def save_task_spec(task_id, spec):
+    if not redis_client: return
+    try:
+        redis_client.set(get_task_spec_key(task_id), json.dumps(spec, ensure_ascii=False))
+    except Exception as e:
+        print(f"保存任务规格到 Redis 时出错 {task_id}: {e}")
+
+def load_task_spec(task_id):
+    if not redis_client: return None
+    try:
+        json_data = redis_client.get(get_task_spec_key(task_id))
+        return json.loads(json_data) if json_data else None
+    except Exception as e:
+        print(f"从 Redis 加载任务规格时出错 {task_id}: {e}")
+    return None
+
+# 日志累计条数，用于事件流只推送新增的日志
+def get_task_log_seq_key(task_id):
+    return f"{REDIS_KEY_PREFIX}task:{task_id}:log_seq"
+
 def save_task_status(task_id, status_data):
     if not redis_client: return # 如果Redis不可用，则不保存
     try:
-        task_key = get_task_key(task_id)
-        redis_client.set(task_key, json.dumps(status_data, ensure_ascii=False))
-        redis_client.sadd(get_all_tasks_key(), task_id)
+        pipe = redis_client.pipeline(transaction=False)
+        stage_task_write(pipe, task_id, status_data)
+        pipe.execute()
     except Exception as e:
         print(f"保存任务状态到 Redis 时出错 {task_id}: {e}")
 
-def load_task_status(task_id):
+def append_task_logs(task_id, messages, pipe=None):
+    if not redis_client or not messages: return
+    try:
+        logs_key = get_task_logs_key(task_id)
+        p = pipe or redis_client.pipeline(transaction=False)
+        p.rpush(logs_key, *messages)
+        p.ltrim(logs_key, -TASK_LOG_LIMIT, -1)
+        p.incrby(get_task_log_seq_key(task_id), len(messages))
+        if pipe is None:
+            p.execute()
+    except Exception as e:
+        print(f"写入任务日志到 Redis 时出错 {task_id}: {e}")
+
+def append_task_log(task_id, message):
+    append_task_logs(task_id, [message])
+
+def load_task_status(task_id, with_logs=True, log_limit=TASK_LOG_LIMIT):
     if not redis_client: return None # 如果Redis不可用，则无法加载
     try:
         task_key = get_task_key(task_id)
-        json_data = redis_client.get(task_key)
+        if not with_logs:
+            json_data = redis_client.get(task_key)
+            return json.loads(json_data) if json_data else None
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(task_key)
+        pipe.lrange(get_task_logs_key(task_id), -log_limit, -1)
+        json_data, logs = pipe.execute()
         if json_data:
-            return json.loads(json_data)
+            status_data = json.loads(json_data)
+            # 兼容旧版本把日志写在任务文档里的记录
+            status_data['logs'] = (status_data.get('logs') or []) + (logs or [])
+            return status_data
     except Exception as e:
         print(f"从 Redis 加载任务状态时出错 {task_id}: {e}")
     return None
 
+def load_task_changes(task_id, since_seq=None):
+    """
+    读取任务文档以及 since_seq 之后新增的日志，返回 (状态, 新日志, 日志序号)。
+    since_seq 为 None 时返回最近的若干条日志。
+    """
+    if not redis_client: return None, [], 0
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(get_task_key(task_id))
+    pipe.get(get_task_log_seq_key(task_id))
+    json_data, seq = pipe.execute()
+    if not json_data:
+        return None, [], 0
+    status_data = json.loads(json_data)
+    legacy_logs = status_data.pop('logs', None) or []
+    seq = int(seq or 0)
+    if since_seq is None:
+        logs = legacy_logs + redis_client.lrange(get_task_logs_key(task_id), -SSE_INITIAL_LOGS, -1)
+        logs = logs[-SSE_INITIAL_LOGS:]
+    elif seq > since_seq:
+        logs = redis_client.lrange(get_task_logs_key(task_id), -min(seq - since_seq, TASK_LOG_LIMIT), -1)
+    else:
+        logs = []
+    return status_data, logs, seq
+
+class LiveTaskState:
+    """
+    运行中任务的内存状态。下载线程只修改内存，由后台线程按固定间隔
+    （或累计一定事件数后）合并写入 Redis，进度更新不会阻塞下载线程。
+    """
+    def __init__(self, task_id, status_data):
+        self.task_id = task_id
+        self.data = {k: v for k, v in status_data.items() if k != 'logs'}
+        self.recent_logs = deque(maxlen=TASK_LOG_LIMIT)
+        self._pending_logs = deque(maxlen=TASK_LOG_LIMIT)
+        self._events = 0
+        self._dirty = True
+        self.log_seq = 0
+        self.version = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+
+    def progress(self, current, total, msg):
+        with self._lock:
+            self.data['progress_current'] = current
+            self.data['progress_total'] = total
+            self.data['progress_percent'] = (current / total * 100) if total > 0 else 0
+            self._log(msg)
+            self._changed.notify_all()
+            wake = self._events >= PROGRESS_FLUSH_EVENTS
+        if wake:
+            progress_flush_event.set()
+
+    def update(self, log=None, **fields):
+        with self._lock:
+            self.data.update(fields)
+            self._dirty = True
+            self.version += 1
+            if log:
+                self._log(log)
+            self._changed.notify_all()
+        progress_flush_event.set()
+
+    def log(self, msg):
+        with self._lock:
+            self._log(msg)
+            self._changed.notify_all()
+
+    def _log(self, msg):
+        self.recent_logs.append(msg)
+        self._pending_logs.append(msg)
+        self._events += 1
+        self._dirty = True
+        self.log_seq += 1
+        self.version += 1
+
+    def close(self):
+        """任务结束：写入最终状态并唤醒所有等待中的事件流。"""
+        self.flush()
+        with self._lock:
+            self.closed = True
+            self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.closed, timeout)
+            return self.version
+
+    def changes_since(self, since_seq=None):
+        """返回 (状态, since_seq 之后的新日志, 日志序号)，语义同 load_task_changes。"""
+        with self._lock:
+            data = dict(self.data)
+            seq = self.log_seq
+            if since_seq is None:
+                count = SSE_INITIAL_LOGS
+            else:
+                count = min(seq - since_seq, len(self.recent_logs))
+            logs = list(self.recent_logs)[-count:] if count > 0 else []
+        return data, logs, seq
+
+    def snapshot(self, log_limit=TASK_LOG_LIMIT):
+        with self._lock:
+            data = dict(self.data)
+            logs = list(self.recent_logs)
+        data['logs'] = logs[-log_limit:]
+        return data
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = dict(self.data)
+                logs = list(self._pending_logs)
+                self._pending_logs.clear()
+                self._events = 0
+                self._dirty = False
+            if not redis_client: return
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                stage_task_write(pipe, self.task_id, data)
+                append_task_logs(self.task_id, logs, pipe=pipe)
+                with redis_timer("task_flush"):
+                    pipe.execute()
+            except Exception as e:
+                print(f"刷新任务状态到 Redis 时出错 {self.task_id}: {e}")
+
+live_tasks = {}
+progress_flush_event = threading.Event()
+
+def progress_flush_loop():
+    while True:
+        progress_flush_event.wait(PROGRESS_FLUSH_INTERVAL)
+        progress_flush_event.clear()
+        for state in list(live_tasks.values()):
+            state.flush()
+
+threading.Thread(target=progress_flush_loop, daemon=True, name="progress-flusher").start()
+
+def update_task(task_id, log=None, **fields):
+    """更新任务字段并可选追加一条日志；运行中的任务只修改内存状态。"""
+    live = live_tasks.get(task_id)
+    if live:
+        live.update(log=log, **fields)
+        return
+    task_data = load_task_status(task_id, with_logs=False)
+    if task_data is None: return
+    task_data.update(fields)
+    save_task_status(task_id, task_data)
+    if log:
+        append_task_log(task_id, log)
+
+def get_task_snapshot(task_id, log_limit=TASK_LOG_LIMIT):
+    live = live_tasks.get(task_id)
+    if live:
+        return live.snapshot(log_limit)
+    return load_task_status(task_id, log_limit=log_limit)
+
+def task_event_stream(task_id):
+    """
+    Server-Sent Events 生成器：只推送变化的字段和新增的日志。
+    本进程内运行的任务直接等待内存状态变化，其它任务按固定间隔读取 Redis。
+    """
+    sent_state = {}
+    log_seq = None
+    version = -1
+    last_sent = 0
+    live = live_tasks.get(task_id)
+    while True:
+        if live:
+            version = live.wait_for_change(version, SSE_HEARTBEAT_INTERVAL)
+            data, logs, log_seq_now = live.changes_since(log_seq)
+        else:
+            data, logs, log_seq_now = load_task_changes(task_id, log_seq)
+            if data is None:
+                yield f"event: error\ndata: {json.dumps({'error': '任务不存在'}, ensure_ascii=False)}\n\n"
+                return
+        log_seq = log_seq_now
+        delta = {k: v for k, v in data.items() if sent_state.get(k) != v}
+        if delta or logs:
+            sent_state.update(delta)
+            yield f"data: {json.dumps({'state': delta, 'logs': logs}, ensure_ascii=False)}\n\n"
+            last_sent = time.time()
+        elif time.time() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+        if data.get('status') in FINAL_TASK_STATUSES or (live and live.closed):
+            yield "event: end\ndata: {}\n\n"
+            return
+        time.sleep(SSE_MIN_INTERVAL if live else SSE_POLL_INTERVAL)
+
 def load_all_task_ids():
     if not redis_client: return set()
     return redis_client.smembers(get_all_tasks_key()) or set()
 
+def parse_task_cursor(cursor):
+    """分页 cursor 为“创建时间:任务ID”；只有创建时间的旧格式按不包含该时间处理。"""
+    score, _, task_id = cursor.partition(":")
+    return float(score), task_id or None
+
+def list_task_summaries(limit=TASK_LIST_DEFAULT_LIMIT, cursor=None, statuses=None, ascending=False):
+    """
+    按创建时间分页读取任务摘要。cursor 为上一页最后一个任务的 (创建时间, 任务ID)，
+    返回 (摘要列表, 下一页 cursor)。每批用一次 ZRANGEBYSCORE + HMGET 读取。
+    创建时间相同的任务在有序集合里按任务ID排列，因此从该创建时间（含）开始读，
+    跳过任务ID不在 cursor 之后的条目，同一时刻创建的多个任务也不会在翻页时漏掉。
+    """
+    if not redis_client: return [], None
+    index_key = get_task_index_key()
+    tasks = []
+    batch_size = max(limit, 20)
+    score, last_id = cursor if cursor is not None else (None, None)
+    # 同一创建时间的条目多于一批、整批都被跳过时，下一批从偏移处继续
+    offset = 0
+    for _ in range(10):
+        if score is None:
+            bound = "-inf" if ascending else "+inf"
+        else:
+            bound = score if last_id else f"({score}"
+        if ascending:
+            entries = redis_client.zrangebyscore(index_key, bound, "+inf", start=offset, num=batch_size,
+                                                 withscores=True)
+        else:
+            entries = redis_client.zrevrangebyscore(index_key, bound, "-inf", start=offset, num=batch_size,
+                                                    withscores=True)
+        if not entries:
+            return tasks, None
+        if last_id:
+            entries_after = [(t, sc) for t, sc in entries
+                             if sc != score or (t > last_id if ascending else t < last_id)]
+        else:
+            entries_after = entries
+        offset = offset + len(entries) if not entries_after else 0
+        summaries = redis_client.hmget(get_task_summary_key(), [t for t, _ in entries_after]) if entries_after else []
+        for (task_id, entry_score), raw in zip(entries_after, summaries):
+            score, last_id = entry_score, task_id
+            if not raw:
+                continue
+            summary = json.loads(raw)
+            if statuses and summary.get('status') not in statuses:
+                continue
+            tasks.append(summary)
+            if len(tasks) >= limit:
+                return tasks, f"{score}:{last_id}"
+        if len(entries) < batch_size:
+            return tasks, None
+    # 过滤条件命中率很低时，扫描一定数量后先返回，由客户端继续翻页
+    return tasks, f"{score}:{last_id}" if last_id else None
+
+last_task_prune = [0]
+
+def prune_expired_tasks(retention_days=TASK_RETENTION_DAYS):
+    """删除创建时间超过保留期限、且不在本进程运行中的任务记录。"""
+    if not redis_client: return 0
+    last_task_prune[0] = time.time()
+    deadline = time.time() - retention_days * 86400
+    expired = redis_client.zrangebyscore(get_task_index_key(), "-inf", deadline)
+    removed = 0
+    for start in range(0, len(expired), 500):
+        batch = [t for t in expired[start:start + 500] if t not in live_tasks]
+        if not batch:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        for task_id in batch:
+            pipe.delete(get_task_key(task_id), get_task_logs_key(task_id), get_task_log_seq_key(task_id),
+                        get_task_spec_key(task_id), get_task_manifest_key(task_id))
+        pipe.hdel(get_task_summary_key(), *batch)
+        pipe.zrem(get_task_index_key(), *batch)
+        pipe.srem(get_all_tasks_key(), *batch)
+        pipe.execute()
+        removed += len(batch)
+    return removed
+
+def maybe_prune_expired_tasks():
+    if time.time() - last_task_prune[0] >= TASK_PRUNE_INTERVAL:
+        try:
+            prune_expired_tasks()
+        except Exception as e:
+            print(f"清理过期任务记录时出错: {e}")
+
 def check_interrupted_tasks():
     if not redis_client:
         print("Redis 不可用，跳过中断任务检查。")
         return
     print("正在检查中断的任务...")
     task_ids = load_all_task_ids()
+    indexed = set(redis_client.hkeys(get_task_summary_key()))
     interrupted_count = 0
     for task_id in task_ids:
-        status_data = load_task_status(task_id)
-        if status_data and status_data.get('status') == '执行中':
-            status_data['status'] = '中断'
-            status_data['logs'].append(f"警告: 服务器重启，任务在 {time.strftime('%Y-%m-%d %H:%M:%S')} 被中断。")
-            save_task_status(task_id, status_data)
+        status_data = load_task_status(task_id, with_logs=False)
+        if not status_data:
+            continue
+        if status_data.get('status') in ('执行中', '等待执行', '暂停中'):
+            release_task_lease(task_id)
+            update_task(task_id, status='中断',
+                        log=f"警告: 服务器重启，任务在 {time.strftime('%Y-%m-%d %H:%M:%S')} 被中断，可点击继续从断点恢复。")
             interrupted_count += 1
+        elif task_id not in indexed:
+            # 旧版本创建的任务没有摘要索引，补建一次
+            save_task_status(task_id, status_data)
     if interrupted_count > 0:
         print(f"发现并标记了 {interrupted_count} 个中断的任务。")
     print(f"从 Redis 加载了 {len(task_ids)} 个现有任务。")
+    removed = prune_expired_tasks()
+    if removed:
+        print(f"清理了 {removed} 个超过 {TASK_RETENTION_DAYS} 天的任务记录。")
+
+# 正在排队或运行的任务文件 -> 任务ID，相同的提交合并到已有任务
+def get_task_file_key(coalesce_key):
+    return f"{REDIS_KEY_PREFIX}taskfile:{coalesce_key}"
+
+# 影响下载结果的选项，这些选项和任务文件都相同的提交才会合并
+COALESCE_SPEC_FIELDS = (
+    'headers', 'custom_referer', 'pack_after_download', 'delete_after_pack', 'pack_mode',
+    'aes_key', 'aes_iv', 'postprocess', 'upload_remote',
+)
+active_task_files = {}
+task_file_lock = threading.Lock()
+
+def task_coalesce_key(digest, filename, spec):
+    options = {k: spec.get(k) for k in COALESCE_SPEC_FIELDS}
+    raw = json.dumps([digest, filename, options], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def claim_task_file(coalesce_key, task_id):
+    """登记任务正在下载的任务文件；已有相同的任务在排队或运行时返回那个任务的 ID。"""
+    with task_file_lock:
+        if redis_client:
+            key = get_task_file_key(coalesce_key)
+            for _ in range(2):
+                if redis_client.set(key, task_id, nx=True, ex=TASK_LEASE_TTL):
+                    return None
+                existing = redis_client.get(key)
+                if existing and (existing in download_controllers or task_lease_held(existing)):
+                    return existing
+                # 登记的任务已经结束（例如进程崩溃），清掉后重新登记
+                redis_client.delete(key)
+            return None
+        existing = active_task_files.get(coalesce_key)
+        if existing and existing in download_controllers:
+            return existing
+        active_task_files[coalesce_key] = task_id
+        return None
+
+def release_task_file(coalesce_key, task_id):
+    if not coalesce_key: return
+    with task_file_lock:
+        try:
+            if redis_client:
+                key = get_task_file_key(coalesce_key)
+                if redis_client.get(key) == task_id:
+                    redis_client.delete(key)
+            elif active_task_files.get(coalesce_key) == task_id:
+                del active_task_files[coalesce_key]
+        except Exception as e:
+            print(f"释放任务文件登记时出错 {task_id}: {e}")
+
+def start_download_task(task_id, spec, status_data):
+    """按任务规格把下载任务放入队列；恢复中断任务时同样走这里，已完成的图片由位图跳过。"""
+    live = LiveTaskState(task_id, status_data)
+    live_tasks[task_id] = live
+    download_controller = make_download_controller(task_id)
+    download_controller.resume()
+    download_controllers[task_id] = download_controller
+
+    def download_task_wrapper():
+        slots = slot_scheduler.register(task_id, spec.get('priority', DEFAULT_PRIORITY))
+        profiler = TaskProfiler() if spec.get('profile') else None
+        suspended = False
+        try:
+            claim_task_outputs(task_id, spec)
+            # 排队期间被暂停的任务轮到时直接让出位置
+            download_controller.check()
+            live.update(status='执行中')
+            process_task = DOWNLOAD_ENGINES[spec.get('engine', 'thread')]
+            with profiler.thread() if profiler else contextlib.nullcontext():
+                result = process_task(
+                    spec['task_path'], app.config['OUTPUT_FOLDER'], spec['headers'],
+                    live.progress, spec['proxy_list'], spec['pack_after_download'],
+                    spec['delete_after_pack'], spec['aes_key'], spec['aes_iv'], max_workers=spec['thread_count'],
+                    download_controller=download_controller, custom_referer=spec['custom_referer'],
+                    redis_client=redis_client, pool_size=spec['pool_size'],
+                    stream_download=spec['stream_download'], manifest_key=get_task_manifest_key(task_id),
+                    resume_download=spec.get('resume_download', False),
+                    max_concurrency=spec.get('max_concurrency'), status_callback=lambda fields: live.update(**fields),
+                    pack_mode=spec.get('pack_mode', 'after'), download_slots=slots, profiler=profiler,
+                    postprocess=spec.get('postprocess')
+                )
+            fields = {'status': '完成', 'result': result, 'progress_percent': 100}
+            if live.data.get('progress_total', 0) > 0:
+                fields['progress_current'] = live.data['progress_total']
+            if spec.get('upload_remote'):
+                # 打包完成后自动上传，上传任务的 ID 随完成状态一起推送给页面
+                fields['upload_task_id'] = start_auto_upload(spec['upload_remote'], result, live)
+            live.update(**fields)
+        except TaskSuspended:
+            suspended = True
+            live.update(status='暂停中', log="⏸️ 任务已暂停，下载槽位已让给其他任务，继续时从断点恢复")
+            suspended_tasks[task_id] = (spec, dict(live.data))
+        except Exception as e:
+            current_status = live.data.get('status', '')
+            fields = {'result': {'error': str(e)}}
+            if current_status not in ['暂停中', '中断']:
+                fields['status'] = '失败'
+            live.update(log=f"❌ 任务执行失败: {e}", **fields)
+        finally:
+            slot_scheduler.unregister(task_id)
+            if profiler:
+                save_task_profile(task_id, profiler, live)
+            live_tasks.pop(task_id, None)
+            live.close()
+            if task_id in download_controllers:
+                del download_controllers[task_id]
+            release_task_lease(task_id)
+            release_task_file(spec.get('coalesce_key'), task_id)
+            housekeeper.index.release(task_id)
+            if OUTPUT_QUOTA_BYTES:
+                # 有配额时任务结束后立即检查一次，不必等到下一轮
+                housekeeper.trigger()
+        # 暂停后、退出前用户又点了继续：重新排队（读取最新状态，不用控制器里的缓存）
+        if suspended and not (make_download_controller(task_id) if redis_client else download_controller).is_paused():
+            error = restart_download_task(task_id)
+            if error:
+                append_task_log(task_id, f"⚠️ 无法继续: {error}")
+
+    job_queue.submit(task_id, download_task_wrapper, spec.get('priority', DEFAULT_PRIORITY))
+
+def get_task_profile_path(task_id):
+    return os.path.join(PROFILE_FOLDER, f"{task_id}.prof")
+
+def save_task_profile(task_id, profiler, live):
+    try:
+        if profiler.dump(get_task_profile_path(task_id)):
+            live.update(log=f"📈 性能分析已保存，可在 /profile/{task_id} 查看")
+    except Exception as e:
+        live.update(log=f"保存性能分析失败: {e}")
+
+def restart_download_task(task_id):
+    """重新提交一个已中断/失败的任务，返回错误信息或 None。"""
+    if task_id in live_tasks:
+        return '任务正在运行'
+    spec = load_task_spec(task_id)
+    status_data = load_task_status(task_id, with_logs=False)
+    if task_id in suspended_tasks:
+        fallback_spec, fallback_status = suspended_tasks[task_id]
+        spec, status_data = spec or fallback_spec, status_data or fallback_status
+    if not spec or not status_data:
+        return '任务规格不存在，无法恢复'
+    if status_data.get('status') not in RESUMABLE_TASK_STATUSES:
+        return f"任务状态为{status_data.get('status')}，无法恢复"
+    if not os.path.exists(spec['task_path']):
+        return '任务文件已不存在，无法恢复'
+    if not claim_task_lease(task_id):
+        return '任务正在运行'
+    existing = claim_task_file(spec['coalesce_key'], task_id) if spec.get('coalesce_key') else None
+    if existing and existing != task_id:
+        # 相同的任务文件已由另一个任务排队或下载，再开一个会写入同一个书籍目录和 CBZ
+        release_task_lease(task_id)
+        return f'相同的任务文件正在由任务 {existing} 下载，请查看该任务'
+    suspended_tasks.pop(task_id, None)
+    status_data['status'] = '等待执行'
+    save_task_status(task_id, status_data)
+    append_task_log(task_id, "🔁 任务已重新排队，将跳过已完成的图片")
+    start_download_task(task_id, spec, status_data)
+    return None
 
 def parse_proxy_list(proxy_list_text):
     proxies = []
@@ -102,21 +742,73 @@ def parse_proxy_list(proxy_list_text):
         proxies.append(line)
     return proxies
 
-def auto_cleanup(output_folder, max_age_days=7):
-    now = time.time()
-    for filename in os.listdir(output_folder):
-        file_path = os.path.join(output_folder, filename)
-        mtime = os.path.getmtime(file_path)
-        if now - mtime > max_age_days * 86400:
-            try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    print(f"自动清理: 删除过期文件 {file_path}")
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                    print(f"自动清理: 删除过期文件夹 {file_path}")
-            except Exception as e:
-                print(f"自动清理失败: {file_path} {e}")
+def output_entry_name(path):
+    """输出目录内路径对应的顶层条目名称（书籍目录或 CBZ 文件名）。"""
+    return os.path.relpath(path, app.config['OUTPUT_FOLDER']).split(os.sep)[0]
+
+def is_output_protected(name, owner):
+    """运行中、排队中、已暂停（含其他 Web 进程中）的任务写入的条目，以及等待上传的文件不能删除。"""
+    if not owner and redis_client:
+        # 其他 Web 进程的任务只登记在 Redis 里
+        owner = redis_client.hget(OUTPUT_OWNERS_KEY, name)
+    if owner and (owner in download_controllers or owner in suspended_tasks or task_lease_held(owner)):
+        return True
+    return name in {output_entry_name(path) for path in upload_manager.pending_paths()}
+
+def active_output_names():
+    return housekeeper.index.names_owned_by(download_controllers)
+
+def on_output_evicted(name, owner):
+    if not redis_client:
+        return
+    owner = owner or redis_client.hget(OUTPUT_OWNERS_KEY, name)
+    redis_client.hdel(OUTPUT_OWNERS_KEY, name)
+    # 中断的任务恢复时会按位图跳过已完成的图片，书籍目录被删除后要从头下载
+    if owner:
+        redis_client.delete(get_task_manifest_key(owner))
+
+def acquire_housekeeping_lock():
+    """没有 Redis 时只有本进程；有 Redis 时抢占或续期清理锁，锁过期前其他进程跳过清理。"""
+    if not redis_client:
+        return True
+    ttl = max(HOUSEKEEPING_INTERVAL * 2, 60)
+    try:
+        if redis_client.set(HOUSEKEEPING_LOCK_KEY, HOUSEKEEPING_LOCK_TOKEN, nx=True, ex=ttl):
+            return True
+        if redis_client.get(HOUSEKEEPING_LOCK_KEY) == HOUSEKEEPING_LOCK_TOKEN:
+            redis_client.expire(HOUSEKEEPING_LOCK_KEY, ttl)
+            return True
+    except Exception as e:
+        print(f"获取清理锁失败: {e}")
+    return False
+
+housekeeper = Housekeeper(OUTPUT_FOLDER, quota_bytes=OUTPUT_QUOTA_BYTES, max_age_days=OUTPUT_MAX_AGE_DAYS,
+                          is_protected=is_output_protected, active_names=active_output_names,
+                          on_evict=on_output_evicted, should_run=acquire_housekeeping_lock)
+gauge("output_bytes", "使用索引统计的输出目录大小", callback=lambda: housekeeper.index.total_bytes())
+
+def claim_task_outputs(task_id, spec):
+    """
+    在使用索引里登记任务将要写入的书籍目录和 CBZ，任务结束前清理线程不会删除它们。
+    在下载线程里调用：读取书名只需读任务文件开头或解析缓存的第一行，也不占用上传请求的时间。
+    """
+    try:
+        title = open_task_file(spec['task_path']).title
+    except Exception as e:
+        print(f"读取任务文件标题失败 {task_id}: {e}")
+        return
+    names = book_artifact_names(title)
+    housekeeper.index.claim(names, task_id)
+    if redis_client:
+        try:
+            redis_client.hset(OUTPUT_OWNERS_KEY, mapping={name: task_id for name in names})
+        except Exception as e:
+            print(f"登记输出目录所属任务失败 {task_id}: {e}")
+
+@app.before_request
+def start_housekeeper():
+    # gunicorn 等服务器不执行 __main__，每个 Web 进程在第一个请求时启动清理线程，由 Redis 锁决定谁来清理
+    housekeeper.start()
 
 @app.route('/')
 def index():
@@ -127,15 +819,36 @@ def upload_file():
     file = request.files.get('taskfile')
     if not file: return jsonify({'error': '未选择任务文件'}), 400
     if not (file.filename.lower().endswith('.json') or file.filename.lower().endswith('.txt')): return jsonify({'error': '请上传 .json 或 .txt 任务文件'}), 400
-    save_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-    file.save(save_path)
+    # 按内容哈希保存，同名的不同文件不会互相覆盖
+    save_path, digest = store_upload(file.stream, app.config['UPLOAD_FOLDER'], file.filename)
+    filename = os.path.basename(save_path)
 
     cookie = request.form.get('cookie', '')
     custom_referer = request.form.get('custom_referer', '').strip()
     proxy_list_text = request.form.get('proxy_list', '').strip()
     pack_after_download = request.form.get('pack_after_download', 'true') == 'true'
     delete_after_pack = request.form.get('delete_after_pack', 'false') == 'true'
+    stream_download = request.form.get('stream_download', 'false') == 'true'
+    resume_download = request.form.get('resume_download', 'false') == 'true'
+    profile = request.form.get('profile', 'false') == 'true'
+    priority = clamp_priority(request.form.get('priority', DEFAULT_PRIORITY))
+    engine = request.form.get('engine', 'thread')
+    if engine not in DOWNLOAD_ENGINES: return jsonify({'error': f'未知的下载引擎: {engine}'}), 400
+    if engine == 'distributed' and not redis_client: return jsonify({'error': '分布式引擎需要 Redis'}), 400
+    pack_mode = request.form.get('pack_mode', 'after')
+    if pack_mode not in PACK_MODES: return jsonify({'error': f'未知的打包模式: {pack_mode}'}), 400
+    try:
+        postprocess = normalize_postprocess_options(request.form.get('transcode_format'), request.form.get('max_width'),
+                                                    request.form.get('transcode_quality'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if postprocess:
+        reason = check_postprocess_support(postprocess['format'])
+        if reason: return jsonify({'error': reason}), 400
+    upload_remote = request.form.get('upload_remote', '').strip() or None
     thread_count = int(request.form.get('thread_count', 4))
+    pool_size = int(request.form.get('pool_size') or thread_count)
+    max_concurrency = int(request.form.get('max_concurrency') or thread_count * 2)
     aes_key = request.form.get('aes_key', None)
     aes_iv = request.form.get('aes_iv', None)
 
@@ -144,167 +857,305 @@ def upload_file():
     proxy_list = parse_proxy_list(proxy_list_text) if proxy_list_text else []
 
     task_id = str(uuid.uuid4())
+    spec = {
+        'task_path': save_path, 'task_digest': digest, 'headers': headers, 'custom_referer': custom_referer,
+        'proxy_list': proxy_list, 'pack_after_download': pack_after_download,
+        'delete_after_pack': delete_after_pack, 'stream_download': stream_download,
+        'resume_download': resume_download, 'max_concurrency': max_concurrency, 'engine': engine, 'pack_mode': pack_mode, 'priority': priority, 'profile': profile, 'postprocess': postprocess, 'upload_remote': upload_remote, 'thread_count': thread_count, 'pool_size': pool_size, 'aes_key': aes_key, 'aes_iv': aes_iv
+    }
     initial_status = {
-        'task_type': 'download', 'status': '等待执行', 'progress_percent': 0,
-        'progress_current': 0, 'progress_total': 0, 'logs': [], 'result': None,
+        'task_type': 'download', 'status': '等待执行', 'created_at': time.time(), 'progress_percent': 0,
+        'progress_current': 0, 'progress_total': 0, 'result': None,
         'config': {
-            'filename': file.filename, 'pack_after_download': pack_after_download,
-            'delete_after_pack': delete_after_pack, 'thread_count': thread_count
+            'filename': filename, 'pack_after_download': pack_after_download,
+            'delete_after_pack': delete_after_pack, 'thread_count': thread_count,
+            'pool_size': pool_size, 'stream_download': stream_download,
+            'resume_download': resume_download, 'max_concurrency': max_concurrency, 'engine': engine,
+            'pack_mode': pack_mode, 'priority': priority, 'profile': profile, 'postprocess': postprocess,
+            'upload_remote': upload_remote
         }
     }
+    spec['coalesce_key'] = task_coalesce_key(digest, filename, spec)
+    # 先取得租约再登记任务文件，其他进程据此判断登记是否仍然有效
+    claim_task_lease(task_id)
+    existing = claim_task_file(spec['coalesce_key'], task_id)
+    if existing:
+        release_task_lease(task_id)
+        update_task(existing, log=f"🔗 收到相同的任务文件 {filename}，已合并到本任务")
+        return jsonify({'status': 'ok', 'task_id': existing, 'coalesced': True})
+    save_task_spec(task_id, spec)
     save_task_status(task_id, initial_status)
-
-    download_controller = DownloadController()
-    download_controllers[task_id] = download_controller
-
-    def download_progress_callback(current, total, msg):
-        task_data = load_task_status(task_id)
-        if not task_data: return
-        task_data['progress_current'] = current
-        task_data['progress_total'] = total
-        task_data['progress_percent'] = (current / total * 100) if total > 0 else 0
-        task_data['logs'].append(msg)
-        if len(task_data['logs']) > 100:
-            task_data['logs'] = task_data['logs'][-50:]
-        save_task_status(task_id, task_data)
-
-    def download_task_wrapper():
-        task_data = load_task_status(task_id)
-        if not task_data: return
-        task_data['status'] = '执行中'
-        save_task_status(task_id, task_data) 
-        try:
-            result = process_task_file_with_progress(
-                save_path, app.config['OUTPUT_FOLDER'], headers, 
-                download_progress_callback, proxy_list, pack_after_download, 
-                delete_after_pack, aes_key, aes_iv, max_workers=thread_count,
-                download_controller=download_controller, custom_referer=custom_referer,
-                redis_client=redis_client
-            )
-            task_data = load_task_status(task_id)
-            if task_data:
-                task_data['status'] = '完成'
-                task_data['result'] = result
-                task_data['progress_percent'] = 100
-                if task_data['progress_total'] > 0:
-                    task_data['progress_current'] = task_data['progress_total']
-                save_task_status(task_id, task_data)
-        except Exception as e:
-            task_data = load_task_status(task_id)
-            if task_data:
-                current_status = task_data.get('status', '')
-                if current_status not in ['暂停中', '中断']:
-                    task_data['status'] = '失败'
-                task_data['logs'].append(f"❌ 任务执行失败: {e}")
-                task_data['result'] = {'error': str(e)}
-                save_task_status(task_id, task_data)
-        finally:
-            if task_id in download_controllers:
-                del download_controllers[task_id]
-
-    executor.submit(download_task_wrapper)
+    start_download_task(task_id, spec, initial_status)
     return jsonify({'status': 'ok', 'task_id': task_id})
 
 @app.route('/pause/<task_id>', methods=['POST'])
 def pause_task(task_id):
-    ctrl = download_controllers.get(task_id)
+    ctrl = find_download_controller(task_id)
     if ctrl:
         ctrl.pause()
-        task_data = load_task_status(task_id)
-        if task_data:
-            task_data['status'] = '暂停中'
-            task_data['logs'].append("⏸️ 用户暂停了任务")
-            save_task_status(task_id, task_data)
+        update_task(task_id, status='暂停中', log="⏸️ 用户暂停了任务，正在释放下载槽位")
         return jsonify({'status': 'paused'})
     return jsonify({'error': '任务不存在或已结束'}), 404
 
 @app.route('/resume/<task_id>', methods=['POST'])
 def resume_task(task_id):
-    ctrl = download_controllers.get(task_id)
+    ctrl = find_download_controller(task_id)
     if ctrl:
         ctrl.resume()
-        task_data = load_task_status(task_id)
-        if task_data:
-            task_data['status'] = '执行中'
-            task_data['logs'].append("▶️ 用户恢复了任务")
-            save_task_status(task_id, task_data)
+        update_task(task_id, status='执行中', log="▶️ 用户恢复了任务")
         return jsonify({'status': 'resumed'})
+    # 没有运行中的控制器：尝试从持久化的任务规格重新开始（例如服务器重启后被中断的任务）
+    error = restart_download_task(task_id)
+    if error:
+        return jsonify({'error': error}), 404
+    return jsonify({'status': 'restarted'})
+
+@app.route('/stop/<task_id>', methods=['POST'])
+def stop_task(task_id):
+    ctrl = find_download_controller(task_id)
+    if ctrl:
+        ctrl.stop()
+        update_task(task_id, status='中断', log="⏹️ 用户终止了任务，可点击继续从断点恢复")
+        return jsonify({'status': 'stopped'})
     return jsonify({'error': '任务不存在或已结束'}), 404
 
+@app.route('/queue')
+def get_queue():
+    snapshot = job_queue.snapshot()
+    for entry in snapshot['running'] + snapshot['queued']:
+        live = live_tasks.get(entry['task_id'])
+        if live:
+            entry['filename'] = live.data.get('config', {}).get('filename')
+            entry['status'] = live.data.get('status')
+    snapshot['slots'] = slot_scheduler.stats()
+    return jsonify(snapshot)
+
+@app.route('/housekeeping')
+def get_housekeeping():
+    # 使用索引的总大小、条目数、配额，以及本进程最近一次清理的结果（由其他进程清理时为空）
+    return jsonify(housekeeper.stats())
+
+@app.route('/queue/<task_id>', methods=['POST'])
+def reorder_queue(task_id):
+    """调整任务优先级（priority）或排队位置（position，0 为队首）。"""
+    priority = request.form.get('priority')
+    position = request.form.get('position')
+    try:
+        position = int(position) if position not in (None, '') else None
+    except ValueError:
+        return jsonify({'error': '参数错误'}), 400
+    found = False
+    if priority not in (None, ''):
+        priority = clamp_priority(priority)
+        found = job_queue.set_priority(task_id, priority)
+        slot_scheduler.set_priority(task_id, priority)
+        spec = load_task_spec(task_id)
+        if spec:
+            spec['priority'] = priority
+            save_task_spec(task_id, spec)
+    if position is not None:
+        # 正在运行的任务只能调整优先级，移动位置失败时不能覆盖前面的结果
+        found = job_queue.move(task_id, position) or found
+    if not found:
+        return jsonify({'error': '任务不在队列中'}), 404
+    return jsonify(job_queue.snapshot())
+
+@app.route('/metrics')
+def export_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/profile/<task_id>')
+def get_task_profile(task_id):
+    """查看任务的 cProfile 结果：默认返回按累计耗时排序的文本，?raw=1 下载原始 .prof 文件（可用 snakeviz 等工具打开）。"""
+    path = get_task_profile_path(task_id)
+    if not os.path.exists(path):
+        return jsonify({'error': '该任务没有性能分析结果'}), 404
+    if request.args.get('raw'):
+        return send_from_directory(PROFILE_FOLDER, os.path.basename(path), as_attachment=True)
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'calls'):
+        return jsonify({'error': f'未知的排序方式: {sort}'}), 400
+    return Response(profile_summary(path, sort=sort, limit=request.args.get('limit', 40, type=int)),
+                    mimetype='text/plain; charset=utf-8')
+
 @app.route('/status/<task_id>')
 def get_status(task_id):
-    status = load_task_status(task_id)
+    status = get_task_snapshot(task_id, log_limit=10)
     if not status: return jsonify({'error': '任务不存在'}), 404
     if 'logs' in status and len(status['logs']) > 10:
         status['logs'] = status['logs'][-10:]
     return jsonify(status)
 
+@app.route('/events/<task_id>')
+def task_events(task_id):
+    return Response(stream_with_context(task_event_stream(task_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/download/<path:filename>')
 def download_file(filename):
+    housekeeper.index.touch(filename.split('/')[0])
     return send_from_directory(app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
 
+def attachment_disposition(filename):
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename=\"export.cbz\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+def range_requested(export):
+    """If-Range 与当前导出不一致时忽略 Range，返回完整内容。"""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == export.etag
+    if if_range.date is not None:
+        return int(export.last_modified) <= if_range.date.timestamp()
+    return True
+
+def export_response(export, filename):
+    headers = {'Accept-Ranges': 'bytes', 'ETag': f'"{export.etag}"', 'Last-Modified': http_date(export.last_modified),
+               'Content-Disposition': attachment_disposition(filename)}
+    if request.if_none_match.contains(export.etag):
+        return Response(status=304, headers=headers)
+    byte_range = request.range if request.range and range_requested(export) else None
+    start, stop, status = 0, export.length, 200
+    if byte_range and byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+        span = byte_range.range_for_length(export.length)
+        if span is None:
+            headers['Content-Range'] = f"bytes */{export.length}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        status = 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{export.length}"
+    # 多段 Range 不支持，按规范返回完整内容
+    headers['Content-Length'] = str(stop - start)
+    return Response(export.iter_range(start, stop), status=status, headers=headers, mimetype=CBZ_MIMETYPE,
+                    direct_passthrough=True)
+
+def find_book_author(book):
+    """
+    导出时写入 ComicInfo 的作者：从最后写入该书籍目录的任务规格找到任务文件，
+    读取开头的元数据（通常直接命中解析缓存）。任务规格已过期或任务文件已删除时返回 None。
+    """
+    owner = housekeeper.index.owner(book)
+    if not owner and redis_client:
+        try:
+            owner = redis_client.hget(OUTPUT_OWNERS_KEY, book)
+        except Exception as e:
+            print(f"读取输出目录所属任务失败 {book}: {e}")
+    spec = load_task_spec(owner) if owner else None
+    if not spec:
+        return None
+    try:
+        return open_task_file(spec['task_path']).author
+    except Exception as e:
+        print(f"读取任务文件作者失败 {owner}: {e}")
+        return None
+
+@app.route('/export/<book>')
+def export_book(book):
+    """
+    把书籍目录即时导出为 CBZ，?chapter=章节名 可重复指定只导出其中几章，支持 Range 断点续传。
+    不指定章节且已有打包好的 CBZ 时直接发送该文件。
+    """
+    output_folder = app.config['OUTPUT_FOLDER']
+    chapters = request.args.getlist('chapter')
+    book_dir = safe_join(output_folder, book)
+    if not book_dir or book.startswith('.'):
+        return jsonify({'error': '书籍不存在'}), 404
+    if not chapters and os.path.isfile(f"{book_dir}.cbz"):
+        housekeeper.index.touch(f"{book}.cbz")
+        return send_from_directory(output_folder, f"{book}.cbz", as_attachment=True, mimetype=CBZ_MIMETYPE)
+    if not os.path.isdir(book_dir):
+        return jsonify({'error': '书籍不存在'}), 404
+    if book in active_output_names():
+        return jsonify({'error': '书籍仍在下载中，完成后再导出'}), 409
+    if any(not safe_join(book_dir, c) or '/' in c or c.startswith('.') for c in chapters):
+        return jsonify({'error': '章节名无效'}), 400
+    try:
+        export = ZipExport(book_dir, book, chapters, author=find_book_author(book))
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    housekeeper.index.touch(book)
+    filename = f"{book} - {chapters[0]}.cbz" if len(chapters) == 1 else f"{book}.cbz"
+    return export_response(export, filename)
+
+@app.route('/export/<book>/chapters')
+def export_book_chapters(book):
+    book_dir = safe_join(app.config['OUTPUT_FOLDER'], book)
+    if not book_dir or book.startswith('.') or not os.path.isdir(book_dir):
+        return jsonify({'error': '书籍不存在'}), 404
+    return jsonify({'book': book, 'chapters': list_chapters(book_dir)})
+
 @app.route('/tasks')
 def list_tasks():
-    task_ids = load_all_task_ids()
-    all_tasks = []
-    for task_id in task_ids:
-        t = load_task_status(task_id)
-        if t:
-            all_tasks.append({
-                'task_id': task_id, 'status': t.get('status', '未知'),
-                'filename': t.get('config', {}).get('filename', ''),
-                'progress_percent': t.get('progress_percent', 0),
-                'result': t.get('result', None)
-            })
-    all_tasks.sort(key=lambda x: x.get('filename', ''), reverse=True)
-    return jsonify(all_tasks)
+    maybe_prune_expired_tasks()
+    try:
+        limit = min(max(int(request.args.get('limit', TASK_LIST_DEFAULT_LIMIT)), 1), TASK_LIST_MAX_LIMIT)
+        cursor = request.args.get('cursor')
+        cursor = parse_task_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': '参数错误'}), 400
+    statuses = [x for x in request.args.get('status', '').split(',') if x]
+    ascending = request.args.get('order', 'desc') == 'asc'
+    tasks, next_cursor = list_task_summaries(limit, cursor, statuses, ascending)
+    return jsonify({'tasks': tasks, 'next_cursor': next_cursor})
 
-@app.route('/rclone_upload', methods=['POST'])
-def rclone_upload():
-    filename = request.form.get('filename')
-    remote_path = request.form.get('remote_path')
-    if not filename or not remote_path: return jsonify({'error': '参数缺失'}), 400
+def start_rclone_upload(filename, remote_path, source_task_id=None):
+    """创建一个 rclone 上传任务并放进上传执行器，返回任务 ID。"""
     local_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-    if not os.path.exists(local_path): return jsonify({'error': '文件不存在'}), 404
-
     task_id = str(uuid.uuid4())
     initial_status = {
-        'task_type': 'rclone_upload', 'status': '等待执行', 'logs': [], 'result': None,
-        'config': {'filename': filename, 'remote_path': remote_path}
+        'task_type': 'rclone_upload', 'status': '等待执行', 'created_at': time.time(), 'result': None,
+        'progress_percent': 0,
+        'config': {'filename': filename, 'remote_path': remote_path, 'source_task_id': source_task_id}
     }
     save_task_status(task_id, initial_status)
+    live = LiveTaskState(task_id, initial_status)
+    live_tasks[task_id] = live
+
+    def on_stats(summary):
+        live.update(upload=summary, progress_percent=summary['percent'],
+                    progress_current=summary['bytes'], progress_total=summary['total_bytes'])
+
+    def on_message(level, msg):
+        live.log(f"❌ {msg}" if level in ('error', 'critical') else msg)
 
     def rclone_upload_task():
-        task_data = load_task_status(task_id)
-        task_data['status'] = '执行中'
-        save_task_status(task_id, task_data)
+        live.update(status='执行中')
         try:
-            cmd = ["rclone", "copy", local_path, remote_path, "--progress", "--stats=1s"]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            for line in process.stdout:
-                task_data = load_task_status(task_id)
-                if not task_data: break
-                task_data['logs'].append(line.strip())
-                save_task_status(task_id, task_data)
-            process.wait()
-            task_data = load_task_status(task_id)
-            if task_data:
-                if process.returncode == 0:
-                    task_data['status'] = '完成'
-                    task_data['result'] = {'msg': '上传成功'}
-                else:
-                    task_data['status'] = '失败'
-                    task_data['result'] = {'msg': '上传失败'}
-                save_task_status(task_id, task_data)
+            returncode = run_rclone(local_path, remote_path, on_stats, on_message)
+            summary = live.data.get('upload')
+            if summary:
+                live.log(format_upload_stats(summary))
+            if returncode == 0:
+                live.update(status='完成', result={'msg': '上传成功'}, progress_percent=100)
+            else:
+                live.update(status='失败', result={'msg': f'上传失败，rclone 退出码 {returncode}'})
         except Exception as e:
-            task_data = load_task_status(task_id)
-            if task_data:
-                task_data['status'] = '失败'
-                task_data['logs'].append(f"❌ 上传失败: {e}")
-                task_data['result'] = {'error': str(e)}
-                save_task_status(task_id, task_data)
-    executor.submit(rclone_upload_task)
-    return jsonify({'status': 'ok', 'task_id': task_id})
+            live.update(status='失败', result={'error': str(e)}, log=f"❌ 上传失败: {e}")
+        finally:
+            live_tasks.pop(task_id, None)
+            live.close()
+    upload_manager.submit(task_id, local_path, rclone_upload_task)
+    return task_id
+
+def start_auto_upload(remote_path, result, live):
+    archive = result[0].get('zip') if isinstance(result, list) and result else None
+    if not archive or not os.path.isfile(os.path.join(app.config['OUTPUT_FOLDER'], archive)):
+        live.log("⚠️ 没有打包出 CBZ 文件，跳过自动上传")
+        return None
+    upload_task_id = start_rclone_upload(archive, remote_path, source_task_id=live.task_id)
+    live.log(f"☁️ 已自动开始上传 {archive} 到 {remote_path}，上传任务 {upload_task_id}")
+    return upload_task_id
+
+@app.route('/rclone_upload', methods=['POST'])
+def rclone_upload():
+    filename = request.form.get('filename')
+    remote_path = request.form.get('remote_path')
+    if not filename or not remote_path: return jsonify({'error': '参数缺失'}), 400
+    if not os.path.exists(os.path.join(app.config['OUTPUT_FOLDER'], filename)): return jsonify({'error': '文件不存在'}), 404
+    return jsonify({'status': 'ok', 'task_id': start_rclone_upload(filename, remote_path)})
 
 @app.route('/rclone_status/<task_id>')
 def rclone_status(task_id):
@@ -312,7 +1163,8 @@ def rclone_status(task_id):
 
 if __name__ == '__main__':
     check_interrupted_tasks()
-    auto_cleanup(app.config['OUTPUT_FOLDER'])
+    # 后台定期按保留天数和配额清理输出目录
+    housekeeper.start()
     # For production, use a WSGI server like Gunicorn instead of app.run()
     # Example: gunicorn --workers 4 --bind 0.0.0.0:5000 app:app
     app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
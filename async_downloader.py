@@ -0,0 +1,417 @@
+# --- START OF FILE async_downloader.py ---
+
+import os
+import json
+import time
+import atexit
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+from downloader import (
+    STREAM_CHUNK_SIZE, CONTENT_RANGE_RE, STATUS_REPORT_INTERVAL, THROTTLE_STATUS_CODES, AdaptiveScheduler,
+    AESStreamDecryptor, DownloadHTTPError, DownloadedUrlBuffer, CompletionManifest, ProxyPool, proxy_at_fault,
+    parse_aes_key_iv, parse_retry_after, backoff_delay,
+    open_task_file, SUBMIT_AHEAD_FACTOR, image_filename, build_image_headers,
+    open_book_packer, iter_pending_batches, pack_existing_images, raise_if_interrupted, abort_book,
+    finish_book_packing,
+    find_existing_image, deliver_image, close_postprocessor,
+    _write_chunks, _iter_file, _remove_files, _range_validator
+)
+from blob_store import BlobStore, BLOB_DIR_NAME
+from postprocess import open_postprocessor
+from metrics import (
+    IMAGES, BYTES, REQUEST_SECONDS, HTTP_RETRIES, RETRY_ROUND_IMAGES, QUEUED_IMAGES, ACTIVE_DOWNLOADS, phase
+)
+
+# 所有异步任务共享的在途请求上限
+ASYNC_GLOBAL_CONCURRENCY = 1024
+ASYNC_SOCK_TIMEOUT = 20
+
+_engine_loop = None
+_engine_lock = threading.Lock()
+_engine_state = {}
+
+def get_engine_loop():
+    """
+    异步引擎只有一个后台事件循环，所有任务的请求都在这里复用连接，
+    并受同一个全局信号量限制。
+    """
+    global _engine_loop
+    with _engine_lock:
+        if _engine_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name="async-download-engine").start()
+            _engine_loop = loop
+    return _engine_loop
+
+def _get_session():
+    # 只在事件循环线程里调用，不需要加锁
+    session = _engine_state.get('session')
+    if session is None or session.closed:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=ASYNC_GLOBAL_CONCURRENCY, limit_per_host=0, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=ASYNC_SOCK_TIMEOUT, sock_read=ASYNC_SOCK_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _engine_state['session'] = session
+        _engine_state['semaphore'] = asyncio.Semaphore(ASYNC_GLOBAL_CONCURRENCY)
+        _engine_state['in_flight'] = 0
+    return session
+
+def shutdown_engine():
+    """进程退出时关闭共享的 aiohttp 会话。"""
+    session = _engine_state.get('session')
+    if _engine_loop is None or session is None or session.closed:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(session.close(), _engine_loop).result(timeout=5)
+    except Exception:
+        pass
+
+atexit.register(shutdown_engine)
+
+def _raise_for_status(r):
+    raise DownloadHTTPError(r.status, parse_retry_after(r.headers.get("Retry-After")))
+
+def _write_chunk(f, chunk, decryptor=None, final=False):
+    if decryptor:
+        with phase("decrypt"):
+            chunk = decryptor.finish() if final else decryptor.update(chunk)
+    with phase("write"):
+        f.write(chunk)
+
+async def _fetch_stream(session, url, save_path, headers, proxy, key, iv, chunk_size):
+    async with session.get(url, headers=headers, proxy=proxy) as r:
+        if r.status != 200:
+            _raise_for_status(r)
+        tmp_path = save_path + ".tmp"
+        decryptor = AESStreamDecryptor(key, iv) if key and iv else None
+        try:
+            with open(tmp_path, "wb") as f:
+                # 解密和写盘都放到线程里，事件循环只负责收数据
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    await asyncio.to_thread(_write_chunk, f, chunk, decryptor)
+                if decryptor:
+                    await asyncio.to_thread(_write_chunk, f, b"", decryptor, True)
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            _remove_files(tmp_path)
+            raise
+
+async def _fetch_resumable(session, url, save_path, headers, proxy, key, iv, chunk_size):
+    """与 downloader._download_resumable 相同的 .part + Range 续传逻辑。"""
+    part_path = save_path + ".part"
+    meta_path = part_path + ".json"
+    offset = 0
+    validator = None
+    if os.path.exists(part_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                validator = json.load(f).get("validator")
+            offset = os.path.getsize(part_path)
+        except Exception:
+            offset = 0
+    req_headers = dict(headers)
+    req_headers["Accept-Encoding"] = "identity"
+    if offset and validator:
+        req_headers["Range"] = f"bytes={offset}-"
+        req_headers["If-Range"] = validator
+    async with session.get(url, headers=req_headers, proxy=proxy) as r:
+        if r.status == 206 and "Range" in req_headers:
+            m = CONTENT_RANGE_RE.match(r.headers.get("Content-Range", ""))
+            if not m or int(m.group(1)) != offset:
+                _remove_files(part_path, meta_path)
+                raise ValueError("Content-Range 与本地已下载长度不一致")
+            mode = "ab"
+        elif r.status == 200:
+            mode = "wb"
+            validator = _range_validator(r)
+            if validator and r.headers.get("Accept-Ranges", "").lower() != "none":
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"url": url, "validator": validator}, f)
+            else:
+                _remove_files(meta_path)
+        else:
+            if r.status == 416:
+                _remove_files(part_path, meta_path)
+            _raise_for_status(r)
+        with open(part_path, mode) as f:
+            async for chunk in r.content.iter_chunked(chunk_size):
+                await asyncio.to_thread(_write_chunk, f, chunk)
+    if key and iv:
+        # 整个文件解密是 CPU 密集操作，放到线程里避免卡住事件循环
+        await asyncio.to_thread(_write_chunks, _iter_file(part_path, chunk_size), save_path, key, iv)
+        _remove_files(part_path)
+    else:
+        os.replace(part_path, save_path)
+    _remove_files(meta_path)
+
+def _proxy_network_errors():
+    import aiohttp
+    return (aiohttp.ClientError, asyncio.TimeoutError)
+
+async def download_image_async(session, url, save_path, headers, proxy=None, retry=3, key=None, iv=None,
+                               resume=False, chunk_size=STREAM_CHUNK_SIZE, scheduler=None, slots=None,
+                               proxy_pool=None):
+    """
+    传入 proxy_pool 时每次尝试重新选择代理。共享连接器按 (主机, 代理) 区分连接，
+    每个代理自然拥有各自复用的连接。scheduler 与线程引擎相同，按主机调节并发、遵守 Retry-After。
+    """
+    semaphore = _engine_state['semaphore']
+    limiter = scheduler.host(url) if scheduler else None
+    host = urlsplit(url).netloc
+    last_error = None
+    for i in range(retry):
+        if limiter:
+            await limiter.acquire_async()
+        ok = False
+        error = None
+        retry_after = None
+        throttled = False
+        start = time.time()
+        try:
+            # 全局槽位在主机限流之后获取，等待主机放行时不占用其他任务的份额
+            if slots:
+                await slots.acquire_async()
+            try:
+                async with semaphore:
+                    if proxy_pool:
+                        proxy = proxy_pool.choose(exclude=proxy)
+                    _engine_state['in_flight'] += 1
+                    ACTIVE_DOWNLOADS.inc()
+                    start = time.time()
+                    try:
+                        # 协程在等待网络时会切换，download 阶段记的是单张图片的墙钟时间
+                        with phase("download"):
+                            if resume:
+                                await _fetch_resumable(session, url, save_path, headers, proxy, key, iv, chunk_size)
+                            else:
+                                await _fetch_stream(session, url, save_path, headers, proxy, key, iv, chunk_size)
+                        ok = True
+                    except Exception as e:
+                        error = e
+                        raise
+                    finally:
+                        elapsed = time.time() - start
+                        _engine_state['in_flight'] -= 1
+                        ACTIVE_DOWNLOADS.dec()
+                        REQUEST_SECONDS.observe(elapsed, host=host)
+                        if proxy_pool:
+                            fault = not ok and proxy_at_fault(error, _proxy_network_errors())
+                            proxy_pool.report(proxy, not fault, elapsed if ok else None)
+            finally:
+                if slots:
+                    slots.release()
+            BYTES.inc(os.path.getsize(save_path))
+            return True
+        except DownloadHTTPError as e:
+            last_error = e
+            retry_after = e.retry_after
+            throttled = e.status_code in THROTTLE_STATUS_CODES
+        except Exception as e:
+            last_error = e
+        finally:
+            if limiter:
+                limiter.release(ok, time.time() - start, throttled, retry_after)
+        if i < retry - 1:
+            HTTP_RETRIES.inc(host=host)
+            await asyncio.sleep(backoff_delay(i, retry_after))
+    if last_error:
+        raise last_error
+    # retry <= 0 时一次都没有尝试，与旧版一样返回 False
+    return False
+
+def process_task_file_async(
+    task_path, output_folder, headers, progress_callback, proxy_list=None,
+    pack_after_download=True, delete_after_pack=False, aes_key=None, aes_iv=None,
+    max_workers=4, download_controller=None, custom_referer=None,
+    redis_client=None, pool_size=None, stream_download=False, manifest_key=None,
+    resume_download=False, max_concurrency=None, status_callback=None, pack_mode='after',
+    download_slots=None, profiler=None, postprocess=None
+):
+    """
+    与 process_task_file_with_progress 接口相同的异步引擎：下载在共享事件循环上进行，
+    每个任务最多 max_concurrency 个在途请求，所有任务合计不超过 ASYNC_GLOBAL_CONCURRENCY。
+    始终流式写盘，因此 stream_download 和 pool_size 在这里没有作用。
+    """
+    task_file = open_task_file(task_path)
+    title, author, global_referer = task_file.title, task_file.author, task_file.global_referer
+    book_dir = os.path.join(output_folder, title)
+    total = [0]
+    progress_callback(0, 0, "开始下载（异步引擎），边解析任务文件边下载")
+    packer, direct, work_dir = open_book_packer(output_folder, title, author, book_dir, pack_after_download, pack_mode)
+    postprocessor = open_postprocessor(postprocess, packer, direct, progress_callback)
+    concurrency = max(max_concurrency or max_workers, max_workers)
+    key, iv = parse_aes_key_iv(aes_key, aes_iv)
+    finished = [0]
+    failed = []
+    last_status_report = [0]
+
+    # aiohttp 只支持 HTTP 代理
+    proxies = [p for p in (proxy_list or []) if p.lower().startswith(("http://", "https://"))]
+    if proxy_list and len(proxies) < len(proxy_list):
+        progress_callback(0, 0, f"异步引擎不支持 SOCKS 代理，已忽略{len(proxy_list) - len(proxies)}个")
+
+    proxy_pool = ProxyPool(proxies) if proxies else None
+    # 与线程引擎相同：max_workers 是每个主机的初始并发，按延迟和错误率在 [1, concurrency] 之间调节
+    scheduler = AdaptiveScheduler(max_workers, concurrency)
+
+    downloaded_buffer = DownloadedUrlBuffer(redis_client)
+    blob_store = BlobStore(os.path.join(output_folder, BLOB_DIR_NAME))
+    manifest = CompletionManifest(redis_client, manifest_key)
+
+    def report_status(force=False):
+        if not status_callback:
+            return
+        now = time.time()
+        if not force and now - last_status_report[0] < STATUS_REPORT_INTERVAL:
+            return
+        last_status_report[0] = now
+        fields = {'engine': {'type': 'async', 'in_flight': _engine_state.get('in_flight', 0),
+                             'task_concurrency': concurrency, 'global_limit': ASYNC_GLOBAL_CONCURRENCY},
+                  'hosts': scheduler.stats()}
+        if proxy_pool:
+            fields['proxies'] = proxy_pool.stats()
+        if postprocessor:
+            fields['postprocess'] = postprocessor.summary()
+        status_callback(fields)
+
+    def prepare(idx, url, chapter_title):
+        if download_controller:
+            download_controller.check()
+        chapter_dir = os.path.join(work_dir, chapter_title)
+        os.makedirs(chapter_dir, exist_ok=True)
+        save_path = os.path.join(chapter_dir, image_filename(idx, url))
+        return (save_path,) + find_existing_image(save_path, postprocessor)
+
+    def record(idx, url, save_path, path, arcname, original=True):
+        # 入库要读整个文件，后处理队列满时 submit 会阻塞，写 Redis 要等往返，都在线程里一次做完
+        digest = blob_store.try_ingest(save_path) if original else None
+        deliver_image(path, arcname, packer, postprocessor, direct, original)
+        if original:
+            downloaded_buffer.add(url, digest)
+        manifest.add(idx)
+
+    async def download_one(session, idx, url, headers_img, chapter_title):
+        # 控制状态可能要查 Redis，建目录和查找已有文件也是阻塞调用
+        save_path, existing, original = await asyncio.to_thread(prepare, idx, url, chapter_title)
+        filename = os.path.basename(save_path)
+        try:
+            # 已存在的文件入库或写 Redis 出错时与下载失败一样只记这一张失败，不中止整个任务
+            if existing:
+                await asyncio.to_thread(record, idx, url, save_path, existing,
+                                        f"{chapter_title}/{os.path.basename(existing)}", original)
+                finished[0] += 1
+                progress_callback(finished[0], total[0], f"本地文件已存在，跳过: {chapter_title}/{filename}")
+                IMAGES.inc(engine='async', result='existing')
+                return
+            h = build_image_headers(headers, headers_img, global_referer, custom_referer)
+            await download_image_async(session, url, save_path, h, key=key, iv=iv, resume=resume_download,
+                                       scheduler=scheduler, slots=download_slots, proxy_pool=proxy_pool)
+            await asyncio.to_thread(record, idx, url, save_path, save_path, f"{chapter_title}/{filename}")
+            finished[0] += 1
+            progress_callback(finished[0], total[0], f"下载成功: {chapter_title}/{filename}")
+            IMAGES.inc(engine='async', result='downloaded')
+        except Exception as e:
+            finished[0] += 1
+            failed.append((idx, url, headers_img, chapter_title))
+            progress_callback(finished[0], total[0], f"下载失败: {chapter_title}/{filename} {e}")
+            IMAGES.inc(engine='async', result='failed')
+        report_status()
+
+    async def run_pass(session, queue):
+        errors = []
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                QUEUED_IMAGES.dec(engine='async')
+                try:
+                    await download_one(session, *item)
+                except Exception as e:
+                    # 任务被暂停或终止时继续把队列取完，避免解析线程卡在 put 上
+                    errors.append(e)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        if errors:
+            raise errors[0]
+
+    async def feed(queue, pending, skipped):
+        finished[0] += len(skipped)
+        if skipped:
+            progress_callback(finished[0], total[0], f"已下载过，跳过{len(skipped)}张")
+            IMAGES.inc(len(skipped), engine='async', result='skipped')
+        for item in pending:
+            await queue.put(item)
+            QUEUED_IMAGES.inc(engine='async')
+
+    async def close_queue(queue):
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def open_session():
+        return _get_session()
+
+    async def set_profiling(enabled):
+        # 事件循环由所有异步任务共享，采样结果也包含同时运行的其他异步任务
+        if enabled:
+            profiler.enable_current()
+        else:
+            profiler.disable_current()
+
+    def run_in_engine(batches):
+        # 解析在调用线程进行，每批图片一次跨线程提交；队列有上限，解析不会远远领先下载
+        loop = get_engine_loop()
+        session = asyncio.run_coroutine_threadsafe(open_session(), loop).result()
+        if profiler:
+            asyncio.run_coroutine_threadsafe(set_profiling(True), loop).result()
+        try:
+            queue = asyncio.Queue(maxsize=concurrency * SUBMIT_AHEAD_FACTOR)
+            done = asyncio.run_coroutine_threadsafe(run_pass(session, queue), loop)
+            try:
+                for pending, skipped in batches:
+                    if (packer or postprocessor) and skipped:
+                        pack_existing_images(packer, work_dir, skipped, direct, postprocessor)
+                    asyncio.run_coroutine_threadsafe(feed(queue, pending, skipped), loop).result()
+            finally:
+                asyncio.run_coroutine_threadsafe(close_queue(queue), loop).result()
+                done.result()
+        except BaseException:
+            # 暂停、终止或其他错误时同时停掉后处理进程池，不留下仍在运行的工作进程
+            abort_book(packer, postprocessor)
+            raise
+        finally:
+            if profiler:
+                asyncio.run_coroutine_threadsafe(set_profiling(False), loop).result()
+        downloaded_buffer.flush()
+        manifest.flush()
+
+    run_in_engine(iter_pending_batches(task_file, manifest, redis_client, progress_callback, total,
+                                       direct, download_controller, blob_store=blob_store, work_dir=work_dir))
+    raise_if_interrupted(download_controller, packer, postprocessor)
+    progress_callback(finished[0], total[0], f"任务文件解析完成，共{total[0]}张图片")
+
+    max_retry_round = 3
+    retry_round = 1
+    while failed and retry_round <= max_retry_round:
+        retry_failed = list(failed)
+        failed.clear()
+        progress_callback(finished[0], total[0], f"第{retry_round}轮重试，剩余{len(retry_failed)}张")
+        RETRY_ROUND_IMAGES.inc(len(retry_failed), round=retry_round)
+        run_in_engine([(retry_failed, [])])
+        raise_if_interrupted(download_controller, packer, postprocessor)
+        retry_round += 1
+    postprocess_stats = close_postprocessor(postprocessor, progress_callback, total[0])
+    report_status(force=True)
+
+    final_archive_name = finish_book_packing(packer, direct, work_dir, output_folder, title, author, book_dir,
+                                             total[0], pack_after_download, delete_after_pack, progress_callback)
+
+    progress_callback(total[0], total[0], f"全部完成，失败{len(failed)}张")
+    return [{"zip": final_archive_name, "book": title, "failed": [x[1] for x in failed], "engine": "async",
+             "hosts": scheduler.stats(), "proxies": proxy_pool.stats() if proxy_pool else None,
+             "postprocess": postprocess_stats}]
+
+# --- END OF FILE async_downloader.py ---
@@ -0,0 +1,331 @@
+# --- START OF FILE benchmark.py ---
+
+"""
+下载引擎基准测试：启动一个本地 HTTP 服务器模拟图片 CDN（可配置图片大小、延迟、错误率、429 限流和 AES 加密），
+生成指定规模的 .txt / .json 任务文件，用下载引擎端到端地跑完，报告吞吐、单张图片延迟、峰值内存和 Redis 命令数。
+
+服务器的错误、限流和延迟抖动都由 --seed 决定（按 图片序号 + 第几次请求 取随机数），
+相同参数的两次运行看到的是同一组响应，不同版本之间的差异即为代码本身的变化：
+
+    python benchmark.py --images 2000 --size 200000 --latency 0.05 --concurrency 64 --json new.json
+    python benchmark.py --images 2000 --size 200000 --latency 0.05 --concurrency 64 --baseline new.json
+
+峰值内存在运行期间采样本进程的 RSS，同一进程里先跑的引擎留下的内存会计入后面的引擎，
+需要精确比较时每次只测一个引擎（--engines thread）。
+Redis 命令数通过 INFO 的 total_commands_processed 差值统计，请使用没有其他客户端的 Redis 实例。
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Crypto.Cipher import AES
+
+from downloader import process_task_file_with_progress, image_filename, url_cache_key
+from async_downloader import process_task_file_async
+
+ENGINES = {'thread': process_task_file_with_progress, 'async': process_task_file_async}
+TASK_FORMATS = ('txt', 'json')
+RSS_SAMPLE_INTERVAL = 0.02
+
+class FakeCDN:
+    """
+    模拟图源的响应策略和统计。路径形如 /<运行标识>/img/<序号>.jpg，
+    每张图片内容不同（前 8 字节为序号），同一图片的第 n 次请求是否出错、延迟多久只取决于 seed。
+    """
+    def __init__(self, size, latency, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1,
+                 aes_key=None, aes_iv=None, seed=0):
+        self.size = size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.aes_key = aes_key
+        self.aes_iv = aes_iv
+        self.seed = seed
+        self.base_body = random.Random(seed).randbytes(size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.attempts = {}
+            self.first_seen = {}
+            self.counts = {'requests': 0, 'ok': 0, 'error': 0, 'throttled': 0}
+
+    def respond(self, path):
+        """返回 (状态码, 额外响应头, 响应体, 延迟秒数)。"""
+        try:
+            image_id = int(path.rsplit("/", 1)[-1].split(".")[0])
+        except ValueError:
+            return 404, {}, b"", 0
+        with self._lock:
+            attempt = self.attempts.get(image_id, 0)
+            self.attempts[image_id] = attempt + 1
+            self.first_seen.setdefault(image_id, time.time())
+            self.counts['requests'] += 1
+        rng = random.Random(f"{self.seed}:{image_id}:{attempt}")
+        delay = max(0.0, self.latency * (1 + self.jitter * (rng.random() * 2 - 1)))
+        r = rng.random()
+        if r < self.error_rate:
+            self._count('error')
+            return 500, {}, b"", delay
+        if r < self.error_rate + self.throttle_rate:
+            self._count('throttled')
+            return 429, {"Retry-After": str(self.retry_after)}, b"", delay
+        self._count('ok')
+        return 200, {}, self.body(image_id), delay
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def body(self, image_id):
+        body = image_id.to_bytes(8, "big") + self.base_body[8:]
+        if self.aes_key:
+            pad = 16 - len(body) % 16
+            body = AES.new(self.aes_key, AES.MODE_CBC, self.aes_iv).encrypt(body + bytes([pad]) * pad)
+        return body
+
+def make_handler(cdn):
+    class ImageHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            status, headers, body, delay = cdn.respond(self.path.split("?")[0])
+            if delay:
+                time.sleep(delay)
+            self.send_response(status)
+            self.send_header("Content-Type", "image/jpeg" if status == 200 else "text/plain")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ImageHandler
+
+def start_server(cdn):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(cdn))
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def task_images(base_url, run_tag, images, chapter_size):
+    """返回 [(章节名, [url, ...]), ...]"""
+    chapters = []
+    for start in range(0, images, chapter_size):
+        urls = [f"{base_url}/{run_tag}/img/{i}.jpg" for i in range(start, min(start + chapter_size, images))]
+        chapters.append((f"第{len(chapters) + 1}章", urls))
+    return chapters
+
+def write_task_file(path, chapters, fmt='txt'):
+    if fmt == 'json':
+        data = {"title": "benchmark", "author": "benchmark",
+                "chapters": [{"title": title, "images": [{"url": url} for url in urls]} for title, urls in chapters]}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("作者：benchmark\n")
+        for title, urls in chapters:
+            f.write(f"{title}\n")
+            for url in urls:
+                f.write(f"{url}\n")
+
+def image_labels(chapters):
+    """进度日志里的 章节/文件名 → 图片序号，用于把完成时间对应到服务器首次收到请求的时间。"""
+    labels = {}
+    idx = 0
+    for title, urls in chapters:
+        for url in urls:
+            labels[f"{title}/{image_filename(idx, url)}"] = idx
+            idx += 1
+    return labels
+
+def read_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # 不支持 /proc 时退回进程生命周期内的峰值（Linux 上单位为 KB）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RSSSampler:
+    """运行期间在后台线程采样 RSS，记录峰值。"""
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = read_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, read_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss())
+
+def redis_commands(redis_client):
+    return int(redis_client.info("stats")["total_commands_processed"]) if redis_client else 0
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def run_engine(name, cdn, base_url, workdir, args, redis_client=None):
+    run_tag = f"{name}-{uuid.uuid4().hex[:8]}"
+    chapters = task_images(base_url, run_tag, args.images, args.chapter_size)
+    task_path = os.path.join(workdir, f"{run_tag}.{args.format}")
+    write_task_file(task_path, chapters, args.format)
+    labels = image_labels(chapters)
+    output_folder = os.path.join(workdir, f"out_{run_tag}")
+    manifest_key = f"comic_downloader:benchmark:{run_tag}" if redis_client else None
+    completed_at = {}
+
+    def on_progress(current, total, msg):
+        if msg.startswith("下载成功: "):
+            idx = labels.get(msg[len("下载成功: "):])
+            if idx is not None:
+                completed_at[idx] = time.time()
+
+    cdn.reset()
+    process_task = ENGINES[name]
+    commands_before = redis_commands(redis_client)
+    with RSSSampler() as rss:
+        started = time.perf_counter()
+        result = process_task(
+            task_path, output_folder, {"User-Agent": "benchmark"}, on_progress,
+            pack_after_download=args.pack, pack_mode=args.pack_mode,
+            max_workers=args.concurrency, max_concurrency=args.concurrency,
+            aes_key=args.aes_key if args.aes else None, aes_iv=args.aes_iv if args.aes else None,
+            redis_client=redis_client, manifest_key=manifest_key, stream_download=args.stream
+        )
+        elapsed = time.perf_counter() - started
+    # 第二次 INFO 的计数里包含第一次 INFO 本身
+    commands = redis_commands(redis_client) - commands_before - 1 if redis_client else None
+    if redis_client:
+        urls = [url for _, chapter_urls in chapters for url in chapter_urls]
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(manifest_key)
+        for url in urls:
+            pipe.delete(url_cache_key(url))
+        pipe.execute()
+
+    latencies = [completed_at[i] - cdn.first_seen[i] for i in completed_at if i in cdn.first_seen]
+    failed = len(result[0]["failed"])
+    done = args.images - failed
+    return {
+        'engine': name, 'seconds': round(elapsed, 3), 'images': args.images, 'failed': failed,
+        'images_per_s': round(done / elapsed, 2), 'mb_per_s': round(done * args.size / elapsed / 1e6, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1), 'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'peak_rss_mb': round(rss.peak / 1024 / 1024, 1),
+        'redis_ops_per_image': round(commands / args.images, 2) if commands is not None else None,
+        'requests_per_image': round(cdn.counts['requests'] / args.images, 3),
+        'server': dict(cdn.counts),
+    }
+
+def print_results(results, baseline=None):
+    baseline = {r['engine']: r for r in (baseline or {}).get('results', [])}
+    print(f"{'engine':<8}{'seconds':>9}{'images/s':>10}{'MB/s':>8}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'RSS MB':>9}{'redis/img':>10}{'req/img':>9}{'failed':>8}")
+    for r in results:
+        redis_ops = "-" if r['redis_ops_per_image'] is None else f"{r['redis_ops_per_image']:.2f}"
+        print(f"{r['engine']:<8}{r['seconds']:>9.2f}{r['images_per_s']:>10.1f}{r['mb_per_s']:>8.1f}"
+              f"{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['peak_rss_mb']:>9.1f}{redis_ops:>10}"
+              f"{r['requests_per_image']:>9.3f}{r['failed']:>8}")
+        old = baseline.get(r['engine'])
+        if old:
+            changes = []
+            for key, label in (('images_per_s', 'images/s'), ('p99_ms', 'p99'), ('peak_rss_mb', 'RSS'),
+                               ('redis_ops_per_image', 'redis/img')):
+                if old.get(key) and r.get(key) is not None:
+                    changes.append(f"{label} {(r[key] - old[key]) / old[key] * 100:+.1f}%")
+            print(f"{'':<8}相对基线: {', '.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="在本地模拟图源上测试下载引擎的吞吐、延迟和资源占用")
+    parser.add_argument("--images", type=int, default=1000, help="图片数量")
+    parser.add_argument("--chapter-size", type=int, default=100, help="每章图片数")
+    parser.add_argument("--format", choices=TASK_FORMATS, default="txt", help="任务文件格式")
+    parser.add_argument("--size", type=int, default=100_000, help="每张图片的字节数")
+    parser.add_argument("--latency", type=float, default=0.05, help="服务器每个请求的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机浮动比例，例如 0.5 表示 ±50%%")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的请求比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的请求比例")
+    parser.add_argument("--retry-after", type=int, default=1, help="429 响应的 Retry-After 秒数")
+    parser.add_argument("--aes", action="store_true", help="图片以 AES-CBC 加密返回，由下载器解密")
+    parser.add_argument("--aes-key", default="00112233445566778899aabbccddeeff", help="AES 密钥（hex）")
+    parser.add_argument("--aes-iv", default="0102030405060708090a0b0c0d0e0f10", help="AES IV（hex）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子，相同种子的运行看到相同的服务器响应")
+    parser.add_argument("--concurrency", type=int, default=32, help="每个任务的并发数")
+    parser.add_argument("--engines", default="thread,async", help="要测试的引擎，逗号分隔")
+    parser.add_argument("--stream", action="store_true", help="使用流式下载")
+    parser.add_argument("--pack", action="store_true", help="下载后打包 CBZ，计入耗时")
+    parser.add_argument("--pack-mode", default="after", help="打包方式：after / stream / direct")
+    parser.add_argument("--redis", default=None, help="Redis 地址，指定后统计每张图片的 Redis 命令数")
+    parser.add_argument("--json", default=None, help="把结果写入 JSON 文件，作为以后比较的基线")
+    parser.add_argument("--baseline", default=None, help="与之前 --json 保存的结果比较")
+    args = parser.parse_args()
+
+    redis_client = None
+    if args.redis:
+        import redis
+        redis_client = redis.Redis.from_url(args.redis, decode_responses=True)
+        redis_client.ping()
+    cdn = FakeCDN(args.size, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after,
+                  bytes.fromhex(args.aes_key) if args.aes else None, bytes.fromhex(args.aes_iv) if args.aes else None,
+                  args.seed)
+    server = start_server(cdn)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    workdir = tempfile.mkdtemp(prefix="comic_bench_")
+    config = {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'redis')}
+    config['body_sha256'] = hashlib.sha256(cdn.base_body).hexdigest()[:16]
+    try:
+        print(f"图片 {args.images} 张 × {args.size} 字节（{args.format}），延迟 {args.latency}s±{args.jitter:.0%}，"
+              f"错误率 {args.error_rate:.1%}，429 比例 {args.throttle_rate:.1%}，AES {'开' if args.aes else '关'}，"
+              f"并发 {args.concurrency}，seed {args.seed}")
+        results = [run_engine(name, cdn, base_url, workdir, args, redis_client) for name in args.engines.split(",")]
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("注意：基线的测试参数与本次不同，比较结果仅供参考")
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'config': config, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.json}")
+
+if __name__ == "__main__":
+    main()
+
+# --- END OF FILE benchmark.py ---
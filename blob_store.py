@@ -0,0 +1,148 @@
+# --- START OF FILE blob_store.py ---
+
+import os
+import re
+import time
+import shutil
+import hashlib
+
+from metrics import phase
+
+# 图片仓库放在输出目录下，保证与书籍目录在同一文件系统上，可以建立硬链接
+BLOB_DIR_NAME = ".blobs"
+HASH_CHUNK_SIZE = 1024 * 1024
+CONTENT_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+# Linux 的 FICLONE ioctl，在 btrfs/xfs 等文件系统上创建共享数据块的副本
+FICLONE = 0x40049409
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def is_content_hash(value):
+    return isinstance(value, str) and bool(CONTENT_HASH_RE.match(value))
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+def _link_or_copy(src, dst):
+    """优先硬链接，其次 reflink，最后才真正复制数据。"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if not _reflink(src, dst):
+        shutil.copyfile(src, dst)
+
+class BlobStore:
+    """
+    按内容 SHA-256 存放图片的本地仓库（<root>/ab/<hash>）。
+    书籍目录里的图片是仓库文件的硬链接，同一张图片无论出现在多少本书里、
+    用什么 URL 下载，磁盘上只存一份；URL 记录指向内容哈希，跳过下载时从仓库链接出完整的书。
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return is_content_hash(digest) and os.path.exists(self.blob_path(digest))
+
+    def ingest(self, path):
+        """把已下载的图片收入仓库并返回内容哈希；仓库里已有相同内容时，把 path 换成指向它的链接。"""
+        digest = file_sha256(path)
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, path):
+                self._link_into(blob, path)
+            return digest
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            # 另一个线程刚好收入了同样的内容
+            self._link_into(blob, path)
+        except OSError:
+            # 不支持硬链接（例如跨文件系统），仓库里保存一份副本
+            tmp = blob + ".tmp"
+            _link_or_copy(path, tmp)
+            os.replace(tmp, blob)
+        return digest
+
+    def try_ingest(self, path):
+        try:
+            with phase("store"):
+                return self.ingest(path)
+        except Exception as e:
+            print(f"收入图片仓库失败: {path} {e}")
+            return None
+
+    def materialize(self, digest, dest):
+        """把仓库中的图片链接到 dest，仓库里没有时返回 False。"""
+        if not self.has(digest):
+            return False
+        if os.path.exists(dest):
+            return True
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        self._link_into(self.blob_path(digest), dest)
+        return True
+
+    def _link_into(self, blob, path):
+        tmp = path + ".tmp"
+        _link_or_copy(blob, tmp)
+        os.replace(tmp, path)
+
+    def gc(self, max_age_days):
+        """
+        删除没有任何书籍目录引用（硬链接数为 1）、且超过 max_age_days 没有被链接或取消链接过的图片。
+        返回 (删除数量, 释放字节数)。
+        """
+        removed, freed = 0, 0
+        if not os.path.isdir(self.root):
+            return removed, freed
+        cutoff = time.time() - max_age_days * 86400
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    st = os.stat(path)
+                    # 链接数变化会更新 ctime，可以当作最后一次被使用的时间
+                    if st.st_ctime >= cutoff:
+                        continue
+                    if st.st_nlink <= 1 or name.endswith(".tmp"):
+                        os.remove(path)
+                        removed += 1
+                        freed += st.st_size
+                except OSError as e:
+                    print(f"清理图片仓库失败: {path} {e}")
+            try:
+                os.rmdir(prefix_dir)
+            except OSError:
+                pass
+        return removed, freed
+
+# --- END OF FILE blob_store.py ---
@@ -0,0 +1,407 @@
+# --- START OF FILE distributed.py ---
+
+"""
+分布式下载：Web 进程把一本书拆成逐张图片的工作项写入 Redis Stream，
+任意数量的下载进程（python worker.py）通过消费者组领取并下载，进度和结果写回 Redis。
+下载进程需要和 Web 进程共享输出目录（例如挂载同一块 NFS），打包仍由 Web 进程完成。
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from downloader import (
+    MIN_EXISTING_IMAGE_SIZE, REDIS_DOWNLOADED_URL_TTL,
+    SessionPool, AdaptiveScheduler, ProxyPool, CompletionManifest, RedisDownloadController, open_task_file,
+    parse_aes_key_iv, download_image, image_filename, build_image_headers, url_cache_key,
+    iter_pending_batches, finish_book_packing, close_postprocessor, PACK_SKIP_SUFFIXES
+)
+from blob_store import BlobStore, BLOB_DIR_NAME
+from metrics import IMAGES, redis_timer
+from postprocess import open_postprocessor
+
+DIST_KEY_PREFIX = "comic_downloader:dist:"
+DIST_STREAM_KEY = DIST_KEY_PREFIX + "items"
+DIST_GROUP = "workers"
+DIST_WORKERS_KEY = DIST_KEY_PREFIX + "workers"
+# 工作项被领取后超过该时间没有确认（下载进程崩溃或失联），会被其他下载进程重新领取
+DIST_VISIBILITY_TIMEOUT = 120
+# 单张图片最多分发的轮数，与本地引擎的 1 轮下载 + 3 轮重试一致
+DIST_MAX_ATTEMPTS = 4
+DIST_POLL_INTERVAL = 0.5
+DIST_JOB_TTL = 7*24*60*60
+DIST_EVENT_LIMIT = 5000
+# 超过该时间没有心跳的下载进程视为离线
+DIST_WORKER_TTL = 30
+DIST_CONFIG_CACHE_TTL = 5
+DIST_BLOCK_MS = 1000
+
+def get_job_key(job_id):
+    return f"{DIST_KEY_PREFIX}job:{job_id}"
+
+def get_job_settled_key(job_id):
+    # 哈希：序号 -> 空字符串（下载成功）或图片 URL（重试用尽后失败）
+    return f"{DIST_KEY_PREFIX}job:{job_id}:settled"
+
+def get_job_events_key(job_id):
+    return f"{DIST_KEY_PREFIX}job:{job_id}:events"
+
+def ensure_group(redis_client):
+    try:
+        redis_client.xgroup_create(DIST_STREAM_KEY, DIST_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def count_live_workers(redis_client):
+    redis_client.zremrangebyscore(DIST_WORKERS_KEY, 0, time.time() - DIST_WORKER_TTL)
+    return redis_client.zcard(DIST_WORKERS_KEY)
+
+def process_task_file_distributed(
+    task_path, output_folder, headers, progress_callback, proxy_list=None,
+    pack_after_download=True, delete_after_pack=False, aes_key=None, aes_iv=None,
+    max_workers=4, download_controller=None, custom_referer=None,
+    redis_client=None, pool_size=None, stream_download=False, manifest_key=None,
+    resume_download=False, max_concurrency=None, status_callback=None, pack_mode='after',
+    download_slots=None, profiler=None, postprocess=None
+):
+    """
+    与 process_task_file_with_progress 接口相同的分布式引擎：本进程只负责解析、入队、汇总进度和打包，
+    图片由 worker.py 进程下载，并发由各下载进程的 --concurrency 决定。
+    下载相关的指标和性能分析在各下载进程里，这里只有解析、入队和打包。
+    """
+    if not redis_client:
+        raise Exception("分布式引擎需要 Redis")
+    task_file = open_task_file(task_path)
+    title, author = task_file.title, task_file.author
+    book_dir = os.path.join(output_folder, title)
+    os.makedirs(book_dir, exist_ok=True)
+    blob_store = BlobStore(os.path.join(output_folder, BLOB_DIR_NAME))
+    total = [0]
+    progress_callback(0, 0, "开始分发下载任务，边解析任务文件边入队")
+    if pack_after_download and pack_mode != 'after':
+        progress_callback(0, 0, "分布式引擎的图片由其他进程写入，打包方式改为下载完成后打包")
+
+    ensure_group(redis_client)
+    job_id = uuid.uuid4().hex
+    config = {
+        'output_folder': output_folder, 'title': title, 'headers': headers,
+        'global_referer': task_file.global_referer, 'custom_referer': custom_referer,
+        'proxy_list': proxy_list or [], 'aes_key': aes_key, 'aes_iv': aes_iv,
+        'stream_download': stream_download, 'resume_download': resume_download, 'manifest_key': manifest_key,
+        'control_task_id': getattr(download_controller, 'task_id', None),
+    }
+    job_key = get_job_key(job_id)
+    settled_key = get_job_settled_key(job_id)
+    events_key = get_job_events_key(job_id)
+    redis_client.set(job_key, json.dumps(config, ensure_ascii=False), ex=DIST_JOB_TTL)
+    manifest = CompletionManifest(redis_client, manifest_key)
+    skipped = [0]
+    enqueued = [0]
+    last_status_report = [0]
+
+    def report_status(force=False):
+        if not status_callback:
+            return
+        now = time.time()
+        if not force and now - last_status_report[0] < 1.0:
+            return
+        last_status_report[0] = now
+        status_callback({'distributed': {
+            'job': job_id, 'workers': count_live_workers(redis_client),
+            'queue_length': redis_client.xlen(DIST_STREAM_KEY), 'enqueued': enqueued[0],
+        }})
+
+    def drain():
+        # 取走下载进程写入的日志并读取本任务已结束（成功或失败）的图片数，一次事务往返
+        pipe = redis_client.pipeline()
+        pipe.lrange(events_key, 0, -1)
+        pipe.delete(events_key)
+        pipe.hlen(settled_key)
+        with redis_timer("dist_drain"):
+            events, _, settled = pipe.execute()
+        current = skipped[0] + settled
+        for msg in events:
+            progress_callback(current, total[0], msg)
+        return settled
+
+    try:
+        for pending, skipped_items in iter_pending_batches(task_file, manifest, redis_client, progress_callback,
+                                                           total, False, download_controller,
+                                                           blob_store=blob_store, work_dir=book_dir):
+            if skipped_items:
+                skipped[0] += len(skipped_items)
+                IMAGES.inc(len(skipped_items), engine='distributed', result='skipped')
+                progress_callback(skipped[0], total[0], f"已下载过，跳过{len(skipped_items)}张")
+            if pending:
+                pipe = redis_client.pipeline(transaction=False)
+                for idx, url, headers_img, chapter_title in pending:
+                    pipe.xadd(DIST_STREAM_KEY, {
+                        'job': job_id, 'idx': idx, 'url': url, 'chapter': chapter_title, 'attempt': 0,
+                        'headers': json.dumps(headers_img, ensure_ascii=False),
+                    })
+                with redis_timer("dist_enqueue"):
+                    pipe.execute()
+                enqueued[0] += len(pending)
+            drain()
+            report_status()
+        progress_callback(skipped[0], total[0], f"任务文件解析完成，共{total[0]}张图片，已分发{enqueued[0]}张")
+
+        started = time.time()
+        warned = False
+        while True:
+            settled = drain()
+            if settled >= enqueued[0]:
+                break
+            if download_controller:
+                download_controller.check()
+            if not warned and time.time() - started > DIST_WORKER_TTL and count_live_workers(redis_client) == 0:
+                progress_callback(skipped[0] + settled, total[0], "没有在线的下载进程，请在任意节点运行 python worker.py")
+                warned = True
+            report_status()
+            time.sleep(DIST_POLL_INTERVAL)
+        failed_urls = [url for url in redis_client.hvals(settled_key) if url]
+    finally:
+        # 任务配置删除后，队列里残留的工作项会被下载进程直接丢弃
+        redis_client.delete(job_key, settled_key, events_key)
+    report_status(force=True)
+
+    # 图片由其他进程写入，后处理在全部下载完成后对整个目录进行，仍在本机进程池里并行
+    postprocess_stats = None
+    postprocessor = open_postprocessor(postprocess, None, False, progress_callback)
+    if postprocessor:
+        for root, _, files in os.walk(book_dir):
+            for name in files:
+                if not name.endswith(PACK_SKIP_SUFFIXES):
+                    path = os.path.join(root, name)
+                    postprocessor.submit(path, os.path.relpath(path, book_dir))
+        postprocess_stats = close_postprocessor(postprocessor, progress_callback, total[0])
+
+    final_archive_name = finish_book_packing(None, False, book_dir, output_folder, title, author, book_dir,
+                                             total[0], pack_after_download, delete_after_pack, progress_callback)
+
+    progress_callback(total[0], total[0], f"全部完成，失败{len(failed_urls)}张")
+    return [{"zip": final_archive_name, "book": title, "failed": failed_urls, "engine": "distributed",
+             "postprocess": postprocess_stats}]
+
+class DistributedWorker:
+    """
+    分布式下载进程：从 Redis Stream 领取图片工作项并下载，成功后写完成位图、URL 记录和计数，
+    失败的重新入队进入下一轮。正在下载的工作项由心跳线程续期；进程崩溃后未确认的工作项
+    超过 visibility_timeout 会被其他下载进程领取。
+    """
+    def __init__(self, redis_client, concurrency=8, consumer=None, output_folder=None,
+                 visibility_timeout=DIST_VISIBILITY_TIMEOUT, block_ms=DIST_BLOCK_MS):
+        self.redis_client = redis_client
+        self.concurrency = concurrency
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        # 各节点挂载路径不同时，用本地路径覆盖任务配置里的输出目录
+        self.output_folder = output_folder
+        self.visibility_timeout = visibility_timeout
+        self.block_ms = block_ms
+        self.scheduler = AdaptiveScheduler(concurrency, concurrency)
+        self.session_pool = SessionPool(pool_size=concurrency)
+        # 使用相同代理列表的任务共享一个代理池，代理的健康状况在任务之间延续
+        self._proxy_pools = {}
+        self.processed = 0
+        self._jobs = {}
+        self._in_progress = set()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        ensure_group(redis_client)
+
+    def stop(self):
+        self._stop.set()
+
+    def _proxy_pool(self, proxy_list):
+        if not proxy_list:
+            return None
+        key = tuple(proxy_list)
+        with self._cond:
+            pool = self._proxy_pools.get(key)
+            if pool is None:
+                pool = self._proxy_pools[key] = ProxyPool(proxy_list, self.session_pool)
+            return pool
+
+    def _job(self, job_id):
+        now = time.time()
+        with self._cond:
+            cached = self._jobs.get(job_id)
+        if cached and cached['expires'] > now:
+            return cached['job']
+        raw = self.redis_client.get(get_job_key(job_id)) if job_id else None
+        job = None
+        if raw:
+            config = json.loads(raw)
+            key, iv = parse_aes_key_iv(config.get('aes_key'), config.get('aes_iv'))
+            task_id = config.get('control_task_id')
+            controller = RedisDownloadController(self.redis_client, task_id) if task_id else None
+            job = {'config': config, 'key': key, 'iv': iv, 'controller': controller}
+        with self._cond:
+            # 顺便丢弃过期的缓存，长期运行的下载进程不会随任务数增长
+            for expired in [k for k, v in self._jobs.items() if v['expires'] <= now]:
+                del self._jobs[expired]
+            self._jobs[job_id] = {'job': job, 'expires': now + DIST_CONFIG_CACHE_TTL}
+        return job
+
+    def claim(self, count):
+        """先接管超时未确认的工作项，再领取新的工作项。"""
+        entries = []
+        result = self.redis_client.xautoclaim(DIST_STREAM_KEY, DIST_GROUP, self.consumer,
+                                              min_idle_time=self.visibility_timeout * 1000,
+                                              start_id='0-0', count=count)
+        entries.extend(e for e in result[1] if e and e[1])
+        if len(entries) < count:
+            block = None if entries else self.block_ms
+            response = self.redis_client.xreadgroup(DIST_GROUP, self.consumer, {DIST_STREAM_KEY: '>'},
+                                                    count=count - len(entries), block=block)
+            for _, items in response or []:
+                entries.extend(items)
+        return entries
+
+    def _finish(self, pipe, entry_id):
+        pipe.xack(DIST_STREAM_KEY, DIST_GROUP, entry_id)
+        pipe.xdel(DIST_STREAM_KEY, entry_id)
+        with redis_timer("dist_ack"):
+            pipe.execute()
+
+    def _event(self, pipe, job_id, msg):
+        events_key = get_job_events_key(job_id)
+        pipe.rpush(events_key, msg)
+        pipe.ltrim(events_key, -DIST_EVENT_LIMIT, -1)
+        pipe.expire(events_key, DIST_JOB_TTL)
+
+    def _succeed(self, entry_id, job_id, config, idx, url, output_folder, save_path, msg):
+        # 图片仓库与书籍目录同在共享的输出目录下，其他节点和 Web 进程都能链接
+        digest = BlobStore(os.path.join(output_folder, BLOB_DIR_NAME)).try_ingest(save_path)
+        manifest_key = config.get('manifest_key')
+        settled_key = get_job_settled_key(job_id)
+        # 完成数按任务各自的哈希统计：同一工作项因超时被重复领取时只计一次，
+        # 之前被另一份副本记为失败的序号改记为成功，也不会重复计数；
+        # 位图只用于跳过和恢复，可能已被暂停前的任务或共用位图的其他任务置位
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hget(settled_key, idx)
+        pipe.hset(settled_key, idx, "")
+        pipe.expire(settled_key, DIST_JOB_TTL)
+        if manifest_key:
+            pipe.setbit(manifest_key, idx, 1)
+            pipe.expire(manifest_key, REDIS_DOWNLOADED_URL_TTL)
+        pipe.set(url_cache_key(url), digest or "1", ex=REDIS_DOWNLOADED_URL_TTL)
+        previous = pipe.execute()[0]
+        pipe = self.redis_client.pipeline(transaction=False)
+        if previous != "":
+            self._event(pipe, job_id, msg)
+            IMAGES.inc(engine='distributed', result='downloaded')
+        self._finish(pipe, entry_id)
+
+    def _fail(self, entry_id, job_id, fields, attempt, label, error):
+        pipe = self.redis_client.pipeline(transaction=False)
+        if attempt + 1 < DIST_MAX_ATTEMPTS:
+            pipe.xadd(DIST_STREAM_KEY, dict(fields, attempt=attempt + 1))
+            self._event(pipe, job_id, f"下载失败，稍后第{attempt + 1}轮重试: {label} {error}")
+        else:
+            settled_key = get_job_settled_key(job_id)
+            # 已被另一份副本下载成功的序号保持成功
+            pipe.hsetnx(settled_key, fields['idx'], fields['url'])
+            pipe.expire(settled_key, DIST_JOB_TTL)
+            self._event(pipe, job_id, f"下载失败: {label} {error}")
+            IMAGES.inc(engine='distributed', result='failed')
+        self._finish(pipe, entry_id)
+
+    def process(self, entry_id, fields):
+        job_id = fields.get('job')
+        job = self._job(job_id)
+        controller = job['controller'] if job else None
+        if job is None or (controller and (controller.is_paused() or controller.is_stopped())):
+            # 任务已结束、暂停或终止：丢弃工作项，恢复任务时会重新分发未完成的图片
+            self._finish(self.redis_client.pipeline(transaction=False), entry_id)
+            return
+        config = job['config']
+        idx = int(fields['idx'])
+        url = fields['url']
+        chapter_title = fields['chapter']
+        attempt = int(fields.get('attempt', 0))
+        output_folder = self.output_folder or config['output_folder']
+        chapter_dir = os.path.join(output_folder, config['title'], chapter_title)
+        os.makedirs(chapter_dir, exist_ok=True)
+        filename = image_filename(idx, url)
+        save_path = os.path.join(chapter_dir, filename)
+        label = f"{chapter_title}/{filename}"
+        if os.path.exists(save_path) and os.path.getsize(save_path) >= MIN_EXISTING_IMAGE_SIZE:
+            self._succeed(entry_id, job_id, config, idx, url, output_folder, save_path, f"本地文件已存在，跳过: {label}")
+            return
+        h = build_image_headers(config['headers'], json.loads(fields.get('headers') or '{}'),
+                                config.get('global_referer'), config.get('custom_referer'))
+        proxy_pool = self._proxy_pool(config.get('proxy_list'))
+        try:
+            download_image(url, save_path, h, aes_key=job['key'], aes_iv=job['iv'],
+                           session=None if proxy_pool else self.session_pool.get(url),
+                           stream=config.get('stream_download'), resume=config.get('resume_download'),
+                           scheduler=self.scheduler, proxy_pool=proxy_pool)
+        except Exception as e:
+            self._fail(entry_id, job_id, fields, attempt, label, e)
+            return
+        self._succeed(entry_id, job_id, config, idx, url, output_folder, save_path, f"下载成功: {label} ({self.consumer})")
+
+    def _run_entry(self, entry_id, fields):
+        try:
+            self.process(entry_id, fields)
+        except Exception as e:
+            # Redis 出错时不确认，工作项超时后由其他下载进程重新领取
+            print(f"处理工作项 {entry_id} 时出错: {e}")
+        finally:
+            with self._cond:
+                self._in_progress.discard(entry_id)
+                self.processed += 1
+                self._cond.notify_all()
+
+    def _heartbeat(self):
+        interval = min(self.visibility_timeout, DIST_WORKER_TTL) / 3
+        while True:
+            try:
+                self.redis_client.zadd(DIST_WORKERS_KEY, {self.consumer: time.time()})
+                with self._cond:
+                    ids = list(self._in_progress)
+                if ids:
+                    # 重置空闲时间，下载慢的图片不会被其他进程当作超时接管
+                    self.redis_client.xclaim(DIST_STREAM_KEY, DIST_GROUP, self.consumer, 0, ids, justid=True)
+            except Exception as e:
+                print(f"下载进程心跳失败: {e}")
+            if self._stop.wait(interval):
+                return
+
+    def run(self, idle_exit=False):
+        """持续领取并下载；idle_exit=True 时队列为空即返回（用于测试和一次性补跑）。"""
+        threading.Thread(target=self._heartbeat, daemon=True, name="dist-worker-heartbeat").start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                while not self._stop.is_set():
+                    with self._cond:
+                        while len(self._in_progress) >= self.concurrency and not self._stop.is_set():
+                            self._cond.wait(0.5)
+                        free = self.concurrency - len(self._in_progress)
+                    if self._stop.is_set():
+                        break
+                    entries = self.claim(free)
+                    if not entries:
+                        with self._cond:
+                            busy = bool(self._in_progress)
+                        if idle_exit and not busy:
+                            break
+                        continue
+                    with self._cond:
+                        self._in_progress.update(entry_id for entry_id, _ in entries)
+                    for entry_id, fields in entries:
+                        pool.submit(self._run_entry, entry_id, fields)
+        finally:
+            self._stop.set()
+            self.session_pool.close()
+            self.redis_client.zrem(DIST_WORKERS_KEY, self.consumer)
+
+# --- END OF FILE distributed.py ---
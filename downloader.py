@@ -2,13 +2,35 @@
 
 import os
 import re
+import ast
 import json
+import time
+import email.utils
+import random
+import hashlib
+import functools
+import contextlib
+import queue
+import shutil
+import asyncio
+import zipfile
 import threading
+from xml.sax.saxutils import escape
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 from Crypto.Cipher import AES
 
+from blob_store import BlobStore, BLOB_DIR_NAME, is_content_hash
+from postprocess import open_postprocessor, find_processed, format_postprocess_summary
+from task_cache import ParsedTaskCache, CachingTaskFile, PARSED_CACHE_DIR_NAME, task_file_digest, cache_key
+from metrics import (
+    IMAGES, BYTES, REQUEST_SECONDS, HTTP_RETRIES, RETRY_ROUND_IMAGES, QUEUED_IMAGES, ACTIVE_DOWNLOADS,
+    PROXY_REQUESTS, PROXY_QUARANTINES, phase, record_phase, redis_timer
+)
+
 def sanitize_filename(filename):
     """
     净化文件名，移除或替换掉不适合在文件名或URL中使用的字符。
@@ -21,6 +43,37 @@ def sanitize_filename(filename):
     sanitized = re.sub(r'\s+', ' ', sanitized).strip()
     return sanitized
 
+STREAM_CHUNK_SIZE = 64 * 1024
+# 本地已存在且不小于该大小的图片视为已下载完成
+MIN_EXISTING_IMAGE_SIZE = 512
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30
+RETRY_AFTER_CAP = 120
+THROTTLE_STATUS_CODES = (429, 503)
+# 平均延迟超过最低延迟的倍数时，不再增加该主机的并发
+HOST_LATENCY_FACTOR = 3
+STATUS_REPORT_INTERVAL = 1.0
+# 代理连续失败该次数后进入隔离，隔离时间从 BASE 秒开始每次探测失败翻倍，不超过 CAP 秒
+PROXY_QUARANTINE_FAILURES = 3
+PROXY_QUARANTINE_BASE = 30
+PROXY_QUARANTINE_CAP = 600
+PROXY_EWMA_ALPHA = 0.2
+# 这些状态码通常说明代理的出口 IP 被封禁或限流，记为代理失败；源站的 404/5xx 与代理无关
+PROXY_FAULT_STATUS_CODES = (403, 407, 429)
+
+def parse_aes_key_iv(aes_key, aes_iv):
+    """
+    将表单里的密钥/IV 字符串转换为字节，hex 格式按长度识别。已是字节则原样返回。
+    """
+    if not (aes_key and aes_iv):
+        return None, None
+    if isinstance(aes_key, str):
+        aes_key = bytes.fromhex(aes_key) if len(aes_key) in (32, 48, 64) else aes_key.encode('utf-8')
+    if isinstance(aes_iv, str):
+        aes_iv = bytes.fromhex(aes_iv) if len(aes_iv) == 32 else aes_iv.encode('utf-8')
+    return aes_key, aes_iv
+
 def aes_decrypt(data, key, iv):
     cipher = AES.new(key, AES.MODE_CBC, iv)
     decrypted = cipher.decrypt(data)
@@ -30,19 +83,91 @@ def aes_decrypt(data, key, iv):
         decrypted = decrypted[:-pad_len]
     return decrypted
 
+class AESStreamDecryptor:
+    """
+    分块解密 AES-CBC 数据流。每次只解密 16 字节对齐的部分，
+    并始终保留最后一个块，直到 finish() 时才处理 PKCS7 填充。
+    """
+    def __init__(self, key, iv):
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._buffer = b""
+
+    def update(self, chunk):
+        self._buffer += chunk
+        # 保留至少一个完整块，留给 finish() 去除填充
+        ready = len(self._buffer) - 16
+        if ready <= 0:
+            return b""
+        ready -= ready % 16
+        data, self._buffer = self._buffer[:ready], self._buffer[ready:]
+        return self._cipher.decrypt(data)
+
+    def finish(self):
+        if not self._buffer:
+            return b""
+        if len(self._buffer) % 16:
+            raise ValueError("密文长度不是16字节的整数倍")
+        decrypted = self._cipher.decrypt(self._buffer)
+        self._buffer = b""
+        pad_len = decrypted[-1]
+        if pad_len > 0 and pad_len <= 16:
+            decrypted = decrypted[:-pad_len]
+        return decrypted
+
+IMG_URL_RE = re.compile(r'^https?://')
+IMG_TAG_SRC_RE = re.compile(r'<img\s+[^>]*src=[\'"]([^\'"]+)[\'"]', re.IGNORECASE)
+EMBEDDED_URL_RE = re.compile(r'(https?://[^\s\'">]+)')
+HEADER_KEY_RE = re.compile(r'([a-zA-Z0-9_]+):')
+AUTHOR_RE = re.compile(r'作者[:：]\s*([^\n]+)')
+SOURCE_SITE_RE = re.compile(r'📌当前源站：[^⓪]*⓪(https?://[^\s]+)')
+# 作者、源站等元数据只在第一张图片之前的行中查找，最多读取这么多行
+TASK_HEADER_MAX_LINES = 1000
+JSON_META_KEYS = ("title", "author", "referer")
+# 同一本书的图片行通常带着完全相同的请求头片段，解析结果按原文缓存
+HEADER_BLOB_CACHE_SIZE = 1024
+
 def is_img_line(line):
     line = line.strip()
     if not line:
         return False
-    if re.match(r'^https?://', line):
+    if IMG_URL_RE.match(line):
         return True
     if '<img' in line and 'src=' in line:
         return True
     return False
 
-def parse_img_src(src):
+@functools.lru_cache(maxsize=HEADER_BLOB_CACHE_SIZE)
+def parse_header_blob(headers_str):
+    """
+    解析图片行里 `,{...}` 形式的请求头片段，返回只含 Referer/Origin 的字典。
+    返回值会被多张图片共享，调用方不要修改。
+    """
+    data = None
+    try:
+        headers_json = headers_str.replace("'", '"')
+        headers_json = HEADER_KEY_RE.sub(r'"\1":', headers_json)
+        data = json.loads(headers_json)
+    except Exception:
+        try:
+            data = ast.literal_eval(headers_str)
+        except Exception:
+            pass
+    result = {}
+    try:
+        headers = data.get("headers") or data.get("header") or data
+        referer = headers.get("Referer") or headers.get("referer")
+        origin = headers.get("Origin") or headers.get("origin")
+    except Exception:
+        return result
+    if referer:
+        result['Referer'] = referer
+    if origin:
+        result['Origin'] = origin
+    return result
+
+def _split_img_src(src):
     src = src.strip()
-    m = re.search(r'<img\s+[^>]*src=[\'"]([^\'"]+)[\'"]', src, re.IGNORECASE)
+    m = IMG_TAG_SRC_RE.search(src)
     if m:
         src = m.group(1)
     if ',{' in src:
@@ -53,96 +178,773 @@ def parse_img_src(src):
         headers_str = None
     url = url.strip()
     if not url.lower().startswith("http"):
-        m2 = re.search(r'(https?://[^\s\'">]+)', url)
+        m2 = EMBEDDED_URL_RE.search(url)
         if m2:
             url = m2.group(1)
-    referer = None
-    origin = None
-    if headers_str:
+    return url, headers_str
+
+def parse_img_src(src):
+    url, headers_str = _split_img_src(src)
+    headers = parse_header_blob(headers_str) if headers_str else {}
+    return url, headers.get('Referer'), headers.get('Origin')
+
+class StreamingTaskFile:
+    """
+    流式读取任务文件：构造时只读取书名、作者、源站等顶层元数据（不组装章节），
+    迭代时逐行（JSON 为逐章）产出 (url, headers, chapter_title)，内存占用与文件大小无关。
+    JSON 任务文件在安装了 ijson 时流式解析，否则整体加载。
+    """
+    def __init__(self, task_path):
+        self.task_path = task_path
+        self.is_json = task_path.lower().endswith(".json")
+        self.title = sanitize_filename(os.path.splitext(os.path.basename(task_path))[0])
+        self.author = "未知作者"
+        self.global_referer = None
+        self._json_data = None
+        if self.is_json:
+            self._read_json_meta()
+        else:
+            self._read_txt_meta()
+
+    def __iter__(self):
+        return self._iter_json() if self.is_json else self._iter_txt()
+
+    def _read_txt_meta(self):
+        header_lines = []
+        with open(self.task_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if is_img_line(line) or len(header_lines) >= TASK_HEADER_MAX_LINES:
+                    break
+                header_lines.append(line)
+        text = "".join(header_lines)
+        m = AUTHOR_RE.search(text)
+        if m:
+            self.author = m.group(1).strip()
+        m = SOURCE_SITE_RE.search(text)
+        if m:
+            self.global_referer = m.group(1).strip()
+
+    def _iter_txt(self):
+        chapter_title = "第1章"
+        with open(self.task_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if is_img_line(line):
+                    url, headers_str = _split_img_src(line)
+                    yield url, parse_header_blob(headers_str) if headers_str else {}, chapter_title
+                else:
+                    chapter_title = sanitize_filename(line)
+
+    def _read_json_meta(self):
+        ijson = _import_ijson()
+        if ijson:
+            meta = self._scan_json_meta(ijson)
+        else:
+            with open(self.task_path, "r", encoding="utf-8") as f:
+                self._json_data = json.load(f)
+            meta = self._json_data
+        if meta.get("title"):
+            self.title = sanitize_filename(meta["title"])
+        self.author = meta.get("author", self.author)
+        self.global_referer = meta.get("referer")
+
+    def _scan_json_meta(self, ijson):
+        """
+        开始下载前先把顶层的书名、作者、源站都读全。元数据都写在 chapters 前面时读到
+        chapters 数组开头就停；否则继续往后扫，只跟踪嵌套深度、不组装章节对象，
+        写在 chapters 之后的 author/referer 也能在第一张图片下载前拿到。
+        """
+        meta = {}
+        depth = 0
+        key = None
+        with open(self.task_path, "rb") as f:
+            for event, value in ijson.basic_parse(f):
+                if event in ("start_map", "start_array"):
+                    if depth == 1 and key == "chapters" and len(meta) == len(JSON_META_KEYS):
+                        break
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+                elif depth == 1:
+                    if event == "map_key":
+                        key = value
+                    elif event == "string" and key in JSON_META_KEYS:
+                        meta.setdefault(key, value)
+        return meta
+
+    def _iter_json(self):
+        ijson = _import_ijson()
+        if ijson and self._json_data is None:
+            with open(self.task_path, "rb") as f:
+                yield from self._iter_chapters(ijson.items(f, "chapters.item"))
+            return
+        data, self._json_data = self._json_data, None
+        if data is None:
+            with open(self.task_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        yield from self._iter_chapters(data.get("chapters", []))
+
+    @staticmethod
+    def _iter_chapters(chapters):
+        for chapter in chapters:
+            chapter_title = sanitize_filename(chapter.get("title", "第1章"))
+            for img in chapter.get("images", []):
+                yield img.get("url"), img.get("headers", {}), chapter_title
+
+def open_task_file(task_path):
+    """
+    打开任务文件。按内容哈希保存的上传文件先查解析缓存，命中时直接读取缓存、完全跳过解析；
+    未命中时边解析边写缓存，完整解析一遍后缓存生效。其他位置的文件直接流式解析。
+    """
+    digest = task_file_digest(task_path)
+    if not digest:
+        return StreamingTaskFile(task_path)
+    upload_folder = os.path.dirname(os.path.dirname(os.path.abspath(task_path)))
+    cache = ParsedTaskCache(os.path.join(upload_folder, PARSED_CACHE_DIR_NAME))
+    key = cache_key(digest, os.path.basename(task_path))
+    return cache.open(key) or CachingTaskFile(StreamingTaskFile(task_path), cache, key)
+
+def _import_ijson():
+    try:
+        import ijson
+    except ImportError:
+        return None
+    return ijson
+
+def parse_txt_task_file(txt_path):
+    task_file = StreamingTaskFile(txt_path)
+    return task_file.title, task_file.author, task_file.global_referer, list(task_file)
+
+def parse_json_task_file(json_path):
+    task_file = StreamingTaskFile(json_path)
+    return task_file.title, task_file.author, task_file.global_referer, list(task_file)
+
+class SessionPool:
+    """
+    按 (主机, 代理) 复用 requests.Session，保持 keep-alive 长连接，
+    避免每张图片都重新建立 TCP/TLS 连接。
+    """
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, proxies=None):
+        parts = urlsplit(url)
+        proxy = (proxies or {}).get(parts.scheme)
+        key = (parts.scheme, parts.netloc, proxy)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+            return session
+
+    def _iter_connection_pools(self):
+        for session in list(self._sessions.values()):
+            adapters = {id(a): a for a in session.adapters.values()}.values()
+            for adapter in adapters:
+                managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+                for manager in managers:
+                    for pool_key in list(manager.pools.keys()):
+                        pool = manager.pools.get(pool_key)
+                        if pool is not None:
+                            yield pool
+
+    def stats(self):
+        """返回连接统计：新建连接数、复用次数、请求总数。"""
+        new_connections = 0
+        requests_sent = 0
+        for pool in self._iter_connection_pools():
+            new_connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            'sessions': len(self._sessions),
+            'new_connections': new_connections,
+            'reused_connections': max(requests_sent - new_connections, 0),
+            'requests': requests_sent,
+        }
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+def mask_proxy(proxy):
+    """任务状态和指标里隐藏代理地址中的用户名和密码。"""
+    parts = urlsplit(proxy)
+    if not (parts.username or parts.password):
+        return proxy
+    netloc = parts.hostname + (f":{parts.port}" if parts.port else "")
+    return urlunsplit((parts.scheme, f"***@{netloc}", parts.path, parts.query, parts.fragment))
+
+class ProxyState:
+    __slots__ = ("proxy", "label", "success_ewma", "latency_ewma", "requests", "failures",
+                 "consecutive_failures", "quarantines", "quarantined_until", "in_flight")
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.label = mask_proxy(proxy)
+        self.success_ewma = 1.0
+        self.latency_ewma = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # 连续被隔离的次数，决定下一次隔离的时长
+        self.quarantines = 0
+        # 非 0 表示处于隔离中；到期后进入探测状态，直到一次成功的请求才清零
+        self.quarantined_until = 0
+        self.in_flight = 0
+
+    def weight(self, default_latency):
+        latency = self.latency_ewma or default_latency
+        return max(self.success_ewma, 0.01) ** 2 / max(latency, 0.05)
+
+class ProxyPool:
+    """
+    单个任务的代理池，替代均匀随机选择：按成功率和延迟（EWMA）加权随机选择代理，
+    连续失败的代理被隔离，到期后只放行一个探测请求，成功则恢复，失败则隔离时间加倍。
+    传入 SessionPool 时每个代理使用各自复用的长连接。
+    """
+    def __init__(self, proxies, session_pool=None):
+        self._states = {p: ProxyState(p) for p in dict.fromkeys(proxies)}
+        self.session_pool = session_pool
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def choose(self, exclude=None):
+        """选择一个代理并计入在途请求，用完后必须调用 report()。exclude 为上一次失败的代理，重试时尽量避开。"""
+        now = time.time()
+        with self._lock:
+            states = list(self._states.values())
+            # 隔离到期的代理同一时间只放行一个探测请求
+            usable = [s for s in states
+                      if not s.quarantined_until or (s.quarantined_until <= now and not s.in_flight)]
+            available = [s for s in usable if s.proxy != exclude] or usable
+            if available:
+                latencies = [s.latency_ewma for s in available if s.latency_ewma]
+                default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+                state = random.choices(available, weights=[s.weight(default_latency) for s in available])[0]
+            else:
+                # 所有代理都在隔离中时任务不停下来，选最早到期的那个
+                state = min(states, key=lambda s: s.quarantined_until)
+            state.in_flight += 1
+            return state.proxy
+
+    def report(self, proxy, ok, latency=None):
+        now = time.time()
+        quarantined = False
+        with self._lock:
+            state = self._states.get(proxy)
+            if state is None:
+                return
+            state.in_flight -= 1
+            state.requests += 1
+            state.success_ewma = state.success_ewma * (1 - PROXY_EWMA_ALPHA) + (PROXY_EWMA_ALPHA if ok else 0)
+            if ok:
+                if latency is not None:
+                    state.latency_ewma = latency if state.latency_ewma is None else \
+                        state.latency_ewma * (1 - PROXY_EWMA_ALPHA) + latency * PROXY_EWMA_ALPHA
+                state.consecutive_failures = 0
+                state.quarantines = 0
+                state.quarantined_until = 0
+            else:
+                state.failures += 1
+                state.consecutive_failures += 1
+                probing = state.quarantined_until and state.quarantined_until <= now
+                if probing or (not state.quarantined_until
+                               and state.consecutive_failures >= PROXY_QUARANTINE_FAILURES):
+                    state.quarantines += 1
+                    state.quarantined_until = now + min(PROXY_QUARANTINE_CAP,
+                                                        PROXY_QUARANTINE_BASE * 2 ** (state.quarantines - 1))
+                    quarantined = True
+        PROXY_REQUESTS.inc(proxy=state.label, result='ok' if ok else 'error')
+        if quarantined:
+            PROXY_QUARANTINES.inc(proxy=state.label)
+
+    def session(self, url, proxy):
+        return self.session_pool.get(url, proxy_mapping(proxy)) if self.session_pool else None
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            states = list(self._states.values())
+            result = {}
+            for s in states:
+                if not s.quarantined_until:
+                    status = 'ok'
+                elif s.quarantined_until > now:
+                    status = 'quarantined'
+                else:
+                    status = 'probing'
+                result[s.label] = {
+                    'status': status, 'requests': s.requests, 'failures': s.failures, 'in_flight': s.in_flight,
+                    'success_rate': round(s.success_ewma, 3),
+                    'latency_ms': round(s.latency_ewma * 1000) if s.latency_ewma is not None else None,
+                    'quarantined_seconds': max(round(s.quarantined_until - now, 1), 0) if s.quarantined_until else 0,
+                }
+            return result
+
+def proxy_mapping(proxy):
+    return {"http": proxy, "https": proxy} if proxy else None
+
+def proxy_at_fault(error, network_errors=(requests.RequestException,)):
+    """请求失败是否应记在代理头上：连接、超时类错误和 403/407/429 算代理的问题。"""
+    if isinstance(error, DownloadHTTPError):
+        return error.status_code in PROXY_FAULT_STATUS_CODES
+    return isinstance(error, network_errors + (ConnectionError, TimeoutError))
+
+class DownloadHTTPError(Exception):
+    """服务器返回了非预期的状态码。retry_after 为 Retry-After 头解析出的秒数。"""
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+def _raise_for_status(r):
+    raise DownloadHTTPError(r.status_code, parse_retry_after(r.headers.get("Retry-After")))
+
+def backoff_delay(attempt, retry_after=None, base=RETRY_BACKOFF_BASE, cap=RETRY_BACKOFF_CAP):
+    """指数退避（full jitter）；服务器给出 Retry-After 时优先使用。"""
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_CAP)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def _write_chunks(chunks, save_path, key=None, iv=None):
+    """
+    把数据块写入临时文件（可选边写边解密），完成后原子重命名，内存占用只与块大小相关。
+    """
+    tmp_path = save_path + ".tmp"
+    decryptor = AESStreamDecryptor(key, iv) if key and iv else None
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if decryptor:
+                    with phase("decrypt"):
+                        chunk = decryptor.update(chunk)
+                with phase("write"):
+                    f.write(chunk)
+            if decryptor:
+                with phase("decrypt"):
+                    chunk = decryptor.finish()
+                with phase("write"):
+                    f.write(chunk)
+        os.replace(tmp_path, save_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _iter_file(path, chunk_size=STREAM_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def _remove_files(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _range_validator(r):
+    # If-Range 只接受强 ETag，弱 ETag 时退回 Last-Modified
+    etag = r.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return r.headers.get("Last-Modified")
+
+def _download_resumable(http, url, save_path, headers, proxies, key, iv, chunk_size):
+    """
+    下载到 save_path.part，中断后用 Range + If-Range 从已有字节处续传。
+    服务器不支持 Range 或资源已变化时会返回 200，此时从头重新下载。
+    .part 里保存的是原始（未解密）字节，下载完成后再流式解密。
+    """
+    part_path = save_path + ".part"
+    meta_path = part_path + ".json"
+    offset = 0
+    validator = None
+    if os.path.exists(part_path) and os.path.exists(meta_path):
         try:
-            headers_json = headers_str.replace("'", '"')
-            headers_json = re.sub(r'([a-zA-Z0-9_]+):', r'"\1":', headers_json)
-            data = json.loads(headers_json)
-            headers = data.get("headers") or data.get("header") or data
-            referer = headers.get("Referer") or headers.get("referer")
-            origin = headers.get("Origin") or headers.get("origin")
+            with open(meta_path, "r", encoding="utf-8") as f:
+                validator = json.load(f).get("validator")
+            offset = os.path.getsize(part_path)
         except Exception:
+            offset = 0
+    req_headers = dict(headers)
+    # 续传按原始字节偏移计算，不能让服务器做内容压缩
+    req_headers["Accept-Encoding"] = "identity"
+    if offset and validator:
+        req_headers["Range"] = f"bytes={offset}-"
+        req_headers["If-Range"] = validator
+    with http.get(url, headers=req_headers, proxies=proxies, timeout=20, stream=True) as r:
+        if r.status_code == 206 and "Range" in req_headers:
+            m = CONTENT_RANGE_RE.match(r.headers.get("Content-Range", ""))
+            if not m or int(m.group(1)) != offset:
+                _remove_files(part_path, meta_path)
+                raise ValueError("Content-Range 与本地已下载长度不一致")
+            mode = "ab"
+        elif r.status_code == 200:
+            mode = "wb"
+            validator = _range_validator(r)
+            if validator and r.headers.get("Accept-Ranges", "").lower() != "none":
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"url": url, "validator": validator}, f)
+            else:
+                _remove_files(meta_path)
+        else:
+            if r.status_code == 416:
+                _remove_files(part_path, meta_path)
+            _raise_for_status(r)
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    with phase("write"):
+                        f.write(chunk)
+    if key and iv:
+        _write_chunks(_iter_file(part_path, chunk_size), save_path, key, iv)
+        _remove_files(part_path)
+    else:
+        os.replace(part_path, save_path)
+    _remove_files(meta_path)
+    return True
+
+class HostLimiter:
+    """
+    单个主机的自适应并发控制（AIMD）：请求成功且延迟正常时并发上限加性增长，
+    遇到 429/503 或网络错误时减半；Retry-After 会让该主机的所有请求暂停。
+    """
+    def __init__(self, initial, min_limit=1, max_limit=32):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.latency_ewma = None
+        self.min_latency = None
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def _try_acquire_locked(self):
+        """能放行时占用一个并发名额并返回 0，否则返回需要等待的秒数（None 表示等到有请求结束）。"""
+        wait = self.blocked_until - time.time()
+        if wait <= 0 and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return 0
+        return wait if wait > 0 else None
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire_locked()
+                if wait == 0:
+                    return
+                self._cond.wait(wait)
+
+    async def acquire_async(self):
+        """异步引擎使用的 acquire：在事件循环上等待，不占用线程。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                wait = self._try_acquire_locked()
+                if wait == 0:
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
             try:
-                import ast
-                data = ast.literal_eval(headers_str)
-                headers = data.get("headers") or data.get("header") or data
-                referer = headers.get("Referer") or headers.get("referer")
-                origin = headers.get("Origin") or headers.get("origin")
-            except Exception:
+                await asyncio.wait_for(waiter[1], wait)
+            except asyncio.TimeoutError:
                 pass
-    return url, referer, origin
+            finally:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
 
-def parse_txt_task_file(txt_path):
-    with open(txt_path, "r", encoding="utf-8") as f:
-        text = f.read()
-    raw_title = os.path.splitext(os.path.basename(txt_path))[0]
-    title = sanitize_filename(raw_title)
-    author = "未知作者"
-    m = re.search(r'作者[:：]\s*([^\n]+)', text)
-    if m:
-        author = m.group(1).strip()
-    global_referer = None
-    m = re.search(r'📌当前源站：[^⓪]*⓪(https?://[^\s]+)', text)
-    if m:
-        global_referer = m.group(1).strip()
-    image_tasks = []
-    chapter_title = "第1章"
-    for line in text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        if is_img_line(line):
-            url, referer, origin = parse_img_src(line)
-            headers = {}
-            if referer:
-                headers['Referer'] = referer
-            if origin:
-                headers['Origin'] = origin
-            image_tasks.append((url, headers, chapter_title))
-        else:
-            chapter_title = sanitize_filename(line)
-    return title, author, global_referer, image_tasks
+    def release(self, ok, latency, throttled=False, retry_after=None):
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            if ok:
+                self.latency_ewma = latency if self.latency_ewma is None else self.latency_ewma * 0.8 + latency * 0.2
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                # 延迟明显高于基线时说明主机已经吃力，保持当前并发不再增长
+                if self.latency_ewma <= self.min_latency * HOST_LATENCY_FACTOR + 0.05:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.errors += 1
+                if throttled:
+                    self.throttled += 1
+                self.limit = max(self.min_limit, self.limit / 2)
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, time.time() + min(retry_after, RETRY_AFTER_CAP))
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, future)
 
-def parse_json_task_file(json_path):
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    raw_title = data.get("title") or os.path.splitext(os.path.basename(json_path))[0]
-    title = sanitize_filename(raw_title)
-    author = data.get("author", "未知作者")
-    global_referer = data.get("referer")
-    image_tasks = []
-    for chapter in data.get("chapters", []):
-        raw_chapter_title = chapter.get("title", "第1章")
-        chapter_title = sanitize_filename(raw_chapter_title)
-        for img in chapter.get("images", []):
-            url = img.get("url")
-            headers = img.get("headers", {})
-            image_tasks.append((url, headers, chapter_title))
-    return title, author, global_referer, image_tasks
-
-def download_image(url, save_path, headers, proxies=None, retry=3, aes_key=None, aes_iv=None):
+    def stats(self):
+        with self._cond:
+            return {
+                'concurrency': int(self.limit), 'in_flight': self.in_flight,
+                'requests': self.requests, 'errors': self.errors, 'throttled': self.throttled,
+                'error_rate': round(self.errors / self.requests, 3) if self.requests else 0,
+                'latency_ms': round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+                'paused_seconds': max(round(self.blocked_until - time.time(), 1), 0),
+            }
+
+def _resolve_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+class AdaptiveScheduler:
+    """按主机分配 HostLimiter，在 [1, max_concurrency] 范围内调节每个主机的并发请求数。"""
+    def __init__(self, initial_concurrency, max_concurrency):
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, url):
+        netloc = urlsplit(url).netloc
+        with self._lock:
+            limiter = self._hosts.get(netloc)
+            if limiter is None:
+                limiter = HostLimiter(self.initial_concurrency, max_limit=self.max_concurrency)
+                self._hosts[netloc] = limiter
+            return limiter
+
+    def stats(self):
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {netloc: limiter.stats() for netloc, limiter in hosts.items()}
+
+def download_image(url, save_path, headers, proxies=None, retry=3, aes_key=None, aes_iv=None, session=None,
+                   stream=False, chunk_size=STREAM_CHUNK_SIZE, resume=False, scheduler=None, slots=None,
+                   proxy_pool=None):
+    """传入 proxy_pool 时每次尝试都从代理池重新选择代理（重试避开上一次的代理），并把结果报告给代理池。"""
+    http = session or requests
+    key, iv = parse_aes_key_iv(aes_key, aes_iv)
+    limiter = scheduler.host(url) if scheduler else None
+    host = urlsplit(url).netloc
+    proxy = None
+    last_error = None
     for i in range(retry):
+        if limiter:
+            limiter.acquire()
+        # 全局槽位在主机限流之后获取，等待主机放行时不占用其他任务的份额
+        if slots:
+            slots.acquire()
+        if proxy_pool:
+            proxy = proxy_pool.choose(exclude=proxy)
+            proxies = proxy_mapping(proxy)
+            http = proxy_pool.session(url, proxy) or session or requests
+        start = time.time()
+        ok = False
+        error = None
+        retry_after = None
+        throttled = False
+        ACTIVE_DOWNLOADS.inc()
         try:
-            r = requests.get(url, headers=headers, proxies=proxies, timeout=20)
-            if r.status_code == 200:
-                data = r.content
-                if aes_key and aes_iv:
-                    key = bytes.fromhex(aes_key) if len(aes_key) in (32, 48, 64) else aes_key.encode('utf-8')
-                    iv = bytes.fromhex(aes_iv) if len(aes_iv) == 32 else aes_iv.encode('utf-8')
-                    data = aes_decrypt(data, key, iv)
-                with open(save_path, "wb") as f:
-                    f.write(data)
-                return True
+            with phase("download"):
+                if resume:
+                    _download_resumable(http, url, save_path, headers, proxies, key, iv, chunk_size)
+                elif stream:
+                    with http.get(url, headers=headers, proxies=proxies, timeout=20, stream=True) as r:
+                        if r.status_code != 200:
+                            _raise_for_status(r)
+                        _write_chunks(r.iter_content(chunk_size=chunk_size), save_path, key, iv)
+                else:
+                    r = http.get(url, headers=headers, proxies=proxies, timeout=20)
+                    if r.status_code != 200:
+                        _raise_for_status(r)
+                    data = r.content
+                    if key and iv:
+                        with phase("decrypt"):
+                            data = aes_decrypt(data, key, iv)
+                    _write_chunks([data], save_path)
+            ok = True
+            BYTES.inc(os.path.getsize(save_path))
+            return True
+        except DownloadHTTPError as e:
+            last_error = error = e
+            retry_after = e.retry_after
+            throttled = e.status_code in THROTTLE_STATUS_CODES
         except Exception as e:
-            if i == retry - 1:
-                raise
+            last_error = error = e
+        finally:
+            elapsed = time.time() - start
+            ACTIVE_DOWNLOADS.dec()
+            REQUEST_SECONDS.observe(elapsed, host=host)
+            if proxy_pool:
+                proxy_pool.report(proxy, ok or not proxy_at_fault(error), elapsed if ok else None)
+            if slots:
+                slots.release()
+            if limiter:
+                limiter.release(ok, elapsed, throttled, retry_after)
+        if i < retry - 1:
+            HTTP_RETRIES.inc(host=host)
+            time.sleep(backoff_delay(i, retry_after))
+    if last_error:
+        raise last_error
+    # retry <= 0 时一次都没有尝试，与旧版一样返回 False
     return False
 
+REDIS_DOWNLOADED_URL_KEY_PREFIX = "comic_downloader:url:"
+REDIS_DOWNLOADED_URL_TTL = 90*24*60*60
+REDIS_BATCH_SIZE = 500
+
+def url_cache_key(url):
+    """URL 去重键使用定长哈希，而不是原始 URL，节省 Redis 内存。"""
+    return REDIS_DOWNLOADED_URL_KEY_PREFIX + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def lookup_url_hashes(redis_client, urls, batch_size=REDIS_BATCH_SIZE):
+    """
+    用 pipeline 批量查询 URL 对应的图片内容哈希，返回 {url: 内容哈希}。
+    旧版本只记录了“已下载”标记、没有内容哈希的 URL 不在结果中，需要重新下载才能补全书籍。
+    """
+    hashes = {}
+    if not redis_client:
+        return hashes
+    urls = list(dict.fromkeys(urls))
+    for start in range(0, len(urls), batch_size):
+        batch = urls[start:start + batch_size]
+        pipe = redis_client.pipeline(transaction=False)
+        for url in batch:
+            pipe.get(url_cache_key(url))
+        with redis_timer("url_lookup"):
+            values = pipe.execute()
+        for url, value in zip(batch, values):
+            if is_content_hash(value):
+                hashes[url] = value
+    return hashes
+
+class DownloadedUrlBuffer:
+    """
+    缓存“已下载”标记，攒够一批后用 pipeline 一次性写入 Redis。
+    """
+    def __init__(self, redis_client, batch_size=REDIS_BATCH_SIZE, ttl=REDIS_DOWNLOADED_URL_TTL):
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, url, digest=None):
+        """digest 为图片的内容哈希，之后其他书籍遇到同一 URL 时直接从图片仓库链接。"""
+        if not self.redis_client:
+            return
+        with self._lock:
+            self._pending.append((url, digest))
+            if len(self._pending) < self.batch_size:
+                return
+            batch, self._pending = self._pending, []
+        self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for url, digest in batch:
+            pipe.set(url_cache_key(url), digest or "1", ex=self.ttl)
+        with redis_timer("url_write"):
+            pipe.execute()
+
+class CompletionManifest:
+    """
+    用 Redis 位图记录每张图片（按任务文件中的序号）是否已完成，
+    写入先在内存中缓冲，每隔 flush_interval 秒或攒够 batch_size 条批量提交。
+    """
+    def __init__(self, redis_client, key, flush_interval=1.0, batch_size=200, ttl=REDIS_DOWNLOADED_URL_TTL):
+        self.redis_client = redis_client if key else None
+        self.key = key
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self._pending = []
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def load(self, total, batch_size=REDIS_BATCH_SIZE):
+        """返回已完成的序号集合。"""
+        done = set()
+        for start in range(0, total, batch_size):
+            done |= self.completed(range(start, min(start + batch_size, total)))
+        return done
+
+    def completed(self, indices):
+        """用一次 pipeline 查询给定序号中哪些已完成。"""
+        done = set()
+        if not self.redis_client:
+            return done
+        pipe = self.redis_client.pipeline(transaction=False)
+        for idx in indices:
+            pipe.getbit(self.key, idx)
+        with redis_timer("manifest_read"):
+            bits = pipe.execute()
+        for idx, bit in zip(indices, bits):
+            if bit:
+                done.add(idx)
+        return done
+
+    def add(self, idx):
+        if not self.redis_client:
+            return
+        with self._lock:
+            self._pending.append(idx)
+            if len(self._pending) < self.batch_size and time.time() - self._last_flush < self.flush_interval:
+                return
+            batch, self._pending = self._pending, []
+            self._last_flush = time.time()
+        self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._last_flush = time.time()
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for idx in batch:
+            pipe.setbit(self.key, idx, 1)
+        pipe.expire(self.key, self.ttl)
+        with redis_timer("manifest_write"):
+            pipe.execute()
+
+class TaskSuspended(Exception):
+    """任务被暂停：下载线程不再阻塞等待，而是退出并让出槽位，恢复时按完成位图继续。"""
+
 class DownloadController:
     def __init__(self):
         self._pause_event = threading.Event()
@@ -153,121 +955,475 @@ class DownloadController:
     def stop(self): self._stop_event.set()
     def check(self):
         if self._stop_event.is_set(): raise Exception("任务被终止")
-        self._pause_event.wait()
+        if not self._pause_event.is_set(): raise TaskSuspended("任务已暂停")
+    def is_paused(self): return not self._pause_event.is_set()
+    def is_stopped(self): return self._stop_event.is_set()
+
+REDIS_CONTROL_KEY_PREFIX = "comic_downloader:control:"
+# 控制状态的本地缓存时间，避免每张图片都访问一次 Redis
+CONTROL_CACHE_TTL = 0.5
+CONTROL_STATE_TTL = 7*24*60*60
+
+class RedisDownloadController:
+    """
+    与 DownloadController 接口相同，但暂停/继续/终止状态保存在 Redis 中，
+    同一任务在任意 Web 进程或分布式下载进程里都看到同一个状态。
+    """
+    def __init__(self, redis_client, task_id, cache_ttl=CONTROL_CACHE_TTL):
+        self.redis_client = redis_client
+        self.task_id = task_id
+        self.key = REDIS_CONTROL_KEY_PREFIX + task_id
+        self.cache_ttl = cache_ttl
+        self._state = None
+        self._checked_at = 0
+
+    def _set(self, state):
+        self.redis_client.set(self.key, state, ex=CONTROL_STATE_TTL)
+        self._state = state
+        self._checked_at = time.time()
+
+    def state(self):
+        now = time.time()
+        if now - self._checked_at >= self.cache_ttl:
+            try:
+                self._state = self.redis_client.get(self.key)
+            except Exception:
+                pass  # Redis 短暂不可用时沿用上一次的状态
+            self._checked_at = now
+        return self._state or 'run'
+
+    def pause(self): self._set('pause')
+    def resume(self): self._set('run')
+    def stop(self): self._set('stop')
+    def check(self):
+        state = self.state()
+        if state == 'stop': raise Exception("任务被终止")
+        if state == 'pause': raise TaskSuspended("任务已暂停")
+    def is_paused(self): return self.state() == 'pause'
+    def is_stopped(self): return self.state() == 'stop'
+
+def image_filename(idx, url):
+    ext = os.path.splitext(url)[1].split("?")[0]
+    if not ext or len(ext) > 6:
+        ext = ".jpg"
+    return f"{idx+1:04d}{ext}"
+
+def build_image_headers(headers, headers_img, global_referer=None, custom_referer=None):
+    h = dict(headers)
+    h.update(headers_img)
+    if 'Referer' not in h and 'referer' not in h:
+        if global_referer:
+            h['Referer'] = global_referer
+        elif custom_referer:
+            h['Referer'] = custom_referer
+    return h
+
+PACK_MODES = ('after', 'stream', 'direct')
+COMIC_INFO_NAME = "ComicInfo.xml"
+# 打包时跳过下载过程中的临时文件
+PACK_SKIP_SUFFIXES = ('.part', '.tmp', '.part.json')
+
+def build_comic_info(title, author=None, page_count=0):
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<ComicInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">',
+        f'  <Title>{escape(title)}</Title>',
+        f'  <Series>{escape(title)}</Series>',
+    ]
+    if author:
+        lines.append(f'  <Writer>{escape(author)}</Writer>')
+    lines.append(f'  <PageCount>{page_count}</PageCount>')
+    lines.append('</ComicInfo>')
+    return "\n".join(lines) + "\n"
+
+def archive_sort_key(arcname):
+    # 图片按全局序号命名（0001.jpg），按序号排序即为阅读顺序；ComicInfo.xml 放最前
+    if arcname == COMIC_INFO_NAME:
+        return (0, 0, arcname)
+    stem = os.path.splitext(os.path.basename(arcname))[0]
+    if stem.isdigit():
+        return (1, int(stem), arcname)
+    return (2, 0, arcname)
+
+def _entry_sort_key(info):
+    return archive_sort_key(info.filename)
+
+class StreamingCBZPacker:
+    """
+    边下载边打包：图片下载完成后交给后台线程，以 ZIP_STORED 追加进 CBZ。
+    数据区按完成先后写入，关闭时把中央目录按阅读顺序排序，阅读器看到的页序与任务文件一致。
+    remove_source=True 时追加后立即删除源文件，磁盘上不保留散图。
+    """
+    def __init__(self, cbz_path, title, author=None):
+        self.cbz_path = cbz_path
+        self.title = title
+        self.author = author
+        self._tmp_path = cbz_path + ".tmp"
+        self._zf = zipfile.ZipFile(self._tmp_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._queue = queue.Queue()
+        self._names = set()
+        self.errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True, name="cbz-packer")
+        self._thread.start()
+
+    def add(self, src_path, arcname, remove_source=False):
+        self._queue.put((src_path, arcname.replace(os.sep, "/"), remove_source))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            src_path, arcname, remove_source = item
+            try:
+                # 重试轮次或恢复任务可能重复提交同一张图片
+                if arcname not in self._names:
+                    with phase("pack"):
+                        self._zf.write(src_path, arcname)
+                    self._names.add(arcname)
+                if remove_source:
+                    os.remove(src_path)
+            except Exception as e:
+                self.errors.append(f"{arcname}: {e}")
+
+    @property
+    def page_count(self):
+        return len(self._names)
+
+    def close(self):
+        """写入 ComicInfo.xml 和排序后的中央目录，返回写入的图片数量。"""
+        self._queue.put(None)
+        self._thread.join()
+        with phase("pack"):
+            self._zf.writestr(COMIC_INFO_NAME, build_comic_info(self.title, self.author, self.page_count))
+            self._zf.filelist.sort(key=_entry_sort_key)
+            self._zf.close()
+        os.replace(self._tmp_path, self.cbz_path)
+        return self.page_count
+
+    def abort(self):
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._zf.close()
+        finally:
+            _remove_files(self._tmp_path)
+
+def pack_book(output_folder, title, book_dir, delete_after_pack=False, author=None):
+    final_archive_name = f"{title}.cbz"
+    packer = StreamingCBZPacker(os.path.join(output_folder, final_archive_name), title, author)
+    try:
+        for root, dirs, files in os.walk(book_dir):
+            for name in files:
+                if name.endswith(PACK_SKIP_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                packer.add(path, os.path.relpath(path, book_dir))
+    except BaseException:
+        packer.abort()
+        raise
+    packer.close()
+    if delete_after_pack:
+        shutil.rmtree(book_dir)
+    return final_archive_name
+
+def open_book_packer(output_folder, title, author, book_dir, pack_after_download, pack_mode):
+    """
+    按打包模式准备输出位置，返回 (packer, direct, work_dir)：
+    'after' 下载完成后整体打包；'stream' 边下边打包并保留散图；
+    'direct' 图片只在临时目录停留到写入 CBZ 为止，不保留散图。
+    """
+    if not pack_after_download or pack_mode not in ('stream', 'direct'):
+        os.makedirs(book_dir, exist_ok=True)
+        return None, False, book_dir
+    os.makedirs(output_folder, exist_ok=True)
+    packer = StreamingCBZPacker(os.path.join(output_folder, f"{title}.cbz"), title, author)
+    if pack_mode == 'direct':
+        return packer, True, os.path.join(output_folder, f".{title}.spool")
+    os.makedirs(book_dir, exist_ok=True)
+    return packer, False, book_dir
+
+# 解析线程最多领先下载 并发数×该倍数 张图片
+SUBMIT_AHEAD_FACTOR = 4
+
+def iter_pending_batches(task_file, manifest, redis_client, progress_callback, total,
+                         direct=False, download_controller=None, batch_size=REDIS_BATCH_SIZE,
+                         blob_store=None, work_dir=None):
+    """
+    边解析任务文件边筛选：每攒够 batch_size 张图片，用 pipeline 查询一次完成位图和 URL 对应的内容哈希，
+    产出 (待下载列表, 已跳过列表)，元素均为 (idx, url, headers_img, chapter_title)。
+    其他书籍下载过的 URL 会从图片仓库链接到 work_dir 再跳过，保证跳过的图片也在书里。
+    total[0] 随解析进度增长，解析结束时即为图片总数。
+    """
+    if direct:
+        # 直接打包模式不保留散图，之前的完成记录对应的文件已不存在，只能从图片仓库补全
+        progress_callback(0, 0, "直接打包模式不保留散图，仓库中没有的图片将重新下载")
+    redis_ok = [True]
+
+    def split(batch):
+        if not redis_ok[0]:
+            return batch, []
+        try:
+            completed = set() if direct else manifest.completed([item[0] for item in batch])
+            url_hashes = lookup_url_hashes(redis_client, [item[1] for item in batch]) if blob_store else {}
+        except Exception as e:
+            redis_ok[0] = False
+            progress_callback(0, total[0], f"查询Redis下载记录失败，将全部下载: {e}")
+            return batch, []
+        pending, skipped = [], []
+        for item in batch:
+            idx, url, _, chapter_title = item
+            if idx in completed:
+                skipped.append(item)
+                continue
+            digest = url_hashes.get(url)
+            dest = os.path.join(work_dir, chapter_title, image_filename(idx, url)) if work_dir else None
+            try:
+                linked = bool(digest and dest and blob_store.materialize(digest, dest))
+            except OSError as e:
+                # 仓库文件可能刚被清理回收，或链接失败，重新下载这张图片即可
+                progress_callback(0, total[0], f"从图片仓库链接失败，将重新下载: {chapter_title}/{os.path.basename(dest)} {e}")
+                linked = False
+            (skipped if linked else pending).append(item)
+        return pending, skipped
+
+    batch = []
+    # 解析耗时按批统计，不包含查询 Redis 和生成器挂起等待下载的时间
+    started = time.perf_counter()
+    for idx, (url, headers_img, chapter_title) in enumerate(task_file):
+        if download_controller and (download_controller.is_stopped() or download_controller.is_paused()):
+            return
+        total[0] = idx + 1
+        batch.append((idx, url, headers_img, chapter_title))
+        if len(batch) >= batch_size:
+            record_phase("parse", time.perf_counter() - started)
+            yield split(batch)
+            batch = []
+            started = time.perf_counter()
+    record_phase("parse", time.perf_counter() - started)
+    if batch:
+        yield split(batch)
+
+def find_existing_image(save_path, postprocessor=None):
+    """
+    返回 (本地已有的文件路径, 是否为未处理的原图)，没有时路径为 None。
+    开启转码时，上次运行可能已把原图替换成了新扩展名的文件。
+    """
+    if os.path.exists(save_path) and os.path.getsize(save_path) >= MIN_EXISTING_IMAGE_SIZE:
+        return save_path, True
+    return find_processed(save_path, postprocessor.options if postprocessor else None), False
+
+def deliver_image(path, arcname, packer, postprocessor=None, remove_source=False, original=True):
+    """原图先交给后处理阶段，处理完由它加入打包器；未开启后处理或已处理过的图片直接加入打包器。"""
+    if postprocessor and original:
+        postprocessor.submit(path, arcname)
+    elif packer:
+        packer.add(path, arcname, remove_source=remove_source)
+
+def pack_existing_images(packer, book_dir, items, remove_source=False, postprocessor=None):
+    """恢复任务或从图片仓库链接出的图片，同样要经过后处理并写进边下边打包的 CBZ。"""
+    for idx, url, _, chapter_title in items:
+        path = os.path.join(book_dir, chapter_title, image_filename(idx, url))
+        path, original = find_existing_image(path, postprocessor)
+        if path:
+            deliver_image(path, f"{chapter_title}/{os.path.basename(path)}", packer, postprocessor,
+                          remove_source, original)
+
+def abort_book(packer=None, postprocessor=None):
+    """放弃未完成的 CBZ；后处理阶段先停，它可能还在往打包器里写。"""
+    if postprocessor:
+        postprocessor.abort()
+    if packer:
+        packer.abort()
+
+def raise_if_interrupted(download_controller, packer=None, postprocessor=None):
+    """任务被暂停或终止时放弃未完成的 CBZ 并抛出异常，跳过后续重试和打包。"""
+    if download_controller and (download_controller.is_stopped() or download_controller.is_paused()):
+        abort_book(packer, postprocessor)
+        download_controller.check()
+
+def close_postprocessor(postprocessor, progress_callback, total):
+    """打包前等待后处理阶段清空，返回统计（未开启时为 None）。"""
+    if not postprocessor:
+        return None
+    stats = postprocessor.close()
+    for error in postprocessor.errors:
+        progress_callback(total, total, f"图片后处理失败，保留原图: {error}")
+    progress_callback(total, total, format_postprocess_summary(stats))
+    return stats
+
+def finish_book_packing(packer, direct, work_dir, output_folder, title, author, book_dir, total,
+                        pack_after_download, delete_after_pack, progress_callback):
+    final_archive_name = f"{title}.cbz"
+    if packer:
+        pages = packer.close()
+        for error in packer.errors:
+            progress_callback(total, total, f"写入CBZ失败: {error}")
+        progress_callback(total, total, f"边下边打包完成，共{pages}张")
+        if direct:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif delete_after_pack:
+            shutil.rmtree(book_dir)
+    elif pack_after_download and os.path.exists(book_dir):
+        pack_book(output_folder, title, book_dir, delete_after_pack, author=author)
+    return final_archive_name
 
 def process_task_file_with_progress(
     task_path, output_folder, headers, progress_callback, proxy_list=None,
     pack_after_download=True, delete_after_pack=False, aes_key=None, aes_iv=None,
     max_workers=4, download_controller=None, custom_referer=None,
-    redis_client=None
+    redis_client=None, pool_size=None, stream_download=False, manifest_key=None,
+    resume_download=False, max_concurrency=None, status_callback=None, pack_mode='after',
+    download_slots=None, profiler=None, postprocess=None
 ):
-    if task_path.lower().endswith(".json"):
-        title, author, global_referer, image_tasks = parse_json_task_file(task_path)
-    else:
-        title, author, global_referer, image_tasks = parse_txt_task_file(task_path)
+    task_file = open_task_file(task_path)
+    title, author, global_referer = task_file.title, task_file.author, task_file.global_referer
     book_dir = os.path.join(output_folder, title)
-    os.makedirs(book_dir, exist_ok=True)
-    total = len(image_tasks)
-    progress_callback(0, total, f"开始下载，共{total}张图片")
+    # 任务文件边解析边下载，total[0] 随解析进度增长
+    total = [0]
+    progress_callback(0, 0, "开始下载，边解析任务文件边下载")
+    packer, direct, work_dir = open_book_packer(output_folder, title, author, book_dir, pack_after_download, pack_mode)
+    # 可选的后处理阶段：转码/缩放在进程池里进行，结果直接进入打包器
+    postprocessor = open_postprocessor(postprocess, packer, direct, progress_callback)
     lock = threading.Lock()
     finished = [0]
     failed = []
+    # max_workers 是每个主机的初始并发，按主机的延迟和错误率在 [1, max_concurrency] 之间调节
+    max_concurrency = max(max_concurrency or max_workers, max_workers)
+    scheduler = AdaptiveScheduler(max_workers, max_concurrency)
+    session_pool = SessionPool(pool_size=pool_size or max_concurrency)
+    # 按成功率和延迟选择代理，失败的代理会被隔离
+    proxy_pool = ProxyPool(proxy_list, session_pool) if proxy_list else None
+    last_status_report = [0]
 
-    REDIS_DOWNLOADED_URL_KEY_PREFIX = "comic_downloader:url:"
-
-    def is_url_already_downloaded(url):
-        if not redis_client:
-            return False
-        return redis_client.exists(f"{REDIS_DOWNLOADED_URL_KEY_PREFIX}{url}")
-
-    def mark_url_as_downloaded(url):
-        if not redis_client:
+    def report_status(force=False):
+        if not status_callback:
+            return
+        now = time.time()
+        if not force and now - last_status_report[0] < STATUS_REPORT_INTERVAL:
             return
-        redis_client.set(f"{REDIS_DOWNLOADED_URL_KEY_PREFIX}{url}", "1", ex=90*24*60*60)
+        last_status_report[0] = now
+        fields = {'hosts': scheduler.stats()}
+        if proxy_pool:
+            fields['proxies'] = proxy_pool.stats()
+        if postprocessor:
+            fields['postprocess'] = postprocessor.summary()
+        status_callback(fields)
+    # 密钥和IV每个任务只解析一次
+    aes_key, aes_iv = parse_aes_key_iv(aes_key, aes_iv)
 
+    downloaded_buffer = DownloadedUrlBuffer(redis_client)
+    # 按内容哈希存放图片的仓库，跨书籍去重
+    blob_store = BlobStore(os.path.join(output_folder, BLOB_DIR_NAME))
+    # 断点续传：已完成的图片序号记录在位图里，恢复任务时只下载剩余部分
+    manifest = CompletionManifest(redis_client, manifest_key)
 
     def download_one(idx, url, headers_img, chapter_title):
         if download_controller:
             download_controller.check()
 
-        if is_url_already_downloaded(url):
-            with lock:
-                finished[0] += 1
-                progress_callback(finished[0], total, f"Redis记录已下载，跳过URL: {url[:50]}...")
-            return
-
-        chapter_dir = os.path.join(book_dir, chapter_title)
+        chapter_dir = os.path.join(work_dir, chapter_title)
         os.makedirs(chapter_dir, exist_ok=True)
         
-        ext = os.path.splitext(url)[1].split("?")[0]
-        if not ext or len(ext) > 6:
-            ext = ".jpg"
-        filename = f"{idx+1:04d}{ext}"
+        filename = image_filename(idx, url)
         save_path = os.path.join(chapter_dir, filename)
-        
-        h = dict(headers)
-        h.update(headers_img)
-        if 'Referer' not in h and 'referer' not in h:
-            if global_referer:
-                h['Referer'] = global_referer
-            elif custom_referer:
-                h['Referer'] = custom_referer
-
-        proxies = None
-        if proxy_list:
-            import random
-            proxy = random.choice(proxy_list)
-            proxies = {"http": proxy, "https": proxy}
+
+        existing, original = find_existing_image(save_path, postprocessor)
         try:
-            download_image(url, save_path, h, proxies, aes_key=aes_key, aes_iv=aes_iv)
-            
-            mark_url_as_downloaded(url)
+            # 已存在的文件入库或写 Redis 出错时与下载失败一样只记这一张失败，不中止整个任务
+            if existing:
+                if original:
+                    downloaded_buffer.add(url, blob_store.try_ingest(save_path))
+                deliver_image(existing, f"{chapter_title}/{os.path.basename(existing)}", packer, postprocessor,
+                              direct, original)
+                manifest.add(idx)
+                with lock:
+                    finished[0] += 1
+                    progress_callback(finished[0], total[0], f"本地文件已存在，跳过: {chapter_title}/{filename}")
+                IMAGES.inc(engine='thread', result='existing')
+                return
+
+            h = build_image_headers(headers, headers_img, global_referer, custom_referer)
+            # 使用代理时由代理池按代理分配会话，每次尝试各自选择
+            session = None if proxy_pool else session_pool.get(url)
+            download_image(url, save_path, h, aes_key=aes_key, aes_iv=aes_iv, session=session,
+                           stream=stream_download, resume=resume_download, scheduler=scheduler,
+                           slots=download_slots, proxy_pool=proxy_pool)
+            digest = blob_store.try_ingest(save_path)
+            deliver_image(save_path, f"{chapter_title}/{filename}", packer, postprocessor, direct)
+            downloaded_buffer.add(url, digest)
+            manifest.add(idx)
 
             with lock:
                 finished[0] += 1
-                progress_callback(finished[0], total, f"下载成功: {chapter_title}/{filename}")
+                progress_callback(finished[0], total[0], f"下载成功: {chapter_title}/{filename}")
+            IMAGES.inc(engine='thread', result='downloaded')
         except Exception as e:
             with lock:
                 finished[0] += 1
                 failed.append((idx, url, headers_img, chapter_title))
-                progress_callback(finished[0], total, f"下载失败: {chapter_title}/{filename} {e}")
+                progress_callback(finished[0], total[0], f"下载失败: {chapter_title}/{filename} {e}")
+            IMAGES.inc(engine='thread', result='failed')
+        report_status()
 
-    with ThreadPoolExecutor(max_workers=max_workers) as pool:
-        futures = []
-        for idx, (url, headers_img, chapter_title) in enumerate(image_tasks):
-            futures.append(pool.submit(download_one, idx, url, headers_img, chapter_title))
-        for f in as_completed(futures):
-            pass
+    def run_round(batches):
+        # 待执行的图片数有上限，解析不会远远领先下载，内存占用与任务文件大小无关
+        slots = threading.BoundedSemaphore(max_concurrency * SUBMIT_AHEAD_FACTOR)
+
+        def run_one(item):
+            QUEUED_IMAGES.dec(engine='thread')
+            try:
+                # 开启性能分析时，每个工作线程各自采样
+                with profiler.thread() if profiler else contextlib.nullcontext():
+                    download_one(*item)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            for pending, skipped in batches:
+                if skipped:
+                    if packer or postprocessor:
+                        pack_existing_images(packer, work_dir, skipped, direct, postprocessor)
+                    with lock:
+                        finished[0] += len(skipped)
+                        progress_callback(finished[0], total[0], f"已下载过，跳过{len(skipped)}张")
+                    IMAGES.inc(len(skipped), engine='thread', result='skipped')
+                for item in pending:
+                    slots.acquire()
+                    QUEUED_IMAGES.inc(engine='thread')
+                    pool.submit(run_one, item)
+        downloaded_buffer.flush()
+        manifest.flush()
+
+    # 每批图片先用 pipeline 查询完成位图和 URL 的内容哈希，仓库里已有的直接链接，只提交其余的
+    run_round(iter_pending_batches(task_file, manifest, redis_client, progress_callback, total,
+                                   direct, download_controller, blob_store=blob_store, work_dir=work_dir))
+    raise_if_interrupted(download_controller, packer, postprocessor)
+    progress_callback(finished[0], total[0], f"任务文件解析完成，共{total[0]}张图片")
 
     max_retry_round = 3
     retry_round = 1
     while failed and retry_round <= max_retry_round:
         retry_failed = list(failed)
         failed.clear()
-        progress_callback(finished[0], total, f"第{retry_round}轮重试，剩余{len(retry_failed)}张")
-        with ThreadPoolExecutor(max_workers=max_workers) as pool:
-            futures = []
-            for idx, url, headers_img, chapter_title in retry_failed:
-                futures.append(pool.submit(download_one, idx, url, headers_img, chapter_title))
-            for f in as_completed(futures):
-                pass
+        progress_callback(finished[0], total[0], f"第{retry_round}轮重试，剩余{len(retry_failed)}张")
+        RETRY_ROUND_IMAGES.inc(len(retry_failed), round=retry_round)
+        run_round([(retry_failed, [])])
+        raise_if_interrupted(download_controller, packer, postprocessor)
         retry_round += 1
 
-    final_archive_name = f"{title}.cbz"
-    if pack_after_download and os.path.exists(book_dir):
-        import shutil
-        archive_base_path = os.path.join(output_folder, title)
-        if os.path.exists(archive_base_path + ".zip"):
-            os.remove(archive_base_path + ".zip")
-        created_zip_file = shutil.make_archive(archive_base_path, 'zip', book_dir)
-        final_cbz_path = os.path.join(output_folder, final_archive_name)
-        if os.path.exists(final_cbz_path):
-            os.remove(final_cbz_path)
-        os.rename(created_zip_file, final_cbz_path)
-        if delete_after_pack:
-            shutil.rmtree(book_dir)
-            
-    progress_callback(total, total, f"全部完成，失败{len(failed)}张")
-    return [{"zip": final_archive_name, "failed": [x[1] for x in failed]}]
+    connection_stats = session_pool.stats()
+    session_pool.close()
+    postprocess_stats = close_postprocessor(postprocessor, progress_callback, total[0])
+    report_status(force=True)
+    progress_callback(finished[0], total[0], f"连接统计: 新建{connection_stats['new_connections']}个，复用{connection_stats['reused_connections']}次")
+
+    final_archive_name = finish_book_packing(packer, direct, work_dir, output_folder, title, author, book_dir,
+                                             total[0], pack_after_download, delete_after_pack, progress_callback)
+
+    progress_callback(total[0], total[0], f"全部完成，失败{len(failed)}张")
+    return [{"zip": final_archive_name, "book": title, "failed": [x[1] for x in failed], "connections": connection_stats,
+             "hosts": scheduler.stats(), "proxies": proxy_pool.stats() if proxy_pool else None,
+             "postprocess": postprocess_stats}]
 
 # --- END OF FILE downloader.py ---
@@ -0,0 +1,303 @@
+# --- START OF FILE housekeeping.py ---
+
+"""
+输出目录的后台清理。维护一份增量更新的使用索引，记录输出目录顶层每个条目（书籍目录、CBZ 等）的
+大小、最后访问时间和所属任务：每轮只列出顶层条目，新出现的、mtime 变化的或被任务写过的条目才重新统计大小，
+上万个文件时清理的开销也很小。超过保留天数的条目被删除；总大小超过配额时按最近最少使用的顺序删除。
+正在运行的任务和等待上传的文件由调用方传入的判断函数保护，不会被删除。
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+
+from blob_store import BlobStore, BLOB_DIR_NAME
+
+USAGE_INDEX_NAME = ".usage_index.json"
+HOUSEKEEPING_INTERVAL = 600
+# 超过配额时删除到配额的该比例为止，避免每轮都只删掉一点
+QUOTA_LOW_WATERMARK = 0.9
+
+def book_artifact_names(title):
+    """一本书在输出目录顶层可能产生的条目：散图目录、CBZ、打包中的临时文件和直接打包的暂存目录。"""
+    return [title, f"{title}.cbz", f"{title}.cbz.tmp", f".{title}.spool"]
+
+def tree_size(path):
+    """返回目录下所有文件的 (总字节数, 文件数)。同一张图片以硬链接出现在多本书里时每本书各算一次。"""
+    total, count = 0, 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                            count += 1
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total, count
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+class UsageIndex:
+    """
+    输出目录顶层条目的使用索引，保存在 <root>/.usage_index.json。
+    entries: {名称: {'size', 'files', 'mtime', 'last_access'}}，owners: {名称: 任务ID}，
+    dirty 为任务写入过、下次 refresh 需要重新统计大小的条目。
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, USAGE_INDEX_NAME)
+        self.entries = {}
+        self.owners = {}
+        self.dirty = set()
+        self._changed = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+            self.owners = data.get('owners', {})
+            self.dirty = set(data.get('dirty', []))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # 索引损坏时从头重建，只是第一轮需要统计所有条目
+            print(f"读取使用索引失败，将重新建立: {e}")
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            data = {'entries': self.entries, 'owners': self.owners, 'dirty': sorted(self.dirty)}
+            self._changed = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def claim(self, names, task_id):
+        """任务开始写入这些条目：记录所属任务，并在任务结束前一直视为活跃。"""
+        now = time.time()
+        with self._lock:
+            for name in names:
+                self.owners[name] = task_id
+                self.dirty.add(name)
+                if name in self.entries:
+                    self.entries[name]['last_access'] = now
+            self._changed = True
+
+    def release(self, task_id):
+        """任务结束：它写过的条目在下一轮重新统计大小，最后访问时间记为现在。"""
+        now = time.time()
+        with self._lock:
+            for name in self._owned_by({task_id}):
+                self.dirty.add(name)
+                if name in self.entries:
+                    self.entries[name]['last_access'] = now
+            self._changed = True
+
+    def touch(self, name):
+        """条目被读取（例如通过 /download 下载）时更新最后访问时间。"""
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry:
+                entry['last_access'] = time.time()
+                self._changed = True
+
+    def owner(self, name):
+        with self._lock:
+            return self.owners.get(name)
+
+    def names_owned_by(self, task_ids):
+        with self._lock:
+            return self._owned_by(set(task_ids))
+
+    def _owned_by(self, task_ids):
+        return {name for name, owner in self.owners.items() if owner in task_ids}
+
+    def refresh(self, active=()):
+        """
+        增量更新索引：只列出顶层条目，新出现的、mtime 或大小变化的、dirty 的以及 active 中的条目才重新统计。
+        返回重新统计的条目数。
+        """
+        active = set(active)
+        with self._lock:
+            known = dict(self.entries)
+            dirty = set(self.dirty)
+        seen = set()
+        updates = {}
+        try:
+            scanner = os.scandir(self.root)
+        except FileNotFoundError:
+            return 0
+        with scanner as it:
+            for entry in it:
+                name = entry.name
+                if name == BLOB_DIR_NAME or name.startswith(USAGE_INDEX_NAME):
+                    continue
+                seen.add(name)
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                old = known.get(name)
+                if old and name not in dirty and name not in active and old['mtime'] == st.st_mtime \
+                        and (is_dir or old['size'] == st.st_size):
+                    continue
+                size, files = tree_size(entry.path) if is_dir else (st.st_size, 1)
+                updates[name] = {
+                    'size': size, 'files': files, 'mtime': st.st_mtime,
+                    # 第一次见到的条目用修改时间近似最后访问时间
+                    'last_access': old['last_access'] if old else st.st_mtime,
+                }
+        with self._lock:
+            for name, entry in updates.items():
+                current = self.entries.get(name)
+                if current:
+                    # 统计期间被 touch 过时保留更新的访问时间
+                    entry['last_access'] = max(entry['last_access'], current['last_access'])
+                self.entries[name] = entry
+            self.dirty -= set(updates) - active
+            for name in set(self.entries) - seen:
+                del self.entries[name]
+            # 条目已不存在且不是活跃任务预先登记的，所属关系也一并删除
+            for name in [n for n in self.owners if n not in seen and n not in active]:
+                del self.owners[name]
+                self.dirty.discard(name)
+            if updates or len(seen) != len(known):
+                self._changed = True
+        return len(updates)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(e['size'] for e in self.entries.values())
+
+    def evict(self, quota_bytes, max_age_days, is_protected):
+        """
+        删除超过 max_age_days 没有访问的条目；总大小仍超过 quota_bytes 时按最后访问时间从旧到新删除，
+        直到降到配额的 QUOTA_LOW_WATERMARK。is_protected(名称, 所属任务) 为真的条目跳过。
+        返回被删除的 [(名称, 条目, 所属任务)]。
+        """
+        now = time.time()
+        with self._lock:
+            candidates = sorted(self.entries.items(), key=lambda item: item[1]['last_access'])
+            owners = dict(self.owners)
+        total = sum(e['size'] for _, e in candidates)
+        target = quota_bytes * QUOTA_LOW_WATERMARK if quota_bytes else None
+        over_quota = bool(quota_bytes and total > quota_bytes)
+        removed = []
+        for name, entry in candidates:
+            expired = max_age_days is not None and now - entry['last_access'] > max_age_days * 86400
+            if not expired and not (over_quota and total > target):
+                # 列表按访问时间排序，后面的条目既没过期，也不需要再为配额删除
+                break
+            owner = owners.get(name)
+            if is_protected(name, owner):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                _remove_path(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"自动清理失败: {path} {e}")
+                continue
+            total -= entry['size']
+            removed.append((name, entry, owner))
+        if removed:
+            with self._lock:
+                for name, _, _ in removed:
+                    self.entries.pop(name, None)
+                    self.owners.pop(name, None)
+                    self.dirty.discard(name)
+                self._changed = True
+        return removed
+
+class Housekeeper:
+    """
+    后台清理线程：每 interval 秒（或 trigger() 后立即）增量刷新索引、按保留天数和配额删除条目，
+    再回收图片仓库中不再被引用的图片。多个进程共用输出目录时，should_run() 返回假的进程跳过这一轮。
+    """
+    def __init__(self, root, quota_bytes=None, max_age_days=7, interval=HOUSEKEEPING_INTERVAL,
+                 is_protected=None, active_names=None, on_evict=None, should_run=None):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.index = UsageIndex(root)
+        self.is_protected = is_protected or (lambda name, owner: False)
+        self.active_names = active_names or (lambda: ())
+        self.on_evict = on_evict
+        self.should_run = should_run or (lambda: True)
+        self.last_run = None
+        self._wake = threading.Event()
+        self._run_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def run_once(self):
+        with self._run_lock:
+            started = time.time()
+            refreshed = self.index.refresh(active=self.active_names())
+            removed = self.index.evict(self.quota_bytes, self.max_age_days, self.is_protected)
+            for name, entry, owner in removed:
+                print(f"自动清理: 删除 {name}（{entry['size'] / 1024 / 1024:.1f}MB）")
+                if self.on_evict:
+                    try:
+                        self.on_evict(name, owner)
+                    except Exception as e:
+                        print(f"清理回调出错: {name} {e}")
+            # 为配额删除过书籍时，立即回收只剩仓库一份链接的图片，否则按保留天数回收
+            quota_pressure = bool(self.quota_bytes and removed)
+            blob_removed, blob_freed = BlobStore(os.path.join(self.root, BLOB_DIR_NAME)).gc(
+                0 if quota_pressure else self.max_age_days)
+            if blob_removed:
+                print(f"自动清理: 图片仓库删除{blob_removed}个文件，释放{blob_freed / 1024 / 1024:.1f}MB")
+            self.index.save()
+            self.last_run = {
+                'time': started, 'seconds': round(time.time() - started, 3), 'refreshed': refreshed,
+                'removed': len(removed), 'freed': sum(e['size'] for _, e, _ in removed) + blob_freed,
+            }
+            return self.last_run
+
+    def _loop(self):
+        while True:
+            try:
+                if self.should_run():
+                    self.run_once()
+            except Exception as e:
+                print(f"后台清理出错: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True, name="housekeeping")
+                self._thread.start()
+
+    def trigger(self):
+        self._wake.set()
+
+    def stats(self):
+        return {'total_bytes': self.index.total_bytes(), 'entries': len(self.index.entries),
+                'quota_bytes': self.quota_bytes, 'max_age_days': self.max_age_days, 'last_run': self.last_run}
+
+# --- END OF FILE housekeeping.py ---
@@ -0,0 +1,226 @@
+# --- START OF FILE job_queue.py ---
+
+import asyncio
+import itertools
+import threading
+from collections import deque
+
+# 任务优先级 1-9，数字越大越优先；同时作为分配下载槽位时的权重
+MIN_PRIORITY = 1
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+
+def clamp_priority(priority):
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError):
+        return DEFAULT_PRIORITY
+    return min(max(priority, MIN_PRIORITY), MAX_PRIORITY)
+
+class TaskSlots:
+    """单个任务在全局槽位调度器中的句柄，下载每张图片前获取一个槽位，完成后归还。"""
+    def __init__(self, scheduler, task_id, priority, seq):
+        self.scheduler = scheduler
+        self.task_id = task_id
+        self.priority = priority
+        self.seq = seq
+        self.in_use = 0
+        self.granted = 0
+        self._waiters = deque()
+
+    def acquire(self):
+        self.scheduler._acquire(self)
+
+    def release(self):
+        self.scheduler._release(self)
+
+    async def acquire_async(self):
+        await self.scheduler._acquire_async(self)
+
+class _Waiter:
+    __slots__ = ('event', 'future', 'loop', 'granted')
+
+    def __init__(self, future=None, loop=None):
+        self.event = None if future else threading.Event()
+        self.future = future
+        self.loop = loop
+        self.granted = False
+
+    def wake(self):
+        self.granted = True
+        if self.event:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+class SlotScheduler:
+    """
+    全局下载槽位：所有任务的在途图片请求合计不超过 total_slots。
+    空出的槽位交给“已占用槽位 / 优先级”最小的等待任务，同比例时先注册的优先，
+    因此大任务无法挤占小任务的份额，高优先级任务按权重获得更多槽位。
+    多线程引擎阻塞等待，异步引擎等待 Future，两者共用同一份额度。
+    """
+    def __init__(self, total_slots):
+        self.total_slots = total_slots
+        self.in_use = 0
+        self._tasks = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def register(self, task_id, priority=DEFAULT_PRIORITY):
+        with self._lock:
+            slots = TaskSlots(self, task_id, clamp_priority(priority), next(self._seq))
+            self._tasks[task_id] = slots
+            return slots
+
+    def unregister(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def set_priority(self, task_id, priority):
+        with self._lock:
+            slots = self._tasks.get(task_id)
+            if slots:
+                slots.priority = clamp_priority(priority)
+
+    def _grant_locked(self):
+        while self.in_use < self.total_slots:
+            waiting = [s for s in self._tasks.values() if s._waiters]
+            if not waiting:
+                return
+            slots = min(waiting, key=lambda s: (s.in_use / s.priority, s.seq))
+            waiter = slots._waiters.popleft()
+            slots.in_use += 1
+            slots.granted += 1
+            self.in_use += 1
+            waiter.wake()
+
+    def _acquire(self, slots):
+        waiter = _Waiter()
+        with self._lock:
+            slots._waiters.append(waiter)
+            self._grant_locked()
+        waiter.event.wait()
+
+    async def _acquire_async(self, slots):
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), loop)
+        with self._lock:
+            slots._waiters.append(waiter)
+            self._grant_locked()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._release_locked(slots)
+                else:
+                    slots._waiters.remove(waiter)
+            raise
+
+    def _release(self, slots):
+        with self._lock:
+            self._release_locked(slots)
+
+    def _release_locked(self, slots):
+        slots.in_use -= 1
+        self.in_use -= 1
+        self._grant_locked()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'total': self.total_slots, 'in_use': self.in_use,
+                'tasks': {
+                    task_id: {'priority': s.priority, 'in_use': s.in_use, 'waiting': len(s._waiters),
+                              'granted': s.granted}
+                    for task_id, s in self._tasks.items()
+                },
+            }
+
+class JobQueue:
+    """
+    下载任务队列：最多 max_running 个任务同时运行，其余排队。
+    新任务按优先级插入（同优先级先到先得），排队中的任务可以调整优先级或直接移动位置。
+    """
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self._queued = []
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, task_id, fn, priority=DEFAULT_PRIORITY):
+        entry = {'task_id': task_id, 'priority': clamp_priority(priority), 'fn': fn}
+        with self._lock:
+            self._insert_locked(entry)
+        self._dispatch()
+
+    def _insert_locked(self, entry):
+        for i, queued in enumerate(self._queued):
+            if queued['priority'] < entry['priority']:
+                self._queued.insert(i, entry)
+                return
+        self._queued.append(entry)
+
+    def _find_locked(self, task_id):
+        for i, entry in enumerate(self._queued):
+            if entry['task_id'] == task_id:
+                return i
+        return None
+
+    def set_priority(self, task_id, priority):
+        """调整排队任务的优先级并重新排序，返回是否找到该任务。"""
+        with self._lock:
+            i = self._find_locked(task_id)
+            if i is None:
+                entry = self._running.get(task_id)
+                if entry:
+                    entry['priority'] = clamp_priority(priority)
+                return entry is not None
+            entry = self._queued.pop(i)
+            entry['priority'] = clamp_priority(priority)
+            self._insert_locked(entry)
+            return True
+
+    def move(self, task_id, position):
+        """把排队任务移动到指定位置（0 为队首），返回是否找到该任务。"""
+        with self._lock:
+            i = self._find_locked(task_id)
+            if i is None:
+                return False
+            entry = self._queued.pop(i)
+            self._queued.insert(min(max(int(position), 0), len(self._queued)), entry)
+            return True
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if len(self._running) >= self.max_running or not self._queued:
+                    return
+                entry = self._queued.pop(0)
+                self._running[entry['task_id']] = entry
+            threading.Thread(target=self._run, args=(entry,), daemon=True,
+                             name=f"download-task-{entry['task_id'][:8]}").start()
+
+    def _run(self, entry):
+        try:
+            entry['fn']()
+        finally:
+            with self._lock:
+                self._running.pop(entry['task_id'], None)
+            self._dispatch()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'max_running': self.max_running,
+                'running': [{'task_id': e['task_id'], 'priority': e['priority']} for e in self._running.values()],
+                'queued': [{'task_id': e['task_id'], 'priority': e['priority'], 'position': i}
+                           for i, e in enumerate(self._queued)],
+            }
+
+# --- END OF FILE job_queue.py ---
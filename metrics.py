@@ -0,0 +1,314 @@
+# --- START OF FILE metrics.py ---
+
+"""
+进程内指标，按 Prometheus 文本格式从 /metrics 导出，不依赖 prometheus_client。
+多进程部署（gunicorn 多 worker、多个 worker.py）时每个进程各自导出，由 Prometheus 分别抓取后聚合。
+"""
+
+import io
+import time
+import bisect
+import pstats
+import cProfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+METRIC_PREFIX = "comic_downloader_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                                for k, v in items]
+
+class Gauge(Metric):
+    """可以直接 set/inc/dec，也可以传入 callback 在抓取时计算 {标签值元组: 数值}。"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self):
+        if self.callback:
+            try:
+                values = self.callback()
+            except Exception:
+                values = {}
+            if not isinstance(values, dict):
+                values = {(): values}
+            items = list(values.items())
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+                                for k, v in items]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, callback))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+IMAGES = counter("images_total", "处理的图片数，result 为 downloaded/existing/skipped/failed", ("engine", "result"))
+BYTES = counter("downloaded_bytes_total", "下载成功写盘的图片字节数（解密后）")
+REQUEST_SECONDS = histogram("request_seconds", "单次图片请求（含读取响应体和写盘）的耗时", ("host",))
+HTTP_RETRIES = counter("http_retries_total", "单张图片下载失败后立即重试的次数", ("host",))
+RETRY_ROUND_IMAGES = counter("retry_round_images_total", "每一轮失败重试中重新下载的图片数", ("round",))
+PHASE_SECONDS = counter("phase_seconds_total", "各阶段累计耗时：parse/download/decrypt/write/store/transcode/pack（transcode 为进程池中的 CPU 时间）", ("phase",))
+REDIS_SECONDS = histogram("redis_seconds", "Redis 调用（pipeline 按一次计）的耗时", ("op",),
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+QUEUED_IMAGES = gauge("queued_images", "已提交给下载执行器、尚未开始下载的图片数", ("engine",))
+ACTIVE_DOWNLOADS = gauge("active_downloads", "正在进行的图片请求数")
+PROXY_REQUESTS = counter("proxy_requests_total", "经代理发出的请求数，result 为 ok/error（只统计可归咎于代理的错误）", ("proxy", "result"))
+PROXY_QUARANTINES = counter("proxy_quarantines_total", "代理因连续失败或探测失败被隔离的次数", ("proxy",))
+ACTIVE_THREADS = gauge("active_threads", "进程中存活的线程数", callback=threading.active_count)
+
+# 当前上下文里正在计时的阶段，嵌套阶段的耗时只记在最内层，外层阶段暂停计时
+_phase_stack = contextvars.ContextVar("phase_stack", default=())
+
+class _PhaseFrame:
+    __slots__ = ("name", "started", "elapsed")
+
+    def __init__(self, name, started):
+        self.name = name
+        self.started = started
+        self.elapsed = 0.0
+
+@contextmanager
+def phase(name):
+    now = time.perf_counter()
+    stack = _phase_stack.get()
+    if stack:
+        outer = stack[-1]
+        outer.elapsed += now - outer.started
+    frame = _PhaseFrame(name, now)
+    token = _phase_stack.set(stack + (frame,))
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        frame.elapsed += now - frame.started
+        _phase_stack.reset(token)
+        if stack:
+            stack[-1].started = now
+        PHASE_SECONDS.inc(frame.elapsed, phase=name)
+
+def record_phase(name, seconds):
+    PHASE_SECONDS.inc(seconds, phase=name)
+
+@contextmanager
+def redis_timer(op):
+    with REDIS_SECONDS.time(op=op):
+        yield
+
+def render_metrics():
+    return REGISTRY.render()
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """没有 Web 界面的进程（worker.py）用一个独立的 HTTP 服务导出 /metrics。"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    return server
+
+class TaskProfiler:
+    """
+    单个任务的 cProfile 采样。cProfile 只对调用 enable 的线程生效，
+    因此每个参与该任务的线程各自持有一个 Profile，结束后合并成一份统计。
+    """
+    def __init__(self):
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _profile(self):
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def enable_current(self):
+        try:
+            self._profile().enable()
+            self._local.active = True
+        except ValueError:
+            # 同一线程上已有其他任务的分析器在运行（共享的事件循环线程），这里不再重复采样
+            self._local.active = False
+
+    def disable_current(self):
+        profile = getattr(self._local, "profile", None)
+        if profile and getattr(self._local, "active", False):
+            profile.disable()
+            self._local.active = False
+
+    @contextmanager
+    def thread(self):
+        """在当前线程上采样一段代码，线程池的每个工作项都包在这里面。"""
+        self.enable_current()
+        try:
+            yield
+        finally:
+            self.disable_current()
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            try:
+                stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+            except TypeError:
+                # 没有采到任何调用的 Profile 无法生成统计
+                continue
+        return stats
+
+    def dump(self, path):
+        stats = self.stats()
+        if stats is None:
+            return False
+        stats.dump_stats(path)
+        return True
+
+def profile_summary(path, sort="cumulative", limit=40):
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+# --- END OF FILE metrics.py ---
@@ -0,0 +1,280 @@
+# --- START OF FILE postprocess.py ---
+
+"""
+下载后处理：把过大的 PNG/JPEG 重新编码为 WebP/AVIF，或把宽度压到上限。
+下载线程只把完成的图片放进有界队列，转码在进程池里进行，不和网络线程争抢 GIL；
+处理完的图片直接交给打包器。需要 Pillow（AVIF 需要 Pillow 11.2+ 或 pillow-avif-plugin）。
+"""
+
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import record_phase
+
+TRANSCODE_FORMATS = ('webp', 'avif')
+DEFAULT_QUALITY = 85
+# 每个进程池工作进程最多排队的图片数，队列满时下载线程等待
+POSTPROCESS_QUEUE_PER_WORKER = 4
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _import_pil():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+def check_postprocess_support(fmt):
+    """返回不支持的原因，支持时返回 None。"""
+    if _import_pil() is None:
+        return "图片后处理需要安装 Pillow"
+    if fmt == 'avif':
+        from PIL import features
+        if not features.check('avif'):
+            try:
+                import pillow_avif  # noqa: F401
+            except ImportError:
+                return "AVIF 编码需要 Pillow 11.2+ 或 pillow-avif-plugin"
+    return None
+
+def normalize_postprocess_options(fmt=None, max_width=None, quality=None):
+    """把表单参数整理成任务规格里保存的字典，没有启用任何处理时返回 None。"""
+    fmt = (fmt or '').lower() or None
+    if fmt and fmt not in TRANSCODE_FORMATS:
+        raise ValueError(f"未知的转码格式: {fmt}")
+    max_width = int(max_width or 0)
+    if not fmt and max_width <= 0:
+        return None
+    quality = min(max(int(quality or DEFAULT_QUALITY), 1), 100)
+    return {'format': fmt, 'max_width': max_width, 'quality': quality}
+
+def get_process_pool():
+    """所有任务共享一个进程池，工作进程数等于 CPU 核数。"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 不能用 fork：进程池在分发线程里第一次提交时才创建，此时刷新、下载、事件循环和 Redis 线程
+            # 可能正持有锁，fork 出的子进程会继承这些锁而死锁。forkserver 的服务进程只预先导入本模块，
+            # 工作进程从它派生，转码函数也只依赖本模块；不支持 forkserver 的平台用 spawn
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["postprocess"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 2, mp_context=context)
+    return _pool
+
+def sniff_image_type(path):
+    with open(path, "rb") as f:
+        head = f.read(8)
+    if head.startswith(PNG_MAGIC):
+        return 'png'
+    if head.startswith(JPEG_MAGIC):
+        return 'jpeg'
+    return None
+
+def output_path(src_path, fmt):
+    return os.path.splitext(src_path)[0] + f".{fmt}" if fmt else src_path
+
+def transcode_image(src_path, fmt, max_width, quality):
+    """
+    在进程池里执行：转码和/或缩放 src_path，返回 (结果路径, 原大小, 新大小, 耗时)。
+    结果没有变小且没有缩放时保留原图。
+    """
+    Image = _import_pil()
+    if fmt == 'avif':
+        try:
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            pass
+    started = time.process_time()
+    old_size = os.path.getsize(src_path)
+    dst_path = output_path(src_path, fmt)
+    tmp_path = dst_path + ".post.tmp"
+    resized = False
+    with Image.open(src_path) as im:
+        im.load()
+        src_format = im.format
+        if max_width and im.width > max_width:
+            height = max(1, round(im.height * max_width / im.width))
+            im = im.resize((max_width, height), Image.LANCZOS)
+            resized = True
+        save_format = fmt.upper() if fmt else src_format
+        if save_format == 'JPEG' and im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        params = {'quality': quality} if save_format in ('WEBP', 'AVIF', 'JPEG') else {'optimize': True}
+        im.save(tmp_path, save_format, **params)
+    new_size = os.path.getsize(tmp_path)
+    if new_size >= old_size and not resized:
+        os.remove(tmp_path)
+        return src_path, old_size, old_size, time.process_time() - started
+    # 临时文件改名替换，不会改写图片仓库中通过硬链接共享的原图
+    os.replace(tmp_path, dst_path)
+    if dst_path != src_path:
+        os.remove(src_path)
+    return dst_path, old_size, new_size, time.process_time() - started
+
+def find_processed(save_path, options):
+    """上次运行已转码的图片：原图已删除，只留下新扩展名的文件。"""
+    if not options or not options.get('format'):
+        return None
+    path = output_path(save_path, options['format'])
+    return path if path != save_path and os.path.exists(path) else None
+
+class PostProcessor:
+    """
+    单个任务的后处理阶段。submit() 把图片放进有界队列（满时阻塞下载线程），
+    分发线程把图片交给共享进程池，完成后调用 on_done(结果路径, arcname)，通常是加入打包器。
+    """
+    def __init__(self, options, on_done, pool=None):
+        self.options = options
+        self.on_done = on_done
+        self.pool = pool or get_process_pool()
+        workers = getattr(self.pool, "_max_workers", os.cpu_count() or 2)
+        self._queue = queue.Queue(maxsize=workers * POSTPROCESS_QUEUE_PER_WORKER)
+        self._in_flight = threading.BoundedSemaphore(workers * 2)
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._aborted = False
+        self.errors = []
+        self.stats = {'processed': 0, 'passed': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0}
+        self._started = None
+        self._finished = None
+        self._thread = threading.Thread(target=self._dispatch, daemon=True, name="postprocess-dispatch")
+        self._thread.start()
+
+    def submit(self, path, arcname):
+        with self._cond:
+            self._pending += 1
+            if self._started is None:
+                self._started = time.time()
+        self._queue.put((path, arcname))
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, arcname = item
+            if self._aborted:
+                self._done()
+                continue
+            try:
+                kind = sniff_image_type(path)
+            except OSError as e:
+                self._record_failure(path, arcname, e)
+                continue
+            if kind is None:
+                # GIF/WebP 等其他格式原样打包
+                with self._cond:
+                    self.stats['passed'] += 1
+                self._deliver(path, arcname)
+                continue
+            self._in_flight.acquire()
+            try:
+                future = self.pool.submit(transcode_image, path, self.options.get('format'),
+                                          self.options.get('max_width'), self.options.get('quality', DEFAULT_QUALITY))
+            except Exception as e:
+                self._in_flight.release()
+                self._record_failure(path, arcname, e)
+                continue
+            future.add_done_callback(lambda f, path=path, arcname=arcname: self._collect(f, path, arcname))
+
+    def _collect(self, future, path, arcname):
+        self._in_flight.release()
+        try:
+            result_path, old_size, new_size, cpu = future.result()
+        except Exception as e:
+            self._record_failure(path, arcname, e)
+            return
+        record_phase("transcode", cpu)
+        with self._cond:
+            self.stats['processed'] += 1
+            self.stats['bytes_in'] += old_size
+            self.stats['bytes_out'] += new_size
+            self.stats['cpu_seconds'] += cpu
+        self._deliver(result_path, os.path.splitext(arcname)[0] + os.path.splitext(result_path)[1])
+
+    def _record_failure(self, path, arcname, error):
+        # 解码失败（例如图片已损坏或实际不是图片）时原样打包
+        with self._cond:
+            self.stats['failed'] += 1
+            if len(self.errors) < 20:
+                self.errors.append(f"{arcname}: {error}")
+        self._deliver(path, arcname)
+
+    def _deliver(self, path, arcname):
+        try:
+            if not self._aborted and self.on_done and os.path.exists(path):
+                self.on_done(path, arcname)
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._cond:
+            self._pending -= 1
+            self._finished = time.time()
+            self._cond.notify_all()
+
+    def close(self):
+        """等待队列中和进程池里的图片全部处理完，返回统计。"""
+        self._queue.put(None)
+        self._thread.join()
+        with self._cond:
+            while self._pending > 0:
+                self._cond.wait()
+        return self.summary()
+
+    def abort(self):
+        """任务暂停或终止：丢弃尚未开始的图片，等待已提交给进程池的图片结束。"""
+        self._aborted = True
+        self.close()
+
+    def summary(self):
+        with self._cond:
+            stats = dict(self.stats)
+            elapsed = (self._finished or time.time()) - self._started if self._started else 0.0
+            stats['queued'] = self._queue.qsize()
+        saved = stats['bytes_in'] - stats['bytes_out']
+        stats['bytes_saved'] = saved
+        stats['saved_percent'] = round(saved / stats['bytes_in'] * 100, 1) if stats['bytes_in'] else 0.0
+        stats['elapsed'] = round(elapsed, 2)
+        stats['images_per_s'] = round(stats['processed'] / elapsed, 1) if elapsed > 0 else 0.0
+        stats['mb_per_s'] = round(stats['bytes_in'] / elapsed / 1e6, 2) if elapsed > 0 else 0.0
+        stats['cpu_seconds'] = round(stats['cpu_seconds'], 2)
+        return stats
+
+def open_postprocessor(options, packer, direct, progress_callback):
+    """
+    按任务的后处理选项创建 PostProcessor，未启用或缺少依赖时返回 None。
+    处理结果加入边下边打包的 CBZ；下载完成后打包的模式由 pack_book 统一打包处理后的目录。
+    """
+    if not options:
+        return None
+    reason = check_postprocess_support(options.get('format'))
+    if reason:
+        progress_callback(0, 0, f"{reason}，跳过图片后处理")
+        return None
+    on_done = (lambda path, arcname: packer.add(path, arcname, remove_source=direct)) if packer else None
+    desc = []
+    if options.get('format'):
+        desc.append(f"转码为 {options['format'].upper()}（质量 {options['quality']}）")
+    if options.get('max_width'):
+        desc.append(f"宽度上限 {options['max_width']}px")
+    progress_callback(0, 0, f"图片后处理已开启：{'，'.join(desc)}")
+    return PostProcessor(options, on_done)
+
+def format_postprocess_summary(stats):
+    return (f"图片后处理完成：转码{stats['processed']}张，原样{stats['passed']}张，失败{stats['failed']}张，"
+            f"节省{stats['bytes_saved'] / 1024 / 1024:.1f}MB（{stats['saved_percent']}%），"
+            f"{stats['images_per_s']}张/秒，{stats['mb_per_s']}MB/秒")
+
+# --- END OF FILE postprocess.py ---
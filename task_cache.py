@@ -0,0 +1,223 @@
+# --- START OF FILE task_cache.py ---
+
+"""
+上传的任务文件按内容 SHA-256 存放（uploads/<哈希>/<原文件名>），同名文件不会互相覆盖，
+同一份文件重复上传也只保存一份。任务文件第一次被完整解析时，解析结果（书名、作者、源站和逐张图片）
+以压缩的记录流写入 uploads/.parsed，之后再提交同一份文件时直接读取缓存，不再解析。
+缓存总大小有上限，超过时删除最久没有使用的缓存。
+"""
+
+import os
+import json
+import uuid
+import zlib
+import hashlib
+
+from blob_store import is_content_hash
+
+PARSED_CACHE_DIR_NAME = ".parsed"
+PARSED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PARSED_CACHE_VERSION = 1
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+CACHE_READ_SIZE = 64 * 1024
+
+def store_upload(stream, upload_folder, filename):
+    """把上传的文件流按内容哈希保存，返回 (保存路径, 内容哈希)。"""
+    filename = os.path.basename(filename.replace("\\", "/")) or "task.txt"
+    os.makedirs(upload_folder, exist_ok=True)
+    tmp_path = os.path.join(upload_folder, f".upload-{uuid.uuid4().hex}.tmp")
+    h = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+        digest = h.hexdigest()
+        save_path = os.path.join(upload_folder, digest, filename)
+        if os.path.exists(save_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return save_path, digest
+
+def task_file_digest(task_path):
+    """按内容哈希保存的任务文件返回其哈希，其他位置的文件返回 None。"""
+    digest = os.path.basename(os.path.dirname(os.path.abspath(task_path)))
+    return digest if is_content_hash(digest) else None
+
+def cache_key(digest, filename):
+    # .txt 任务文件没有写书名时用文件名作书名，因此缓存键同时包含内容哈希和文件名
+    return hashlib.sha256(f"{digest}\0{filename}".encode("utf-8")).hexdigest()
+
+def _dump(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+class CachedTaskFile:
+    """
+    从解析缓存读取的任务文件，接口与 StreamingTaskFile 相同。
+    记录流：第一行为元数据，字符串行为章节标题，数组行为 [url] 或 [url, headers]。
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            meta = json.loads(next(self._iter_lines(f)))
+        if meta.get("v") != PARSED_CACHE_VERSION:
+            raise ValueError(f"解析缓存版本不匹配: {meta.get('v')}")
+        self.title = meta["title"]
+        self.author = meta["author"]
+        self.global_referer = meta.get("referer")
+
+    @staticmethod
+    def _iter_lines(f):
+        decompressor = zlib.decompressobj()
+        buffer = b""
+        while True:
+            data = f.read(CACHE_READ_SIZE)
+            buffer += decompressor.decompress(data) if data else decompressor.flush()
+            *lines, buffer = buffer.split(b"\n")
+            yield from lines
+            if not data:
+                return
+
+    def __iter__(self):
+        chapter_title = "第1章"
+        with open(self.path, "rb") as f:
+            lines = self._iter_lines(f)
+            next(lines)
+            for line in lines:
+                value = json.loads(line)
+                if isinstance(value, str):
+                    chapter_title = value
+                else:
+                    yield value[0], value[1] if len(value) > 1 else {}, chapter_title
+
+class ParsedTaskCache:
+    """解析结果缓存目录，总大小超过 max_bytes 时按最后使用时间删除旧缓存。"""
+    def __init__(self, root, max_bytes=PARSED_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.bin")
+
+    def open(self, key):
+        path = self.path(key)
+        try:
+            task_file = CachedTaskFile(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"解析缓存损坏，将重新解析: {path} {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # 修改时间作为最后使用时间，淘汰时据此排序
+            os.utime(path)
+        except OSError:
+            pass
+        return task_file
+
+    def writer(self, key, task_file):
+        return CacheWriter(self, key, task_file)
+
+    def evict(self):
+        try:
+            entries = [e for e in os.scandir(self.root) if e.name.endswith(".bin")]
+        except FileNotFoundError:
+            return 0
+        stats = []
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            stats.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in stats)
+        removed = 0
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+class CacheWriter:
+    """边解析边把记录压缩写入临时文件，commit() 后才作为缓存生效。"""
+    def __init__(self, cache, key, task_file):
+        self.cache = cache
+        self.key = key
+        self.task_file = task_file
+        os.makedirs(cache.root, exist_ok=True)
+        self._tmp_path = cache.path(key) + f".{uuid.uuid4().hex}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._compressor = zlib.compressobj(6)
+        self._chapter = None
+        meta = {"v": PARSED_CACHE_VERSION, "title": task_file.title, "author": task_file.author,
+                "referer": task_file.global_referer}
+        self._file.write(self._compressor.compress(_dump(meta)))
+
+    def add(self, url, headers, chapter_title):
+        if chapter_title != self._chapter:
+            self._chapter = chapter_title
+            self._file.write(self._compressor.compress(_dump(chapter_title)))
+        self._file.write(self._compressor.compress(_dump([url, headers] if headers else [url])))
+
+    def commit(self):
+        self._file.write(self._compressor.flush())
+        self._file.close()
+        os.replace(self._tmp_path, self.cache.path(self.key))
+        self.cache.evict()
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+class CachingTaskFile:
+    """
+    包装 StreamingTaskFile：迭代时把每条记录写入解析缓存，完整迭代一遍才提交；
+    中途停止（任务暂停、终止或出错）时丢弃未完成的缓存。
+    """
+    def __init__(self, task_file, cache, key):
+        self.task_file = task_file
+        self.cache = cache
+        self.key = key
+        self.title = task_file.title
+        self.author = task_file.author
+        self.global_referer = task_file.global_referer
+
+    def __iter__(self):
+        try:
+            writer = self.cache.writer(self.key, self.task_file)
+        except OSError as e:
+            print(f"无法写入解析缓存: {e}")
+            yield from self.task_file
+            return
+        committed = False
+        try:
+            for item in self.task_file:
+                writer.add(*item)
+                yield item
+            writer.commit()
+            committed = True
+        finally:
+            if not committed:
+                writer.discard()
+
+# --- END OF FILE task_cache.py ---
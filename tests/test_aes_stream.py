@@ -0,0 +1,56 @@
+"""分块 AES-CBC 解密：任意切分方式的结果都要与整体解密 aes_decrypt 一致。"""
+
+import random
+
+import pytest
+from Crypto.Cipher import AES
+
+from downloader import AESStreamDecryptor, aes_decrypt, _write_chunks
+
+KEY = b"0123456789abcdef"
+IV = b"fedcba9876543210"
+
+def encrypt(data):
+    pad = 16 - len(data) % 16
+    return AES.new(KEY, AES.MODE_CBC, IV).encrypt(data + bytes([pad]) * pad)
+
+def random_split(data, rng):
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([0, 1, 7, 15, 16, 17, 31, 64, rng.randint(1, 5000)])
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 4096, 100003])
+def test_random_chunks_match_aes_decrypt(size):
+    rng = random.Random(size)
+    plain = rng.randbytes(size)
+    cipher = encrypt(plain)
+    for _ in range(20):
+        decryptor = AESStreamDecryptor(KEY, IV)
+        out = b"".join(decryptor.update(chunk) for chunk in random_split(cipher, rng)) + decryptor.finish()
+        assert out == aes_decrypt(cipher, KEY, IV) == plain
+
+def test_update_keeps_last_block_for_finish():
+    cipher = encrypt(b"x" * 32)
+    decryptor = AESStreamDecryptor(KEY, IV)
+    # 刚好对齐时也不能提前解密最后一块，否则 finish() 无法去除填充
+    assert decryptor.update(cipher) == b"x" * 32
+    assert decryptor.finish() == b""
+
+def test_truncated_ciphertext():
+    decryptor = AESStreamDecryptor(KEY, IV)
+    decryptor.update(encrypt(b"y" * 40)[:-3])
+    with pytest.raises(ValueError):
+        decryptor.finish()
+
+def test_write_chunks(tmp_path):
+    plain = random.Random(1).randbytes(70001)
+    cipher = encrypt(plain)
+    path = str(tmp_path / "img.jpg")
+    _write_chunks(random_split(cipher, random.Random(2)), path, KEY, IV)
+    with open(path, "rb") as f:
+        assert f.read() == plain
+    assert not (tmp_path / "img.jpg.tmp").exists()
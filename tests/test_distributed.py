@@ -0,0 +1,104 @@
+"""分布式引擎：用 fakeredis 代替 Redis，走一遍 入队 → 下载进程 → 暂停/继续。"""
+
+import os
+import json
+import time
+import zipfile
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import benchmark
+from downloader import RedisDownloadController, TaskSuspended, image_filename
+from distributed import (
+    DistributedWorker, process_task_file_distributed, get_job_key, get_job_settled_key, DIST_STREAM_KEY,
+    DIST_MAX_ATTEMPTS,
+)
+
+IMAGES = 60
+
+@pytest.fixture
+def cdn_url():
+    server = benchmark.start_server(benchmark.FakeCDN(2000, 0.02))
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+def start_worker(redis_client, **kwargs):
+    worker = DistributedWorker(redis_client, concurrency=2, block_ms=100, **kwargs)
+    thread = threading.Thread(target=worker.run, daemon=True)
+    thread.start()
+    return worker, thread
+
+def run_task(redis_client, task_path, output, controller):
+    return process_task_file_distributed(
+        task_path, output, {}, lambda *args: None, redis_client=redis_client,
+        download_controller=controller, manifest_key="test:manifest")
+
+def test_enqueue_pause_resume(tmp_path, redis_client, cdn_url):
+    task_path = str(tmp_path / "book.txt")
+    benchmark.write_task_file(task_path, benchmark.task_images(cdn_url, "dist", IMAGES, 20))
+    output = str(tmp_path / "output")
+    controller = RedisDownloadController(redis_client, "task-1", cache_ttl=0)
+    worker, thread = start_worker(redis_client)
+    try:
+        def pause_when_started():
+            while not redis_client.bitcount("test:manifest"):
+                time.sleep(0.01)
+            controller.pause()
+        threading.Thread(target=pause_when_started, daemon=True).start()
+        with pytest.raises(TaskSuspended):
+            run_task(redis_client, task_path, output, controller)
+        assert 0 < redis_client.bitcount("test:manifest") < IMAGES
+
+        controller.resume()
+        result = run_task(redis_client, task_path, output, controller)
+    finally:
+        worker.stop()
+        thread.join()
+
+    assert result[0]["failed"] == []
+    assert redis_client.bitcount("test:manifest") == IMAGES
+    with zipfile.ZipFile(os.path.join(output, "book.cbz")) as zf:
+        assert len(zf.namelist()) == IMAGES + 1
+    # 暂停时丢弃的工作项已确认，队列里不留残余
+    assert redis_client.xlen(DIST_STREAM_KEY) == 0
+
+def test_done_counted_when_bitmap_already_set(tmp_path, redis_client):
+    # 另一个任务（或暂停前的同一任务）已经把位图置位，本任务的完成数仍要增加，否则 Web 进程会一直等待
+    output = str(tmp_path / "output")
+    chapter_dir = os.path.join(output, "book", "ch")
+    os.makedirs(chapter_dir)
+    url = "http://example.invalid/0.jpg"
+    with open(os.path.join(chapter_dir, image_filename(0, url)), "wb") as f:
+        f.write(os.urandom(4096))
+    config = {'output_folder': output, 'title': "book", 'headers': {}, 'manifest_key': "test:manifest"}
+    redis_client.set(get_job_key("job-1"), json.dumps(config))
+    redis_client.setbit("test:manifest", 0, 1)
+    worker = DistributedWorker(redis_client, concurrency=1)
+    fields = {'job': "job-1", 'idx': "0", 'url': url, 'chapter': "ch", 'attempt': "0"}
+    entry_id = redis_client.xadd(DIST_STREAM_KEY, fields)
+    worker.process(entry_id, fields)
+    worker.process(entry_id, fields)
+    assert redis_client.hgetall(get_job_settled_key("job-1")) == {"0": ""}
+
+def test_failed_then_done_counted_once(tmp_path, redis_client):
+    # 工作项超时被重复领取：一份副本重试用尽记为失败，另一份随后成功，该图片只计一次且不算失败
+    worker = DistributedWorker(redis_client, concurrency=1)
+    settled_key = get_job_settled_key("job-1")
+    fields = {'job': "job-1", 'idx': "3", 'url': "http://example.invalid/3.jpg", 'chapter': "ch"}
+    entry_id = redis_client.xadd(DIST_STREAM_KEY, fields)
+    worker._fail(entry_id, "job-1", fields, DIST_MAX_ATTEMPTS - 1, "ch/0004.jpg", "timeout")
+    assert redis_client.hgetall(settled_key) == {"3": fields['url']}
+    save_path = tmp_path / "0004.jpg"
+    save_path.write_bytes(os.urandom(4096))
+    worker._succeed(entry_id, "job-1", {}, 3, fields['url'], str(tmp_path), str(save_path), "ok")
+    assert redis_client.hgetall(settled_key) == {"3": ""}
+    # 成功之后才到的失败不会覆盖成功
+    worker._fail(entry_id, "job-1", fields, DIST_MAX_ATTEMPTS - 1, "ch/0004.jpg", "timeout")
+    assert redis_client.hgetall(settled_key) == {"3": ""}
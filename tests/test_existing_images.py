@@ -0,0 +1,50 @@
+"""本地已存在的图片：入库出错时两个引擎都只把这一张记为失败，任务继续完成。"""
+
+import os
+
+import pytest
+
+import benchmark
+from blob_store import BlobStore
+from downloader import process_task_file_with_progress
+
+IMAGES = 12
+
+@pytest.fixture
+def cdn_url():
+    server = benchmark.start_server(benchmark.FakeCDN(2000, 0.01))
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+def thread_engine(*args, **kwargs):
+    return process_task_file_with_progress(*args, **kwargs)
+
+def async_engine(*args, **kwargs):
+    pytest.importorskip("aiohttp")
+    from async_downloader import process_task_file_async
+    return process_task_file_async(*args, **kwargs)
+
+@pytest.mark.parametrize("engine", [thread_engine, async_engine])
+def test_ingest_error_on_existing_image(tmp_path, cdn_url, monkeypatch, engine):
+    chapters = benchmark.task_images(cdn_url, "existing", IMAGES, 6)
+    task_path = str(tmp_path / "book.txt")
+    benchmark.write_task_file(task_path, chapters)
+    output = str(tmp_path / "output")
+
+    def run():
+        return engine(task_path, output, {}, lambda *args: None, pack_after_download=False)[0]
+
+    assert run()["failed"] == []
+    broken = os.path.join(output, "book", "第1章", "0001.jpg")
+    try_ingest = BlobStore.try_ingest
+
+    def failing_ingest(self, path):
+        if path == broken:
+            raise OSError("模拟入库失败")
+        return try_ingest(self, path)
+
+    monkeypatch.setattr(BlobStore, "try_ingest", failing_ingest)
+    messages = []
+    result = engine(task_path, output, {}, lambda *args: messages.append(args[2]), pack_after_download=False)[0]
+    assert result["failed"] == [chapters[0][1][0]]
+    assert sum("本地文件已存在" in msg for msg in messages) >= IMAGES - 1
@@ -0,0 +1,131 @@
+"""全局槽位的按优先级公平分配，以及任务队列的排序、调整和调度。"""
+
+import asyncio
+import threading
+
+import pytest
+
+from job_queue import SlotScheduler, JobQueue, clamp_priority
+
+async def fill(slots, count):
+    for _ in range(count):
+        await slots.acquire_async()
+
+async def wait_in_queue(slots, count):
+    tasks = [asyncio.create_task(slots.acquire_async()) for _ in range(count)]
+    await asyncio.sleep(0)
+    return tasks
+
+def test_freed_slots_go_to_task_with_smaller_share():
+    async def run():
+        scheduler = SlotScheduler(4)
+        big, small = scheduler.register("big"), scheduler.register("small")
+        await fill(big, 4)
+        waiting = await wait_in_queue(big, 4) + await wait_in_queue(small, 2)
+        # 大任务先排队，但空出的槽位先给还没有份额的小任务
+        big.release()
+        big.release()
+        assert (big.in_use, small.in_use) == (2, 2)
+        big.release()
+        assert (big.in_use, small.in_use) == (2, 2)
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+    asyncio.run(run())
+
+def test_slots_split_by_priority():
+    async def run():
+        scheduler = SlotScheduler(8)
+        blocker = scheduler.register("blocker")
+        await fill(blocker, 8)
+        low, high = scheduler.register("low", priority=1), scheduler.register("high", priority=3)
+        waiting = await wait_in_queue(low, 8) + await wait_in_queue(high, 8)
+        for _ in range(8):
+            blocker.release()
+        assert (low.in_use, high.in_use) == (2, 6)
+        assert scheduler.stats()['in_use'] == 8
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+    asyncio.run(run())
+
+def test_cancelled_waiter_gives_slot_back():
+    async def run():
+        scheduler = SlotScheduler(1)
+        a, b = scheduler.register("a"), scheduler.register("b")
+        await fill(a, 1)
+        (waiting,) = await wait_in_queue(b, 1)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.stats()['tasks']['b']['waiting'] == 0
+        # 已经分到槽位、但还没来得及恢复执行就被取消的等待者要把槽位还回去
+        (waiting,) = await wait_in_queue(b, 1)
+        a.release()
+        assert b.in_use == 1
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert (b.in_use, scheduler.in_use) == (0, 0)
+    asyncio.run(run())
+
+def test_thread_acquire_blocks_until_release():
+    scheduler = SlotScheduler(1)
+    a, b = scheduler.register("a"), scheduler.register("b")
+    a.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        b.acquire()
+        acquired.set()
+
+    threading.Thread(target=worker, daemon=True).start()
+    assert not acquired.wait(0.1)
+    a.release()
+    assert acquired.wait(2)
+    b.release()
+    assert scheduler.in_use == 0
+
+def test_clamp_priority():
+    assert [clamp_priority(p) for p in (0, 3, 12, "7", "x", None)] == [1, 3, 9, 7, 5, 5]
+
+@pytest.fixture
+def blocked_queue():
+    """max_running=1 的队列，第一个任务一直运行到测试放行为止。"""
+    queue = JobQueue(1)
+    release = threading.Event()
+    order = []
+    done = threading.Semaphore(0)
+
+    def job(name):
+        def fn():
+            if name == "first":
+                release.wait(5)
+            order.append(name)
+            done.release()
+        return fn
+
+    queue.submit("first", job("first"))
+    yield queue, job, release, order, done
+    release.set()
+
+def queued_ids(queue):
+    return [e['task_id'] for e in queue.snapshot()['queued']]
+
+def test_queue_orders_by_priority_then_arrival(blocked_queue):
+    queue, job, release, order, done = blocked_queue
+    queue.submit("a", job("a"), priority=5)
+    queue.submit("b", job("b"), priority=8)
+    queue.submit("c", job("c"), priority=5)
+    assert queued_ids(queue) == ["b", "a", "c"]
+    assert queue.set_priority("c", 9)
+    assert queued_ids(queue) == ["c", "b", "a"]
+    assert queue.move("a", 0)
+    assert queued_ids(queue) == ["a", "c", "b"]
+    assert not queue.move("missing", 0)
+    # 正在运行的任务也能调整优先级，只是不参与排队
+    assert queue.set_priority("first", 2)
+    assert queue.snapshot()['running'] == [{'task_id': "first", 'priority': 2}]
+
+    release.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    assert order == ["first", "a", "c", "b"]
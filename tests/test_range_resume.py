@@ -0,0 +1,139 @@
+"""Range/If-Range 续传：服务器返回 206 时追加，返回 200 时从头下载，两个引擎行为一致。"""
+
+import os
+import json
+import random
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from Crypto.Cipher import AES
+
+from downloader import _download_resumable, STREAM_CHUNK_SIZE
+
+KEY = b"0123456789abcdef"
+IV = b"fedcba9876543210"
+BODY = random.Random(0).randbytes(50000)
+
+class RangeServer:
+    """body/etag 可随时替换；honor_range 为 False 时忽略 Range 总是返回 200。"""
+    def __init__(self):
+        self.body = BODY
+        self.etag = '"v1"'
+        self.honor_range = True
+        self.bad_offset = False
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                body = server.body
+                range_header = self.headers.get("Range")
+                if (server.honor_range and range_header
+                        and self.headers.get("If-Range") == server.etag):
+                    start = int(range_header.split("=")[1].rstrip("-"))
+                    reported = start + 1 if server.bad_offset else start
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {reported}-{len(body) - 1}/{len(body)}")
+                    body = body[start:]
+                else:
+                    self.send_response(200)
+                    self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", server.etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/img.jpg"
+
+@pytest.fixture
+def server():
+    s = RangeServer()
+    yield s
+    s.httpd.shutdown()
+
+def fetch_thread(url, save_path, key=None, iv=None):
+    with requests.Session() as session:
+        _download_resumable(session, url, save_path, {}, None, key, iv, STREAM_CHUNK_SIZE)
+
+def fetch_async(url, save_path, key=None, iv=None):
+    aiohttp = pytest.importorskip("aiohttp")
+    from async_downloader import _fetch_resumable
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            await _fetch_resumable(session, url, save_path, {}, None, key, iv, STREAM_CHUNK_SIZE)
+    asyncio.run(run())
+
+@pytest.fixture(params=[fetch_thread, fetch_async], ids=["thread", "async"])
+def fetch(request):
+    return request.param
+
+def write_partial(save_path, data, validator):
+    with open(save_path + ".part", "wb") as f:
+        f.write(data)
+    with open(save_path + ".part.json", "w", encoding="utf-8") as f:
+        json.dump({"url": "", "validator": validator}, f)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_fresh_download(tmp_path, server, fetch):
+    save_path = str(tmp_path / "img.jpg")
+    fetch(server.url, save_path)
+    assert read(save_path) == BODY
+    assert "Range" not in server.requests[0]
+    assert not os.path.exists(save_path + ".part") and not os.path.exists(save_path + ".part.json")
+
+def test_resume_with_206(tmp_path, server, fetch):
+    save_path = str(tmp_path / "img.jpg")
+    write_partial(save_path, BODY[:12345], '"v1"')
+    fetch(server.url, save_path)
+    assert server.requests[0]["Range"] == "bytes=12345-"
+    assert server.requests[0]["If-Range"] == '"v1"'
+    assert read(save_path) == BODY
+
+def test_range_ignored_falls_back_to_200(tmp_path, server, fetch):
+    save_path = str(tmp_path / "img.jpg")
+    write_partial(save_path, BODY[:12345], '"v1"')
+    server.honor_range = False
+    fetch(server.url, save_path)
+    assert read(save_path) == BODY
+
+def test_changed_resource_restarts(tmp_path, server, fetch):
+    save_path = str(tmp_path / "img.jpg")
+    write_partial(save_path, BODY[:12345], '"v1"')
+    server.body, server.etag = BODY[::-1], '"v2"'
+    fetch(server.url, save_path)
+    assert read(save_path) == BODY[::-1]
+
+def test_mismatched_content_range(tmp_path, server, fetch):
+    save_path = str(tmp_path / "img.jpg")
+    write_partial(save_path, BODY[:12345], '"v1"')
+    server.bad_offset = True
+    with pytest.raises(ValueError):
+        fetch(server.url, save_path)
+    # 丢弃不可信的部分文件，下一次从头下载
+    assert not os.path.exists(save_path + ".part")
+    server.bad_offset = False
+    fetch(server.url, save_path)
+    assert read(save_path) == BODY
+
+def test_resume_encrypted(tmp_path, server, fetch):
+    # .part 里保存的是密文，续传完成后整体解密
+    pad = 16 - len(BODY) % 16
+    server.body = AES.new(KEY, AES.MODE_CBC, IV).encrypt(BODY + bytes([pad]) * pad)
+    save_path = str(tmp_path / "img.jpg")
+    write_partial(save_path, server.body[:20000], '"v1"')
+    fetch(server.url, save_path, KEY, IV)
+    assert read(save_path) == BODY
+    assert not os.path.exists(save_path + ".part")
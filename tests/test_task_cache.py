@@ -0,0 +1,92 @@
+"""上传文件按内容哈希保存，解析结果缓存：命中时跳过解析，中途停止不留下缓存。"""
+
+import io
+import os
+import json
+import time
+
+from downloader import open_task_file, StreamingTaskFile
+from task_cache import (
+    store_upload, task_file_digest, cache_key, ParsedTaskCache, CachedTaskFile, CachingTaskFile,
+    PARSED_CACHE_DIR_NAME,
+)
+
+TXT = '作者：某人\n第1话\nhttp://cdn/1.jpg\nhttp://cdn/2.jpg,{"Referer": "http://r/"}\n第2话\nhttp://cdn/3.jpg\n'
+
+def upload(upload_folder, content, filename):
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    return store_upload(io.BytesIO(data), str(upload_folder), filename)
+
+def cache_files(upload_folder):
+    root = upload_folder / PARSED_CACHE_DIR_NAME
+    return sorted(os.listdir(root)) if root.exists() else []
+
+def test_store_upload_by_content(tmp_path):
+    path1, digest1 = upload(tmp_path, TXT, "书名.txt")
+    path2, digest2 = upload(tmp_path, TXT, "书名.txt")
+    path3, digest3 = upload(tmp_path, TXT + "http://cdn/4.jpg\n", "书名.txt")
+    assert (path1, digest1) == (path2, digest2)
+    assert digest3 != digest1 and path3 != path1
+    assert task_file_digest(path1) == digest1
+    assert task_file_digest(str(tmp_path / "书名.txt")) is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def test_cache_hit_skips_parsing(tmp_path):
+    task_path, _ = upload(tmp_path, TXT, "书名.txt")
+    first = open_task_file(task_path)
+    assert isinstance(first, CachingTaskFile)
+    items = list(first)
+    assert len(cache_files(tmp_path)) == 1
+
+    second = open_task_file(task_path)
+    assert isinstance(second, CachedTaskFile)
+    assert (second.title, second.author, second.global_referer) == ("书名", "某人", None)
+    assert list(second) == items == list(StreamingTaskFile(task_path))
+    assert items[1] == ("http://cdn/2.jpg", {"Referer": "http://r/"}, "第1话")
+
+def test_cache_keeps_json_meta_after_chapters(tmp_path):
+    data = {"chapters": [{"title": "第1话", "images": [{"url": "http://cdn/1.jpg"}]}],
+            "title": "书名", "author": "作者", "referer": "http://site/"}
+    task_path, _ = upload(tmp_path, json.dumps(data, ensure_ascii=False), "task.json")
+    list(open_task_file(task_path))
+    cached = open_task_file(task_path)
+    assert isinstance(cached, CachedTaskFile)
+    assert (cached.title, cached.author, cached.global_referer) == ("书名", "作者", "http://site/")
+
+def test_partial_iteration_leaves_no_cache(tmp_path):
+    task_path, _ = upload(tmp_path, TXT, "书名.txt")
+    items = iter(open_task_file(task_path))
+    next(items)
+    items.close()
+    assert cache_files(tmp_path) == []
+    assert isinstance(open_task_file(task_path), CachingTaskFile)
+
+def test_same_content_different_name(tmp_path):
+    # .txt 的书名来自文件名，文件名不同时不能共用缓存
+    path_a, digest = upload(tmp_path, TXT, "甲.txt")
+    path_b, _ = upload(tmp_path, TXT, "乙.txt")
+    assert cache_key(digest, "甲.txt") != cache_key(digest, "乙.txt")
+    list(open_task_file(path_a))
+    task_file = open_task_file(path_b)
+    assert isinstance(task_file, CachingTaskFile) and task_file.title == "乙"
+
+def test_corrupt_cache_is_reparsed(tmp_path):
+    task_path, digest = upload(tmp_path, TXT, "书名.txt")
+    cache = ParsedTaskCache(str(tmp_path / PARSED_CACHE_DIR_NAME))
+    os.makedirs(cache.root)
+    key = cache_key(digest, "书名.txt")
+    with open(cache.path(key), "wb") as f:
+        f.write(b"not zlib")
+    assert cache.open(key) is None
+    assert not os.path.exists(cache.path(key))
+    assert len(list(open_task_file(task_path))) == 3
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ParsedTaskCache(str(tmp_path), max_bytes=0)
+    for i, name in enumerate(["old", "mid", "new"]):
+        with open(cache.path(name), "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(cache.path(name), (time.time() - 100 + i, time.time() - 100 + i))
+    cache.max_bytes = 250
+    assert cache.evict() == 1
+    assert sorted(os.listdir(tmp_path)) == ["mid.bin", "new.bin"]
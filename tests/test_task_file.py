@@ -0,0 +1,50 @@
+"""流式任务文件解析：元数据写在 chapters 前后都要在开始下载前读全。"""
+
+import json
+
+import pytest
+
+import downloader
+from downloader import StreamingTaskFile
+
+CHAPTERS = [
+    {"title": "第1话", "images": [{"url": "http://cdn/1.jpg"}, {"url": "http://cdn/2.jpg", "headers": {"Referer": "http://r"}}]},
+    {"title": "第2话", "images": [{"url": "http://cdn/3.jpg"}]},
+]
+
+def write_json(path, data):
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+@pytest.fixture(params=["ijson", "json"])
+def parser(request, monkeypatch):
+    if request.param == "ijson":
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(downloader, "_import_ijson", lambda: None)
+    return request.param
+
+def test_meta_after_chapters(tmp_path, parser):
+    # chapters 写在最前面，作者和源站写在后面
+    task_path = write_json(tmp_path / "book.json", {
+        "chapters": CHAPTERS, "title": "书名", "author": "作者", "referer": "http://site/",
+    })
+    task_file = StreamingTaskFile(task_path)
+    assert (task_file.title, task_file.author, task_file.global_referer) == ("书名", "作者", "http://site/")
+    assert [(url, chapter) for url, _, chapter in task_file] == [
+        ("http://cdn/1.jpg", "第1话"), ("http://cdn/2.jpg", "第1话"), ("http://cdn/3.jpg", "第2话"),
+    ]
+
+def test_meta_before_chapters_without_referer(tmp_path, parser):
+    task_path = write_json(tmp_path / "book.json", {"title": "书名", "author": "作者", "chapters": CHAPTERS})
+    title, author, referer, images = downloader.parse_json_task_file(task_path)
+    assert (title, author, referer) == ("书名", "作者", None)
+    assert images[1] == ("http://cdn/2.jpg", {"Referer": "http://r"}, "第1话")
+
+def test_nested_keys_are_not_meta(tmp_path, parser):
+    # 章节里的同名字段不能当成顶层元数据
+    chapters = [{"title": "第1话", "author": "章节作者", "referer": "http://chapter/", "images": [{"url": "http://cdn/1.jpg"}]}]
+    task_path = write_json(tmp_path / "book.json", {"chapters": chapters, "title": "书名"})
+    task_file = StreamingTaskFile(task_path)
+    assert (task_file.author, task_file.global_referer) == ("未知作者", None)
+    assert len(list(task_file)) == 1
@@ -0,0 +1,107 @@
+"""即时导出 CBZ：完整导出可被 zipfile 读取，任意 Range 片段与完整输出一致，超过 ZIP64 界限时写 ZIP64 记录。"""
+
+import io
+import os
+import random
+import zipfile
+
+import pytest
+
+from zip_export import ZipExport, list_chapters
+from downloader import COMIC_INFO_NAME
+
+def make_book(root, chapters=(("第1话", 3), ("第2话", 2)), size=3000):
+    rng = random.Random(0)
+    book_dir = root / "书名"
+    idx = 0
+    contents = {}
+    for chapter, count in chapters:
+        (book_dir / chapter).mkdir(parents=True)
+        for _ in range(count):
+            idx += 1
+            arcname = f"{chapter}/{idx:04d}.jpg"
+            contents[arcname] = rng.randbytes(size + idx)
+            (book_dir / arcname).write_bytes(contents[arcname])
+    # 下载中的临时文件不导出
+    (book_dir / chapters[0][0] / "0099.jpg.part").write_bytes(b"partial")
+    return str(book_dir), contents
+
+def export_bytes(export, start=0, stop=None):
+    return b"".join(export.iter_range(start, stop))
+
+def check_archive(data, contents, author=None):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        names = zf.namelist()
+        assert names[0] == COMIC_INFO_NAME
+        assert names[1:] == sorted(contents, key=lambda n: int(n[-8:-4]))
+        for name, body in contents.items():
+            assert zf.read(name) == body
+        comic_info = zf.read(COMIC_INFO_NAME).decode("utf-8")
+        if author:
+            assert author in comic_info
+        return zf.infolist()
+
+def test_full_export(tmp_path):
+    book_dir, contents = make_book(tmp_path)
+    export = ZipExport(book_dir, "书名", author="作者")
+    data = export_bytes(export)
+    assert len(data) == export.length
+    check_archive(data, contents, author="作者")
+
+def test_range_slices_match_full_output(tmp_path):
+    book_dir, contents = make_book(tmp_path)
+    export = ZipExport(book_dir, "书名")
+    full = export_bytes(export)
+    # 条目边界前后、中央目录附近以及随机位置
+    cuts = {0, export.length, export.central_directory_offset}
+    for entry in export.entries:
+        cuts.update({entry.offset, entry.data_offset, entry.end})
+    cuts.update(c + d for c in list(cuts) for d in (-1, 1))
+    rng = random.Random(1)
+    cuts.update(rng.randrange(export.length) for _ in range(40))
+    cuts = sorted(c for c in cuts if 0 <= c <= export.length)
+    for _ in range(300):
+        start, stop = sorted(rng.sample(cuts, 2))
+        assert export_bytes(export, start, stop) == full[start:stop]
+    # 续传时会从中间开始，新的 ZipExport 没有算过任何 CRC
+    resumed = ZipExport(book_dir, "书名")
+    assert export_bytes(resumed, export.length - 10) == full[-10:]
+
+def test_chapter_subset(tmp_path):
+    book_dir, contents = make_book(tmp_path)
+    assert list_chapters(book_dir) == ["第1话", "第2话"]
+    export = ZipExport(book_dir, "书名", chapters=["第2话"])
+    check_archive(export_bytes(export), {k: v for k, v in contents.items() if k.startswith("第2话/")})
+    with pytest.raises(FileNotFoundError):
+        ZipExport(book_dir, "书名", chapters=["第9话"])
+
+def test_zip64_offsets_and_sizes(tmp_path, monkeypatch):
+    # 调低界限，用几 KB 的文件走到 ZIP64 的大小、偏移和结束记录分支
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 3002)
+    book_dir, contents = make_book(tmp_path)
+    export = ZipExport(book_dir, "书名")
+    assert any(e.zip64 for e in export.entries) and not all(e.zip64 for e in export.entries)
+    assert export.central_directory_offset > zipfile.ZIP64_LIMIT
+    data = export_bytes(export)
+    assert len(data) == export.length
+    assert b"PK\x06\x06" in data[export.central_directory_offset:]
+    infos = check_archive(data, contents)
+    assert [i.header_offset for i in infos] == [e.offset for e in export.entries]
+
+def test_etag_and_changed_file(tmp_path):
+    book_dir, contents = make_book(tmp_path)
+    export = ZipExport(book_dir, "书名")
+    assert ZipExport(book_dir, "书名").etag == export.etag
+    path = os.path.join(book_dir, "第1话", "0001.jpg")
+    with open(path, "ab") as f:
+        f.write(b"more")
+    assert ZipExport(book_dir, "书名").etag != export.etag
+    # 导出过程中文件被改动时中止输出，而不是写出与中央目录不符的数据
+    with pytest.raises(IOError):
+        export_bytes(export)
+
+def test_empty_book(tmp_path):
+    (tmp_path / "空").mkdir()
+    with pytest.raises(FileNotFoundError):
+        ZipExport(str(tmp_path / "空"), "空")
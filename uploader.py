@@ -0,0 +1,116 @@
+# --- START OF FILE uploader.py ---
+
+"""
+rclone 上传：用 --use-json-log 让 rclone 输出 JSON 日志，从统计信息里解析已传字节、速度和剩余时间，
+节流后写入任务状态，不再把每一行进度输出当作日志保存。上传在独立的线程池里运行，同时进行的上传数有上限。
+"""
+
+import json
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时运行的 rclone 进程数，其余上传排队
+MAX_CONCURRENT_UPLOADS = 2
+RCLONE_STATS_INTERVAL = 1
+# 结构化进度写入任务状态的最小间隔（秒）
+UPLOAD_STATUS_INTERVAL = 2.0
+
+def build_rclone_command(local_path, remote_path, stats_interval=RCLONE_STATS_INTERVAL):
+    # 统计信息默认在 INFO 级别输出，提到 NOTICE 后不加 -v 也会打印，其余 INFO 日志不输出
+    return ["rclone", "copy", local_path, remote_path, "--use-json-log",
+            f"--stats={stats_interval}s", "--stats-log-level", "NOTICE"]
+
+def parse_rclone_line(line):
+    """解析一行 rclone JSON 日志，返回 (级别, 消息, 统计)。不是 JSON 的行（如 rclone 启动前的报错）原样作为消息。"""
+    line = line.strip()
+    if not line:
+        return None, None, None
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return 'notice', line, None
+    if not isinstance(entry, dict):
+        return 'notice', line, None
+    stats = entry.get('stats')
+    return entry.get('level', 'notice'), (entry.get('msg') or '').strip(), stats if isinstance(stats, dict) else None
+
+def summarize_rclone_stats(stats):
+    done = stats.get('bytes') or 0
+    total = stats.get('totalBytes') or 0
+    return {
+        'bytes': done, 'total_bytes': total,
+        'percent': round(done / total * 100, 1) if total else 0,
+        'speed': round(stats.get('speed') or 0), 'eta': stats.get('eta'),
+        'transfers': stats.get('transfers', 0), 'total_transfers': stats.get('totalTransfers', 0),
+        'errors': stats.get('errors', 0), 'elapsed': round(stats.get('elapsedTime') or 0, 1),
+    }
+
+def run_rclone(local_path, remote_path, on_stats, on_message, status_interval=UPLOAD_STATUS_INTERVAL):
+    """
+    运行 rclone copy 并返回退出码。on_stats(统计摘要) 最多每 status_interval 秒调用一次，
+    结束前总会用最后一次统计再调用一次；其他日志交给 on_message(级别, 消息)。
+    """
+    process = subprocess.Popen(build_rclone_command(local_path, remote_path), stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace')
+    last_report = 0
+    pending = None
+    for line in process.stdout:
+        level, msg, stats = parse_rclone_line(line)
+        if stats is not None:
+            pending = summarize_rclone_stats(stats)
+            now = time.time()
+            if now - last_report >= status_interval:
+                on_stats(pending)
+                last_report = now
+                pending = None
+        elif msg:
+            on_message(level, msg)
+    returncode = process.wait()
+    if pending is not None:
+        on_stats(pending)
+    return returncode
+
+def format_upload_stats(summary):
+    eta = f"，剩余{summary['eta']}秒" if summary.get('eta') is not None else ""
+    return (f"已上传 {summary['bytes'] / 1024 / 1024:.1f}/{summary['total_bytes'] / 1024 / 1024:.1f}MB"
+            f"（{summary['percent']}%），{summary['speed'] / 1024 / 1024:.2f}MB/秒{eta}")
+
+class UploadManager:
+    """
+    上传任务的执行器：最多 max_concurrent 个同时运行，其余排队。
+    记录排队中和进行中的上传所需的本地文件，清理输出目录时不会删除它们。
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPLOADS):
+        self.max_concurrent = max_concurrent
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="rclone-upload")
+        self._paths = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, upload_id, local_path, fn):
+        with self._lock:
+            self._paths[upload_id] = local_path
+
+        def run():
+            with self._lock:
+                self._running.add(upload_id)
+            try:
+                fn()
+            finally:
+                with self._lock:
+                    self._paths.pop(upload_id, None)
+                    self._running.discard(upload_id)
+        return self._executor.submit(run)
+
+    def pending_paths(self):
+        with self._lock:
+            return set(self._paths.values())
+
+    def stats(self):
+        with self._lock:
+            running = len(self._running)
+            return {'running': running, 'queued': len(self._paths) - running, 'max_concurrent': self.max_concurrent}
+
+# --- END OF FILE uploader.py ---
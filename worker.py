@@ -0,0 +1,47 @@
+# --- START OF FILE worker.py ---
+
+"""
+分布式下载进程：从 Redis 领取图片下载工作项。可以在多台机器上同时运行多个，
+各节点需要连接同一个 Redis，并挂载 Web 进程的输出目录（挂载路径不同时用 --output 指定）。
+
+    python worker.py --redis redis://localhost:6379/0 --concurrency 16
+"""
+
+import signal
+import argparse
+
+import redis
+
+from distributed import DistributedWorker, DIST_VISIBILITY_TIMEOUT
+from metrics import start_metrics_server
+
+def main():
+    parser = argparse.ArgumentParser(description="漫画下载器的分布式下载进程")
+    parser.add_argument("--redis", default="redis://localhost:6379/0", help="Redis 地址")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时下载的图片数")
+    parser.add_argument("--output", default=None, help="本机上输出目录的路径，默认使用任务中记录的路径")
+    parser.add_argument("--name", default=None, help="消费者名称，默认为 主机名-进程号")
+    parser.add_argument("--visibility-timeout", type=int, default=DIST_VISIBILITY_TIMEOUT,
+                        help="工作项超过该秒数未确认时由其他进程接管")
+    parser.add_argument("--metrics-port", type=int, default=None, help="在该端口导出 Prometheus 指标（/metrics）")
+    args = parser.parse_args()
+
+    redis_client = redis.Redis.from_url(args.redis, decode_responses=True)
+    redis_client.ping()
+    worker = DistributedWorker(redis_client, concurrency=args.concurrency, consumer=args.name,
+                               output_folder=args.output, visibility_timeout=args.visibility_timeout)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+        print(f"指标已导出到 :{args.metrics_port}/metrics")
+    print(f"下载进程 {worker.consumer} 已启动，并发 {args.concurrency}")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+    print(f"下载进程 {worker.consumer} 已退出，共处理 {worker.processed} 个工作项")
+
+if __name__ == "__main__":
+    main()
+
+# --- END OF FILE worker.py ---
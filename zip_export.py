@@ -0,0 +1,287 @@
+# --- START OF FILE zip_export.py ---
+
+"""
+把书籍目录（或其中几个章节）即时导出为 ZIP_STORED 的 CBZ，不在磁盘上生成临时压缩包。
+存储模式下每个条目的大小就是文件大小，只靠 stat 就能排好全部条目、算出每个本地文件头的偏移和整个压缩包的长度，
+因此响应有准确的 Content-Length，也可以按 Range 只输出其中一段，断点续传不需要从头生成。
+CRC32 在输出到对应条目时才计算，并按 (设备, inode, 大小, mtime) 缓存在进程内，
+重复导出、续传或同一张图片以硬链接出现在多本书里时不会重复读取。
+"""
+
+import os
+import time
+import zlib
+import struct
+import hashlib
+import threading
+import zipfile
+from collections import OrderedDict
+
+from downloader import COMIC_INFO_NAME, PACK_SKIP_SUFFIXES, build_comic_info, archive_sort_key
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+# 不超过该大小的图片整张读入内存，计算 CRC 和输出只读一次文件
+EXPORT_BUFFER_MAX = 8 * 1024 * 1024
+CRC_CACHE_MAX_ENTRIES = 200000
+
+_LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+_CENTRAL_HEADER = struct.Struct("<4sHHHHHHLLLHHHHHLL")
+_END_RECORD = struct.Struct("<4sHHHHLLH")
+_END_RECORD64 = struct.Struct("<4sQHHLLQQQQ")
+_END_LOCATOR64 = struct.Struct("<4sLQL")
+_FLAG_UTF8 = 0x800
+_ZIP64_MAX = 0xFFFFFFFF
+# 与 zipfile 写出的条目一致：Unix 创建，普通文件 0644
+_CREATE_SYSTEM_UNIX = 3
+_EXTERNAL_ATTR = (0o100644 & 0xFFFF) << 16
+
+_crc_cache = OrderedDict()
+_crc_lock = threading.Lock()
+
+def _cached_crc(key):
+    with _crc_lock:
+        crc = _crc_cache.get(key)
+        if crc is not None:
+            _crc_cache.move_to_end(key)
+        return crc
+
+def _store_crc(key, crc):
+    with _crc_lock:
+        _crc_cache[key] = crc
+        _crc_cache.move_to_end(key)
+        while len(_crc_cache) > CRC_CACHE_MAX_ENTRIES:
+            _crc_cache.popitem(last=False)
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+class ExportEntry:
+    """压缩包中的一个条目：磁盘上的文件（path）或内存中的数据（data，用于 ComicInfo.xml）。"""
+    __slots__ = ("arcname", "path", "data", "size", "mtime", "stat_key", "offset", "crc", "_name", "_flags")
+
+    def __init__(self, arcname, size, mtime, path=None, data=None, stat_key=None):
+        self.arcname = arcname
+        self.path = path
+        self.data = data
+        self.size = size
+        self.mtime = mtime
+        self.stat_key = stat_key
+        self.offset = 0
+        self.crc = zlib.crc32(data) if data is not None else None
+        try:
+            self._name = arcname.encode("ascii")
+            self._flags = 0
+        except UnicodeEncodeError:
+            self._name = arcname.encode("utf-8")
+            self._flags = _FLAG_UTF8
+
+    @property
+    def zip64(self):
+        return self.size > zipfile.ZIP64_LIMIT
+
+    @property
+    def header_size(self):
+        return _LOCAL_HEADER.size + len(self._name) + (20 if self.zip64 else 0)
+
+    @property
+    def data_offset(self):
+        return self.offset + self.header_size
+
+    @property
+    def end(self):
+        return self.data_offset + self.size
+
+    def _central_zip64_fields(self):
+        fields = [self.size, self.size] if self.zip64 else []
+        if self.offset > zipfile.ZIP64_LIMIT:
+            fields.append(self.offset)
+        return fields
+
+    @property
+    def central_size(self):
+        fields = self._central_zip64_fields()
+        return _CENTRAL_HEADER.size + len(self._name) + (4 + 8 * len(fields) if fields else 0)
+
+    def ensure_crc(self):
+        if self.crc is None:
+            crc = _cached_crc(self.stat_key)
+            if crc is None:
+                crc = 0
+                with open(self.path, "rb") as f:
+                    self._check_size(f)
+                    while True:
+                        chunk = f.read(EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        crc = zlib.crc32(chunk, crc)
+                _store_crc(self.stat_key, crc)
+            self.crc = crc
+        return self.crc
+
+    def _check_size(self, f):
+        # 导出期间图片被替换或截断时中止输出，客户端按新的 ETag 重新下载
+        size = os.fstat(f.fileno()).st_size
+        if size != self.size:
+            raise IOError(f"导出期间文件发生变化: {self.arcname}（{self.size} -> {size}）")
+
+    def local_header(self):
+        dostime, dosdate = _dos_datetime(self.mtime)
+        extra = b""
+        size = self.size
+        version = 20
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, self.size, self.size)
+            size = _ZIP64_MAX
+            version = 45
+        return _LOCAL_HEADER.pack(b"PK\x03\x04", version, self._flags, zipfile.ZIP_STORED, dostime, dosdate,
+                                  self.ensure_crc(), size, size, len(self._name), len(extra)) + self._name + extra
+
+    def central_header(self):
+        dostime, dosdate = _dos_datetime(self.mtime)
+        fields = self._central_zip64_fields()
+        size = _ZIP64_MAX if self.zip64 else self.size
+        offset = _ZIP64_MAX if self.offset > zipfile.ZIP64_LIMIT else self.offset
+        extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields) if fields else b""
+        version = 45 if fields else 20
+        return _CENTRAL_HEADER.pack(b"PK\x01\x02", (_CREATE_SYSTEM_UNIX << 8) | version, version, self._flags,
+                                    zipfile.ZIP_STORED, dostime, dosdate, self.ensure_crc(), size, size,
+                                    len(self._name), len(extra), 0, 0, 0, _EXTERNAL_ATTR, offset) \
+            + self._name + extra
+
+    def iter_data(self, start, stop):
+        """输出数据区中 [start, stop) 这一段（相对条目数据开头）。"""
+        if self.data is not None:
+            yield self.data[start:stop]
+            return
+        with open(self.path, "rb") as f:
+            self._check_size(f)
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(EXPORT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"导出期间文件被截断: {self.arcname}")
+                remaining -= len(chunk)
+                yield chunk
+
+    def read_all(self):
+        """整张读入并顺便算出 CRC，只用于不超过 EXPORT_BUFFER_MAX 的图片。"""
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            self._check_size(f)
+            data = f.read()
+        if len(data) != self.size:
+            raise IOError(f"导出期间文件被截断: {self.arcname}")
+        if self.crc is None:
+            self.crc = zlib.crc32(data)
+            _store_crc(self.stat_key, self.crc)
+        return data
+
+def list_chapters(book_dir):
+    """书籍目录下的章节（一级子目录）名称，按目录中第一张图片的序号排序，即阅读顺序。"""
+    chapters = []
+    with os.scandir(book_dir) as it:
+        for entry in it:
+            if entry.is_dir() and not entry.name.startswith("."):
+                names = [n for n in os.listdir(entry.path) if not n.endswith(PACK_SKIP_SUFFIXES)]
+                first = min((archive_sort_key(n) for n in names), default=(3, 0, ""))
+                chapters.append((first, entry.name))
+    return [name for _, name in sorted(chapters)]
+
+class ZipExport:
+    """
+    按 stat 结果排好的一份导出：entries 的偏移、central_directory_offset 和 length 在构造时就已确定。
+    条目顺序与 StreamingCBZPacker 写出的 CBZ 相同，ComicInfo.xml 在最前。
+    """
+    def __init__(self, book_dir, title, chapters=None, author=None):
+        self.book_dir = book_dir
+        self.title = title
+        self.chapters = list(chapters) if chapters else None
+        files = self._scan()
+        if not files:
+            raise FileNotFoundError("没有可导出的图片")
+        files.sort(key=lambda e: archive_sort_key(e.arcname))
+        mtime = max(e.mtime for e in files)
+        comic_info = build_comic_info(title, author, len(files)).encode("utf-8")
+        self.entries = [ExportEntry(COMIC_INFO_NAME, len(comic_info), mtime, data=comic_info)] + files
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset = entry.end
+        self.central_directory_offset = offset
+        self.central_directory_size = sum(e.central_size for e in self.entries)
+        self._end = self._end_records()
+        self.length = self.central_directory_offset + self.central_directory_size + len(self._end)
+        self.last_modified = mtime
+        digest = hashlib.sha1(self.title.encode("utf-8"))
+        for e in files:
+            digest.update(f"{e.arcname}\0{e.size}\0{e.stat_key}\n".encode("utf-8"))
+        self.etag = digest.hexdigest()
+
+    def _scan(self):
+        files = []
+        roots = [os.path.join(self.book_dir, c) for c in self.chapters] if self.chapters else [self.book_dir]
+        for top in roots:
+            if not os.path.isdir(top):
+                raise FileNotFoundError(f"章节不存在: {os.path.relpath(top, self.book_dir)}")
+            for root, dirs, names in os.walk(top):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for name in names:
+                    if name.endswith(PACK_SKIP_SUFFIXES) or name.startswith("."):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    arcname = os.path.relpath(path, self.book_dir).replace(os.sep, "/")
+                    files.append(ExportEntry(arcname, st.st_size, st.st_mtime, path=path,
+                                             stat_key=(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)))
+        return files
+
+    def _end_records(self):
+        count = len(self.entries)
+        cd_offset, cd_size = self.central_directory_offset, self.central_directory_size
+        records = b""
+        if count > zipfile.ZIP_FILECOUNT_LIMIT or cd_offset > zipfile.ZIP64_LIMIT or cd_size > zipfile.ZIP64_LIMIT:
+            end64_offset = cd_offset + cd_size
+            records += _END_RECORD64.pack(b"PK\x06\x06", _END_RECORD64.size - 12, 45, 45, 0, 0,
+                                          count, count, cd_size, cd_offset)
+            records += _END_LOCATOR64.pack(b"PK\x06\x07", 0, end64_offset, 1)
+            count = min(count, 0xFFFF)
+            cd_offset = min(cd_offset, _ZIP64_MAX)
+            cd_size = min(cd_size, _ZIP64_MAX)
+        return records + _END_RECORD.pack(b"PK\x05\x06", 0, 0, count, count, cd_size, cd_offset, 0)
+
+    def iter_range(self, start=0, stop=None):
+        """按顺序输出压缩包中 [start, stop) 这一段字节，只读取与该段相交的条目。"""
+        stop = self.length if stop is None else min(stop, self.length)
+        for entry in self.entries:
+            if entry.end <= start:
+                continue
+            if entry.offset >= stop:
+                return
+            data_offset = entry.data_offset
+            if start <= entry.offset and entry.end <= stop and entry.size <= EXPORT_BUFFER_MAX:
+                data = entry.read_all()
+                yield entry.local_header()
+                if data:
+                    yield data
+                continue
+            if start < data_offset:
+                yield entry.local_header()[max(start - entry.offset, 0):stop - entry.offset]
+            lo, hi = max(start, data_offset), min(stop, entry.end)
+            if lo < hi:
+                yield from entry.iter_data(lo - data_offset, hi - data_offset)
+        if stop <= self.central_directory_offset:
+            return
+        # 中央目录需要全部条目的 CRC，续传时没输出过的条目在这里补算（命中缓存时不读文件）
+        tail = b"".join(e.central_header() for e in self.entries) + self._end
+        yield tail[max(start - self.central_directory_offset, 0):stop - self.central_directory_offset]
+
+# --- END OF FILE zip_export.py ---